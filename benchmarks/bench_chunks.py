@@ -0,0 +1,86 @@
+"""
+bench_chunks.py: measure the throughput of Client.map() for trivial tasks
+on a LocalCluster, with and without chunking.
+
+Each task is a FunctionTask that returns its argument, or, with
+--subprocess, a SubprocessTask that runs "echo". The table gives tasks per
+second from the call to map() until every result has been gathered.
+
+Usage:
+
+    python benchmarks/bench_chunks.py [--subprocess] [n_tasks] [chunksize ...]
+
+The defaults are 100000 tasks, and chunk sizes of none (one Dask task per
+element), 100, 1000 and auto.
+"""
+
+import sys
+import time
+
+from dask.distributed import LocalCluster
+
+from crossflow import clients, config, tasks
+
+
+def identity(x):
+    """
+    The trivial FunctionTask.
+    """
+    return x
+
+
+def make_task(subprocess):
+    """
+    Returns the task to map.
+    """
+    if subprocess:
+        task = tasks.SubprocessTask("echo {x}")
+        task.set_inputs(["x"])
+        task.set_outputs([tasks.STDOUT])
+    else:
+        task = tasks.FunctionTask(identity)
+        task.set_inputs(["x"])
+        task.set_outputs(["x"])
+    return task
+
+
+def throughput(client, task, n_tasks, chunksize):
+    """
+    Returns tasks per second for one map() over n_tasks elements.
+    """
+    t0 = time.perf_counter()
+    futures = client.map(task, list(range(n_tasks)), chunksize=chunksize)
+    client.gather(futures)
+    elapsed = time.perf_counter() - t0
+    del futures
+    return n_tasks / elapsed
+
+
+def main():
+    """
+    Run the benchmark and print a table of results.
+    """
+    args = sys.argv[1:]
+    subprocess = "--subprocess" in args
+    args = [a for a in args if a != "--subprocess"]
+    n_tasks = int(args[0]) if args else 100000
+    chunksizes = [None if a == "none" else a for a in args[1:]] or [
+        None,
+        100,
+        1000,
+        "auto",
+    ]
+    config.STAGE_POINT = None
+    task = make_task(subprocess)
+    with LocalCluster(n_workers=4, threads_per_worker=1, processes=True) as cluster:
+        with clients.Client(cluster) as client:
+            print(f"{'chunksize':>10s}{'tasks/s':>12s}")
+            for chunksize in chunksizes:
+                if chunksize not in (None, "auto"):
+                    chunksize = int(chunksize)
+                rate = throughput(client, task, n_tasks, chunksize)
+                print(f"{str(chunksize):>10s}{rate:12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+bench_compression.py: compare the throughput and compression ratio of the
+FileHandle codecs on MD-style binary and text data.
+
+Usage:
+
+    python benchmarks/bench_compression.py [size_in_MB]
+
+Codecs whose libraries are not installed (e.g. zstandard, lz4) are skipped.
+"""
+
+import array
+import io
+import random
+import sys
+import time
+
+from crossflow import compression, config
+
+
+def md_binary(size):
+    """
+    A DCD/netCDF-like trajectory: frames of float32 coordinates that
+    drift slowly from frame to frame.
+    """
+    rng = random.Random(42)
+    n_atoms = 10000
+    coords = [rng.uniform(-50.0, 50.0) for _ in range(3 * n_atoms)]
+    frames = []
+    total = 0
+    while total < size:
+        coords = [x + rng.gauss(0.0, 0.05) for x in coords]
+        frame = array.array("f", coords).tobytes()
+        frames.append(frame)
+        total += len(frame)
+    return b"".join(frames)[:size]
+
+
+def md_text(size):
+    """
+    A PDB-like coordinate file.
+    """
+    rng = random.Random(42)
+    residues = ["ALA", "ARG", "ASN", "ASP", "CYS", "GLN", "GLU", "GLY", "HIS"]
+    lines = []
+    total = 0
+    i = 0
+    while total < size:
+        i += 1
+        line = (
+            f"ATOM  {i % 100000:5d}  CA  {rng.choice(residues)} A{i % 10000:4d}    "
+            f"{rng.uniform(-50, 50):8.3f}{rng.uniform(-50, 50):8.3f}"
+            f"{rng.uniform(-50, 50):8.3f}  1.00  0.00           C\n"
+        )
+        lines.append(line)
+        total += len(line)
+    return "".join(lines).encode()[:size]
+
+
+def bench(codec, data):
+    """
+    Returns (compress MB/s, decompress MB/s, ratio) for codec on data.
+    """
+    sink = io.BytesIO()
+    start = time.perf_counter()
+    for offset in range(0, len(data), config.BUFFER_SIZE):
+        compression.write_block(sink, codec, data[offset : offset + config.BUFFER_SIZE])
+    compress_time = time.perf_counter() - start
+    sink.seek(0)
+    start = time.perf_counter()
+    for _ in compression.iter_blocks(sink):
+        pass
+    decompress_time = time.perf_counter() - start
+    megabytes = len(data) / 1e6
+    return (
+        megabytes / compress_time,
+        megabytes / decompress_time,
+        len(sink.getvalue()) / len(data),
+    )
+
+
+def main():
+    """
+    Run the benchmarks and print a table of results.
+    """
+    size = int(float(sys.argv[1]) * 1e6) if len(sys.argv) > 1 else 32 * 10**6
+    datasets = {"binary": md_binary(size), "text": md_text(size)}
+    print(f"{'data':8s}{'codec':8s}{'comp MB/s':>12s}{'decomp MB/s':>14s}{'ratio':>8s}")
+    for label, data in datasets.items():
+        for name in compression.available_codecs():
+            comp, decomp, ratio = bench(compression.get_codec(name), data)
+            print(f"{label:8s}{name:8s}{comp:12.1f}{decomp:14.1f}{ratio:8.3f}")
+        auto = compression.select_codec(sample=data, size=len(data)).name
+        print(f"{label:8s}auto selects {auto}")
+
+
+if __name__ == "__main__":
+    main()
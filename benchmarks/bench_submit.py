@@ -0,0 +1,72 @@
+"""
+bench_submit.py: measure the latency from Client.submit() to the start of
+a task on a LocalCluster worker, for large FileHandle arguments.
+
+FileHandle payloads travel as out-of-band frames; for comparison the same
+payload is also sent as plain bytes embedded in the task pickle.
+
+Usage:
+
+    python benchmarks/bench_submit.py [size_in_MB ...]
+
+The default sizes are 100 and 1000 MB.
+"""
+
+import os
+import statistics
+import sys
+import tempfile
+import time
+import warnings
+
+from dask.distributed import LocalCluster
+
+from crossflow import clients, config, filehandling
+
+
+def started(_):
+    """
+    The task: return the time at which it started.
+    """
+    return time.time()
+
+
+def latency(client, arg, repeats=3):
+    """
+    Returns the median submit-to-start latency, in seconds, for arg.
+    """
+    times = []
+    for _ in range(repeats):
+        t0 = time.time()
+        t1 = client.submit(started, arg, pure=False).result()
+        times.append(t1 - t0)
+    return statistics.median(times)
+
+
+def main():
+    """
+    Run the benchmark and print a table of results.
+    """
+    sizes = [int(s) for s in sys.argv[1:]] or [100, 1000]
+    warnings.filterwarnings("ignore", message="Sending large graph")
+    config.STAGE_POINT = None
+    config.COMPRESSION = "none"
+    with LocalCluster(n_workers=1, threads_per_worker=1, processes=True) as cluster:
+        with clients.Client(cluster) as client:
+            print(f"{'size MB':>8s}{'FileHandle s':>14s}{'in-band bytes s':>17s}")
+            for size in sizes:
+                with tempfile.TemporaryDirectory() as td:
+                    path = os.path.join(td, "payload.dat")
+                    with open(path, "wb") as f:
+                        for _ in range(size):
+                            f.write(os.urandom(1024 * 1024))
+                    handle = filehandling.FileHandler().load(path)
+                    fh_time = latency(client, handle)
+                    in_band = ("bytes", handle.read_binary())
+                    bytes_time = latency(client, in_band)
+                    del handle, in_band
+                print(f"{size:8d}{fh_time:14.3f}{bytes_time:17.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+capture.py: bounded-memory capture of subprocess output.
+
+An OutputCapture collects what a subprocess writes to a pipe, holding at
+most a fixed number of bytes in memory and spilling the rest to a file:
+
+    capture = OutputCapture(limit=1024 * 1024, directory=scratch)
+    drain(process.stdout, capture)
+
+or, to keep only the end of the output (e.g. of stderr, for an error
+message):
+
+    capture = OutputCapture(tail=64 * 1024)
+"""
+
+import os
+import tempfile
+import threading
+
+
+class OutputCapture:
+    """
+    A write-only buffer that spills to a file once it holds more than limit
+    bytes, or that keeps only the last tail bytes written to it.
+
+    args:
+        limit (int): the number of bytes to hold in memory
+        directory (str, optional): where to create the spill file
+        tail (int, optional): if given, keep only this many of the most
+            recently written bytes, in memory, and never spill
+
+    """
+
+    def __init__(self, limit=0, directory=None, tail=None):
+        self.limit = limit
+        self.directory = directory
+        self.tail_size = tail
+        self.path = None
+        self.size = 0
+        self._buffer = bytearray()
+        self._file = None
+
+    def write(self, data):
+        """
+        Add data to the capture.
+        """
+        self.size += len(data)
+        if self.tail_size is not None:
+            self._buffer += data
+            excess = len(self._buffer) - self.tail_size
+            if excess > 0:
+                del self._buffer[:excess]
+            return
+        if self._file is None and len(self._buffer) + len(data) > self.limit:
+            fd, self.path = tempfile.mkstemp(
+                prefix="crossflow-output-", dir=self.directory
+            )
+            self._file = os.fdopen(fd, "wb")
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+        if self._file is None:
+            self._buffer += data
+        else:
+            self._file.write(data)
+
+    @property
+    def spilled(self):
+        """
+        True if the output has been written to a file.
+        """
+        return self.path is not None
+
+    def flush(self):
+        """
+        Finish writing the spill file, if there is one.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def to_file(self):
+        """
+        Returns the path of a file holding the captured output, spilling it
+        if it is still in memory.
+        """
+        if self.path is None:
+            fd, self.path = tempfile.mkstemp(
+                prefix="crossflow-output-", dir=self.directory
+            )
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._buffer)
+            self._buffer = bytearray()
+        self.flush()
+        return self.path
+
+    def getvalue(self):
+        """
+        Returns everything captured (or, with tail, the last tail bytes).
+        """
+        self.flush()
+        if self.path is None:
+            return bytes(self._buffer)
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def tail(self, size):
+        """
+        Returns at most the last size bytes captured.
+        """
+        self.flush()
+        if self.path is None:
+            return bytes(self._buffer[-size:]) if size else b""
+        with open(self.path, "rb") as f:
+            f.seek(max(0, self.size - size))
+            return f.read()
+
+    def close(self):
+        """
+        Discard the capture, removing any spill file.
+        """
+        self.flush()
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+        self._buffer = bytearray()
+
+
+def drain(pipe, capture, chunk_size=64 * 1024):
+    """
+    Start a thread that copies everything from a pipe into a capture, and
+    closes the pipe at the end.
+
+    args:
+        pipe (file-like): a binary pipe
+        capture (OutputCapture): where to put the data
+        chunk_size (int, optional): the maximum size of each read
+
+    returns:
+        threading.Thread: the thread, which should be joined
+    """
+
+    def run():
+        with pipe:
+            for chunk in iter(lambda: pipe.read1(chunk_size), b""):
+                capture.write(chunk)
+
+    thread = threading.Thread(target=run, name="crossflow-capture", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,60 @@
+"""
+cli.py: the crossflow command line tool.
+
+    crossflow staging [STAGE_POINT] [--collect] [--grace SECONDS]
+
+reports how much is stored at a stage point, and optionally deletes
+staged files that are no longer in use.
+"""
+
+import argparse
+
+from . import config, staging
+
+
+def _megabytes(nbytes):
+    return f"{nbytes / 1e6:.1f} MB"
+
+
+def main(argv=None):
+    """
+    Entry point for the crossflow command.
+    """
+    parser = argparse.ArgumentParser(prog="crossflow")
+    commands = parser.add_subparsers(dest="command", required=True)
+    staging_parser = commands.add_parser(
+        "staging", help="report or clean up usage of a stage point"
+    )
+    staging_parser.add_argument(
+        "stage_point", nargs="?", default=config.STAGE_POINT, help="the stage point"
+    )
+    staging_parser.add_argument(
+        "--collect",
+        action="store_true",
+        help="delete staged files no live process is using",
+    )
+    staging_parser.add_argument(
+        "--grace",
+        type=float,
+        default=None,
+        help="only delete files older than this many seconds",
+    )
+    args = parser.parse_args(argv)
+
+    if args.stage_point is None:
+        parser.error("no stage point given")
+    if args.collect:
+        removed = staging.collect(args.stage_point, grace=args.grace)
+        print(f"removed {removed['files']} files ({_megabytes(removed['bytes'])})")
+    report = staging.usage(args.stage_point)
+    print(f"stage point:     {args.stage_point}")
+    print(f"staged files:    {report['files']} ({_megabytes(report['bytes'])})")
+    print(
+        f"in use:          {report['live_files']} ({_megabytes(report['live_bytes'])})"
+    )
+    print(f"live processes:  {report['processes']}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -3,16 +3,216 @@ clients.py: thin wrapper over dask client
 """
 
 from collections.abc import Iterable
-import glob
+import functools
+import math
+import os.path as op
 import pickle
 import sys
+import threading
+import uuid
 
 from dask.distributed import Client as DaskClient
-from dask.distributed import Future
+from dask.distributed import Future, Queue
 
-from . import config
-from .filehandling import FileHandler
-from .tasks import FunctionTask, SubprocessTask
+from . import config, iostats, staging, streaming, timings
+from .filehandling import FileHandle, FileHandler, visible_directories
+from .speculation import SpeculativeFuture, Speculator, _Race
+from .tasks import FunctionTask, SubprocessTask, TaskChain
+
+# the kinds of task the client runs through their run() methods
+_TASKS = (SubprocessTask, FunctionTask, TaskChain)
+
+
+def _task_function(task):
+    """
+    Returns the method that runs a task on a worker: run_async() for a
+    SubprocessTask set to the "async" executor, otherwise run().
+    """
+    if getattr(task, "executor", None) == "async":
+        return task.run_async
+    return task.run
+
+
+def _run_chunk(func, rows):
+    """
+    Run a task or function on each of a list of argument tuples, in one
+    worker call.
+    """
+    if isinstance(func, _TASKS):
+        func = func.run
+    return [func(*row) for row in rows]
+
+
+def _run_streamed(task, queue_name, *args):
+    """
+    Run a task on a worker, sending the files it publishes to the Dask
+    Queue called queue_name, see crossflow.streaming.
+    """
+    sink = streaming.QueueSink(queue_name)
+    try:
+        return task.run_streamed(sink, *args)
+    finally:
+        sink.close()
+
+
+def _chunk_item(results, i, j=None):
+    """
+    Pick out the result of one element (or one output of one element) of a
+    chunk.
+    """
+    if j is None:
+        return results[i]
+    return results[i][j]
+
+
+class _Chunk:
+    """
+    The future for a chunk of elements run by Client.map(), and its results
+    once they have been fetched.
+    """
+
+    def __init__(self, future):
+        self.future = future
+        self._results = None
+        self._lock = threading.Lock()
+
+    def results(self, timeout=None):
+        """
+        Returns the results of the chunk, fetching them once.
+        """
+        with self._lock:
+            if self._results is None:
+                self._results = self.future.result(timeout)
+            return self._results
+
+    def set_results(self, results):
+        """
+        Record results fetched elsewhere, e.g. by Client.gather().
+        """
+        with self._lock:
+            self._results = results
+
+
+class ElementFuture:
+    """
+    A future for one element, or one output of one element, of a chunked
+    Client.map().
+
+    It behaves like a Dask future for result(), done(), exception() and
+    add_done_callback(), and can be passed to Client.gather(),
+    Client.submit() and Client.map(). The results of a chunk are fetched
+    once, however many of its elements are asked for. Cancelling an
+    element cancels its whole chunk.
+
+    """
+
+    def __init__(self, client, chunk, index, output=None):
+        self._client = client
+        self.chunk = chunk
+        self.index = index
+        self.output = output
+        self._future = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (
+            f"<ElementFuture: {self.status}, chunk={self.chunk.future.key}, "
+            f"index={self.index}>"
+        )
+
+    @property
+    def status(self):
+        """
+        The status of the chunk.
+        """
+        return self.chunk.future.status
+
+    def result(self, timeout=None):
+        """
+        Wait for and return the result of the element.
+        """
+        result = self.chunk.results(timeout)[self.index]
+        return result if self.output is None else result[self.output]
+
+    def done(self):
+        """
+        Returns True if the chunk has finished.
+        """
+        return self.chunk.future.done()
+
+    def exception(self, timeout=None):
+        """
+        Returns the exception raised by the chunk, if any.
+        """
+        return self.chunk.future.exception(timeout)
+
+    def cancel(self):
+        """
+        Cancel the chunk this element belongs to.
+        """
+        self.chunk.future.cancel()
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(self) when the chunk finishes.
+        """
+        self.chunk.future.add_done_callback(lambda _: fn(self))
+
+    def future(self):
+        """
+        Returns a Dask future for the element, creating a task to pick it
+        out of its chunk the first time this is called.
+        """
+        with self._lock:
+            if self._future is None:
+                self._future = DaskClient.submit(
+                    self._client,
+                    _chunk_item,
+                    self.chunk.future,
+                    self.index,
+                    self.output,
+                )
+            return self._future
+
+
+def _replace_element_futures(item, replace):
+    """
+    Apply replace() to every ElementFuture or SpeculativeFuture in a
+    (possibly nested) list, tuple or dict.
+    """
+    if isinstance(item, (ElementFuture, SpeculativeFuture)):
+        return replace(item)
+    if isinstance(item, (list, tuple)):
+        return type(item)(_replace_element_futures(i, replace) for i in item)
+    if isinstance(item, dict):
+        return {k: _replace_element_futures(v, replace) for k, v in item.items()}
+    return item
+
+
+def _staged_handles(item):
+    """
+    Returns the FileHandles with a staged copy in a (possibly nested) list
+    or tuple.
+    """
+    if isinstance(item, FileHandle):
+        return [item] if item.staging_path is not None else []
+    if isinstance(item, (list, tuple)):
+        return [h for i in item for h in _staged_handles(i)]
+    return []
+
+
+def _proxy_future(proxy):
+    """
+    Returns the Dask future behind an ElementFuture or SpeculativeFuture.
+    """
+    return proxy.future()
+
+
+def _proxy_result(proxy):
+    """
+    Returns the result of an ElementFuture or SpeculativeFuture.
+    """
+    return proxy.result()
 
 
 class Client(DaskClient):
@@ -22,7 +222,14 @@ class Client(DaskClient):
 
     def __init__(self, *args, **kwargs):
         self.filehandler = FileHandler(config.STAGE_POINT)
+        # the workers each directory of shared files is known to be visible on
+        self._visible = {}
         super().__init__(*args, **kwargs)
+        if not self.asynchronous:
+            self.register_plugin(iostats.IOStatsPlugin())
+            self.register_plugin(timings.TimingsPlugin())
+        if config.STAGE_POINT is not None and config.STAGING_GC:
+            staging.start_collector(config.STAGE_POINT)
 
     def upload(self, some_object):
         """
@@ -38,8 +245,96 @@ class Client(DaskClient):
             some_object = self.filehandler.load(some_object)
         except IOError:
             pass
+        self._check_references([some_object])
         return self.scatter(some_object, broadcast=True)
 
+    def _check_references(self, items):
+        """
+        Copy the content of any FileHandles among items that refer to files
+        on a shared filesystem (see config.SHARED_FILESYSTEM) in a directory
+        that some worker cannot see, so they work there too.
+        """
+        handles = []
+        for i in items:
+            handles.extend(i if isinstance(i, list) else [i])
+        references = [
+            h for h in handles if isinstance(h, FileHandle) and h.reference is not None
+        ]
+        # an asynchronous client cannot wait for the workers' answer here
+        if not references or self.asynchronous:
+            return
+        workers = set(self.nthreads())
+        directories = {op.dirname(h.reference) for h in references}
+        unknown = [d for d in directories if not workers <= self._visible.get(d, set())]
+        if unknown:
+            for worker, visible in self.run(visible_directories, unknown).items():
+                for directory, seen in zip(unknown, visible):
+                    if seen:
+                        self._visible.setdefault(directory, set()).add(worker)
+        for handle in references:
+            if not workers <= self._visible.get(op.dirname(handle.reference), set()):
+                handle.dereference()
+
+    def io_stats(self):
+        """
+        Collect the FileHandle I/O counters from this process and from
+        every worker, see crossflow.iostats.
+
+        returns:
+            dict: the counters for this process ("client"), for each worker
+                ("workers", keyed by address) and summed over the workers
+                ("cluster")
+        """
+        workers = self.run(iostats.snapshot)
+        return {
+            "client": iostats.snapshot(),
+            "workers": workers,
+            "cluster": iostats.aggregate(workers.values()),
+        }
+
+    def phase_summary(self, futures):
+        """
+        Summarize where the time went in the task runs behind some futures,
+        e.g. all those returned by one map(), see crossflow.timings.
+
+        args:
+            futures (list): futures (or lists or tuples of them) returned
+                by submit() or map()
+
+        returns:
+            dict: for each phase, the total, mean and max seconds and the
+                fraction of the total run time spent in it; the number of
+                "runs" found; and the number of futures "missing", whose
+                runs are no longer (or not yet) recorded
+        """
+        keys = set()
+
+        def collect(item):
+            if isinstance(item, ElementFuture):
+                keys.add(item.chunk.future.key)
+            elif isinstance(item, SpeculativeFuture):
+                if item.done():
+                    keys.add(item.race.final().key)
+                else:
+                    keys.update(f.key for f in item.race.futures)
+            elif isinstance(item, Future):
+                keys.add(getattr(item, "run_key", item.key))
+            elif isinstance(item, (list, tuple)):
+                for i in item:
+                    collect(i)
+            elif isinstance(item, dict):
+                for i in item.values():
+                    collect(i)
+
+        collect(futures)
+        found = {}
+        for profiles in self.run(timings.lookup, list(keys)).values():
+            for key, runs in profiles.items():
+                found.setdefault(key, []).extend(runs)
+        summary = timings.summarize(p for runs in found.values() for p in runs)
+        summary["missing"] = len(keys - set(found))
+        return summary
+
     def _rough_size(self, item):
         """
         Get the approximate size of an item, to decide if
@@ -88,87 +383,35 @@ class Client(DaskClient):
             return future
         outputs = []
         for i in range(len(task.outputs)):
-            outputs.append(self.submit(lambda tup, j: tup[j], future, i))
+            output = self.submit(lambda tup, j: tup[j], future, i)
+            # so phase_summary() can find the run behind each output
+            output.run_key = future.key
+            outputs.append(output)
         return tuple(outputs)
 
     def _filehandlify(self, args):
-        # pylint: disable=too-many-nested-blocks
-        # pylint: disable=too-many-branches
-        # pylint: disable=too-many-statements
         """
         work through an argument list, converting paths to filehandles
         where possible.
+
+        All the files are loaded in parallel, by FileHandler.load_many().
         """
-        if isinstance(args, Iterable):
-            newargs = []
-            for a in args:
-                if isinstance(a, list):
-                    newa = []
-                    for b in a:
-                        if isinstance(b, Iterable):
-                            if "?" in b or "*" in b:
-                                blist = glob.glob(b)
-                                blist.sort()
-                                if len(blist) > 0:
-                                    newb = []
-                                    for c in blist:
-                                        try:
-                                            c = self.filehandler.load(c)
-                                        except IOError:
-                                            pass
-                                        newb.append(c)
-                                else:
-                                    try:
-                                        newb = self.filehandler.load(b)
-                                    except IOError:
-                                        newb = b
-                            else:
-                                try:
-                                    newb = self.filehandler.load(b)
-                                except IOError:
-                                    newb = b
-                        else:
-                            try:
-                                newb = self.filehandler.load(b)
-                            except IOError:
-                                newb = b
-
-                        newa.append(newb)
-                else:
-                    if isinstance(a, Iterable):
-                        if "?" in a or "*" in a:
-                            alist = glob.glob(a)
-                            alist.sort()
-                            if len(alist) > 0:
-                                newa = []
-                                for c in alist:
-                                    try:
-                                        c = self.filehandler.load(c)
-                                    except IOError:
-                                        pass
-                                    newa.append(c)
-                            else:
-                                try:
-                                    newa = self.filehandler.load(a)
-                                except IOError:
-                                    newa = a
-                        else:
-                            try:
-                                newa = self.filehandler.load(a)
-                            except IOError:
-                                newa = a
-                    else:
-                        try:
-                            newa = self.filehandler.load(a)
-                        except IOError:
-                            newa = a
-                newargs.append(newa)
-        else:
-            newargs = args
-            try:
-                newargs = self.filehandler.load(newargs)
-            except IOError:
-                pass
+        if not isinstance(args, Iterable):
+            loaded = self.filehandler.load_many([args], ignore_errors=True)
+            self._check_references(loaded)
+            return loaded[0]
+        items = []
+        for a in args:
+            items.extend(a if isinstance(a, list) else [a])
+        loaded = self.filehandler.load_many(items, ignore_errors=True)
+        self._check_references(loaded)
+        loaded = iter(loaded)
+        newargs = []
+        for a in args:
+            if isinstance(a, list):
+                newargs.append([next(loaded) for _ in a])
+            else:
+                newargs.append(next(loaded))
         return newargs
 
     def submit(self, func, *args, **kwargs):
@@ -183,21 +426,74 @@ class Client(DaskClient):
         returns:
             future or tuple of futures
         """
+        args = _replace_element_futures(args, _proxy_future)
+        newargs = self._task_args(args)
+
+        if isinstance(func, _TASKS):  # pylint: disable=no-else-return
+            kwargs["pure"] = False
+            if func.resources:
+                kwargs.setdefault("resources", func.resources)
+            future = super().submit(_task_function(func), *newargs, **kwargs)
+            self._hold_inputs(future, newargs)
+            return self._unpack(func, future)
+        else:
+            return super().submit(func, *args, **kwargs)
+
+    def _hold_inputs(self, future, args):
+        """
+        Keep the staged FileHandles among the arguments of a task, and so
+        their leases (see crossflow.staging), alive until the task is done.
+        Until a worker loads them they exist only in the task's pickled
+        arguments, which lease nothing, so a task queued for longer than
+        config.STAGING_GRACE could otherwise lose its inputs.
+        """
+        handles = _staged_handles(args)
+        if handles:
+            future.add_done_callback(lambda _: handles.clear())
+
+    def _task_args(self, args):
+        """
+        Convert the arguments of a task to FileHandles where possible, and
+        upload any large ones.
+        """
         newargs = self._filehandlify(args)
         if isinstance(newargs, list):
             for i, arg in enumerate(newargs):
                 newargs[i] = self._futurize(arg)
         else:
             newargs = self._futurize(newargs)
+        return newargs
 
-        if isinstance(  # pylint: disable=no-else-return
-            func, (SubprocessTask, FunctionTask)
-        ):
-            kwargs["pure"] = False
-            future = super().submit(func.run, *newargs, **kwargs)
-            return self._unpack(func, future)
-        else:
-            return super().submit(func, *args, **kwargs)
+    def stream(self, task, *args, **kwargs):
+        """
+        Submit a SubprocessTask that publishes the files matching its
+        stream patterns (see SubprocessTask.set_stream()) as they are
+        completed, so work on them can start while it is still running,
+        see crossflow.streaming.
+
+        args:
+            task (SubprocessTask): the task to run
+            args (list): the task arguments
+            kwargs (dict): keyword arguments to submit()
+
+        returns:
+            OutputStream: yields a (name, future) pair for each file as it
+                is published; its outputs attribute holds the future (or
+                tuple of futures) for the outputs of the run
+        """
+        if not isinstance(task, SubprocessTask):
+            raise TypeError("Error - only SubprocessTasks can be streamed")
+        if not task.stream_patterns:
+            raise ValueError("Error - the task has no stream patterns")
+        args = _replace_element_futures(args, _proxy_future)
+        newargs = self._task_args(args)
+        kwargs["pure"] = False
+        if task.resources:
+            kwargs.setdefault("resources", task.resources)
+        queue = Queue(f"crossflow-stream-{uuid.uuid4().hex}", client=self)
+        future = super().submit(_run_streamed, task, queue.name, *newargs, **kwargs)
+        self._hold_inputs(future, newargs)
+        return streaming.OutputStream(queue, self._unpack(task, future), future)
 
     def _lt2tl(self, tuplist):
         """converts a list of tuples to a tuple of lists"""
@@ -206,18 +502,127 @@ class Client(DaskClient):
             result.append([t[i] for t in tuplist])
         return tuple(result)
 
-    def map(self, func, *iterables, **kwargs):
+    def _auto_chunksize(self, n_items):
+        """
+        Choose a chunk size that gives each worker thread about four
+        chunks.
+        """
+        n_threads = max(1, sum(self.nthreads().values()))
+        return max(1, math.ceil(n_items / (4 * n_threads)))
+
+    def _map_chunks(self, func, its, chunksize, kwargs):
+        """
+        Run func over the elements of its in chunks of chunksize elements
+        per Dask task, returning a future for each element (or a tuple of
+        futures, for a task with several outputs).
+        """
+        rows = list(zip(*its))
+        if chunksize == "auto":
+            chunksize = self._auto_chunksize(len(rows))
+        chunks = [rows[i : i + chunksize] for i in range(0, len(rows), chunksize)]
+        chunk_futures = super().map(
+            functools.partial(_run_chunk, func), chunks, **kwargs
+        )
+        n_outputs = len(getattr(func, "outputs", [None]))
+        result = []
+        for future, rows_in_chunk in zip(chunk_futures, chunks):
+            self._hold_inputs(future, rows_in_chunk)
+            chunk = _Chunk(future)
+            for i in range(len(rows_in_chunk)):
+                if n_outputs <= 1:
+                    result.append(ElementFuture(self, chunk, i))
+                else:
+                    result.append(
+                        tuple(
+                            ElementFuture(self, chunk, i, j) for j in range(n_outputs)
+                        )
+                    )
+        return result
+
+    def gather(self, futures, *args, **kwargs):
+        """
+        Wrapper round the dask gather() method that also accepts the
+        ElementFutures returned by a chunked map(), fetching each chunk
+        once, and the SpeculativeFutures returned by a speculative map().
+        """
+        chunks = {}
+
+        proxies = []
+
+        def collect(proxy):
+            proxies.append(proxy)
+            if isinstance(proxy, ElementFuture):
+                chunks[id(proxy.chunk)] = proxy.chunk
+            return proxy
+
+        _replace_element_futures(futures, collect)
+        if chunks:
+            chunk_list = list(chunks.values())
+            results = super().gather([c.future for c in chunk_list], *args, **kwargs)
+            for chunk, chunk_results in zip(chunk_list, results):
+                chunk.set_results(chunk_results)
+        if proxies:
+            futures = _replace_element_futures(futures, _proxy_result)
+        return super().gather(futures, *args, **kwargs)
+
+    def _map_speculative(self, func, its, factor, kwargs):
+        """
+        Submit func for each element of its, duplicating stragglers as
+        described in crossflow.speculation, and return a SpeculativeFuture
+        for each element (or a tuple of them, for a task with several
+        outputs).
+        """
+        # zero-argument super() does not work inside lambdas before 3.12
+        dask_submit = super().submit
+        races = [
+            _Race(functools.partial(dask_submit, _task_function(func), *row, **kwargs))
+            for row in zip(*its)
+        ]
+        Speculator(self, races, factor).start()
+        n_outputs = len(func.outputs)
+        if n_outputs <= 1:
+            return [SpeculativeFuture(self, race) for race in races]
+        return [
+            tuple(SpeculativeFuture(self, race, j) for j in range(n_outputs))
+            for race in races
+        ]
+
+    def map(  # pylint: disable=too-many-branches,too-many-locals
+        self, func, *iterables, chunksize=None, speculate=None, **kwargs
+    ):
         """
         Wrapper arounf the dask map() method so it returns lists of
         tuples of futures, rather than lists of futures.
 
+        With chunksize, elements are run in groups of that many per Dask
+        task, which cuts the scheduling overhead when each call is short.
+        Each element still gets its own future (or tuple of futures), but
+        an error in one element fails its whole chunk.
+
         args:
             func (function): the function to be mapped
             iterables (iterables): the function arguments
+            chunksize (int or str, optional): the number of elements to run
+                per Dask task, or "auto" to give each worker thread about
+                four chunks
+            speculate (float, optional): for a task, duplicate any element
+                still running after this many times the median run time
+                of the finished ones, and use whichever copy finishes
+                first, see crossflow.speculation
 
         returns:
             list or tuple of lists: futures returned by the mapped function
         """
+        if speculate is not None:
+            if chunksize is not None:
+                raise ValueError("Error - speculate cannot be used with chunksize")
+            if not isinstance(func, _TASKS):
+                raise TypeError("Error - speculate can only be used with tasks")
+            if speculate < 1:
+                raise ValueError(
+                    f"Error - speculate must be at least 1, not {speculate}"
+                )
+        iterables = _replace_element_futures(iterables, _proxy_future)
         its = []
         maxlen = 0
         for iterable in iterables:
@@ -230,17 +635,32 @@ class Client(DaskClient):
                 its.append([iterable] * maxlen)
 
         kwargs["pure"] = False
-        if isinstance(func, (SubprocessTask, FunctionTask)):
+        # zero-argument super() does not work inside comprehensions before 3.12
+        dask_submit = super().submit
+        if isinstance(func, _TASKS):
+            if func.resources:
+                kwargs.setdefault("resources", func.resources)
             newits = self._filehandlify(its)
             for i, arg in enumerate(newits):
                 newits[i] = self._futurize(arg)
 
-            # futures = super().map(func, *newits, **kwargs)
-            futures = [super().submit(func, *newit, **kwargs) for newit in zip(*newits)]
-            result = [self._unpack(func, future) for future in futures]
+            if chunksize is not None:
+                result = self._map_chunks(func, newits, chunksize, kwargs)
+            elif speculate is not None:
+                result = self._map_speculative(func, newits, speculate, kwargs)
+            else:
+                # futures = super().map(func, *newits, **kwargs)
+                run = _task_function(func)
+                futures = []
+                for newit in zip(*newits):
+                    futures.append(dask_submit(run, *newit, **kwargs))
+                    self._hold_inputs(futures[-1], newit)
+                result = [self._unpack(func, future) for future in futures]
+        elif chunksize is not None:
+            result = self._map_chunks(func, its, chunksize, kwargs)
         else:
             # result = super().map(func, *its, **kwargs)
-            result = [super().submit(func, *it, **kwargs) for it in zip(*its)]
+            result = [dask_submit(func, *it, **kwargs) for it in zip(*its)]
         if isinstance(result[0], tuple):
             result = self._lt2tl(result)
         return result
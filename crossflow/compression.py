@@ -0,0 +1,411 @@
+"""
+compression.py: pluggable compression codecs for FileHandle payloads.
+
+FileHandle payloads are stored as a sequence of independently compressed
+blocks. Each block starts with a small header recording the codec used,
+the raw length and the stored length, so blocks that do not compress can
+be stored as they are, and a payload can be decoded without knowing in
+advance how it was written. The headers also let build_index() locate
+every block without decompressing any, so BlockReader can serve random
+access reads by decompressing only the blocks they touch.
+
+Codecs are registered by name:
+
+    register_codec(Codec('mycodec', 42, my_compress, my_decompress))
+
+and are chosen per file by select_codec(), according to
+config.COMPRESSION.
+"""
+
+import bisect
+import bz2
+import io
+import os.path as op
+import struct
+import time
+import zlib
+
+from . import config
+
+_HEADER = struct.Struct(">BII")
+
+# Files at least this big are compressed with the fastest codec available.
+LARGE_FILE_SIZE = 64 * 1024 * 1024
+
+# The number of bytes compressed to estimate how compressible a file is.
+PROBE_SIZE = 64 * 1024
+
+# Blocks or probes that compress to more than this fraction of their raw
+# size are stored uncompressed.
+MAX_RATIO = 0.9
+
+
+class Codec:
+    """
+    A named compression codec.
+
+    args:
+        name (str): the name the codec is registered under
+        ident (int): a unique id in the range 0-255, written to block headers
+        compress (callable): bytes -> compressed bytes
+        decompress (callable): (compressed bytes, raw length) -> bytes
+
+    """
+
+    def __init__(self, name, ident, compress, decompress):
+        self.name = name
+        self.ident = ident
+        self._compress = compress
+        self._decompress = decompress
+
+    def __repr__(self):
+        return f"Codec({self.name!r})"
+
+    def compress(self, data):
+        """
+        Compress a block of data.
+
+        args:
+            data (bytes): the raw data
+
+        returns:
+            bytes: the compressed data
+        """
+        return self._compress(data)
+
+    def decompress(self, data, raw_length):
+        """
+        Decompress a block of data.
+
+        args:
+            data (bytes): the compressed data
+            raw_length (int): the length of the raw data
+
+        returns:
+            bytes: the raw data
+        """
+        return self._decompress(data, raw_length)
+
+
+_CODECS = {}
+_IDENTS = {}
+
+
+def register_codec(codec):
+    """
+    Make a codec available to FileHandles.
+
+    args:
+        codec (Codec): the codec to register
+    """
+    if codec.ident in _IDENTS and _IDENTS[codec.ident].name != codec.name:
+        raise ValueError(f"Error - codec id {codec.ident} is already in use")
+    _CODECS[codec.name] = codec
+    _IDENTS[codec.ident] = codec
+
+
+def available_codecs():
+    """
+    Returns the names of all registered codecs.
+    """
+    return list(_CODECS)
+
+
+def get_codec(name):
+    """
+    Return a registered codec.
+
+    args:
+        name (str or int): the codec name or id
+
+    returns:
+        Codec: the codec
+    """
+    codec = _IDENTS.get(name) if isinstance(name, int) else _CODECS.get(name)
+    if codec is None:
+        raise ValueError(
+            f"Error - unknown or unavailable codec {name}; "
+            f"available codecs are {available_codecs()}"
+        )
+    return codec
+
+
+register_codec(Codec("none", 0, bytes, lambda data, n: bytes(data)))
+register_codec(
+    Codec(
+        "zlib", 1, lambda data: zlib.compress(data, 6), lambda d, n: zlib.decompress(d)
+    )
+)
+register_codec(
+    Codec("bz2", 2, lambda data: bz2.compress(data, 9), lambda d, n: bz2.decompress(d))
+)
+
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+    register_codec(
+        Codec(
+            "zstd",
+            3,
+            lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+            lambda d, n: zstandard.ZstdDecompressor().decompress(d, max_output_size=n),
+        )
+    )
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    register_codec(
+        Codec("lz4", 4, lz4.frame.compress, lambda d, n: lz4.frame.decompress(d))
+    )
+
+
+def _first_available(names):
+    """
+    Returns the first of names that is a registered codec.
+    """
+    for name in names:
+        if name in _CODECS:
+            return _CODECS[name]
+    return _CODECS["zlib"]
+
+
+def select_codec(path=None, sample=b"", size=None):
+    """
+    Choose a codec for a file.
+
+    If config.COMPRESSION names a codec, that codec is used. If it is
+    "auto", files with an extension in config.INCOMPRESSIBLE_EXTENSIONS,
+    or whose first bytes do not compress, are not compressed; large files
+    use the fastest codec available and others the best all-rounder.
+
+    args:
+        path (str, optional): the file path, used for its extension
+        sample (bytes, optional): the first bytes of the file
+        size (int, optional): the file size, if known
+
+    returns:
+        Codec: the codec
+    """
+    if config.COMPRESSION != "auto":
+        return get_codec(config.COMPRESSION)
+    if path is not None:
+        ext = op.splitext(str(path))[1].lower()
+        if ext in config.INCOMPRESSIBLE_EXTENSIONS:
+            return _CODECS["none"]
+    if sample:
+        probe = sample[:PROBE_SIZE]
+        if len(zlib.compress(probe, 1)) > MAX_RATIO * len(probe):
+            return _CODECS["none"]
+    if size is not None and size >= LARGE_FILE_SIZE:
+        return _first_available(["lz4", "zstd", "zlib"])
+    return _first_available(["zstd", "zlib"])
+
+
+def write_block(sink, codec, data):
+    """
+    Compress a block of data and write it, with its header, to sink.
+
+    Blocks that do not compress are written uncompressed.
+
+    args:
+        sink (file-like): a binary file-like object to write to
+        codec (Codec): the codec to use
+        data (bytes): the raw data
+
+    returns:
+        int: the number of bytes written
+    """
+    stored = codec.compress(data)
+    if codec.ident != 0 and len(stored) > MAX_RATIO * len(data):
+        codec = _CODECS["none"]
+        stored = data
+    sink.write(_HEADER.pack(codec.ident, len(data), len(stored)))
+    sink.write(stored)
+    return _HEADER.size + len(stored)
+
+
+class _BufferReader:
+    """
+    A minimal read-only file-like view of a bytes-like object, which unlike
+    io.BytesIO never copies the whole buffer.
+    """
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast("B")
+        self._pos = 0
+
+    def read(self, size):
+        """
+        Read up to size bytes.
+        """
+        data = self._view[self._pos : self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def seek(self, pos):
+        """
+        Move to an absolute position.
+        """
+        self._pos = pos
+
+    def close(self):
+        """
+        Nothing to release.
+        """
+
+
+def iter_blocks(source):
+    """
+    Yield the decompressed blocks of a payload.
+
+    args:
+        source (file-like or bytes-like): the payload, or a binary file-like
+            object positioned at the start of a block
+
+    yields:
+        bytes: the raw data of each block
+    """
+    if not hasattr(source, "read"):
+        source = _BufferReader(source)
+    while True:
+        header = source.read(_HEADER.size)
+        if not header:
+            return
+        if len(header) < _HEADER.size:
+            raise IOError("Error - truncated FileHandle payload")
+        ident, raw_length, stored_length = _HEADER.unpack(header)
+        stored = source.read(stored_length)
+        if len(stored) < stored_length:
+            raise IOError("Error - truncated FileHandle payload")
+        yield get_codec(ident).decompress(stored, raw_length)
+
+
+def build_index(source):
+    """
+    Index the blocks of a payload from their headers, without
+    decompressing them.
+
+    args:
+        source (file-like or bytes-like): the payload, or a seekable binary
+            file-like object positioned at its start
+
+    returns:
+        list: (raw offset, raw length, stored offset, stored length, codec id)
+            for each block
+    """
+    if not hasattr(source, "read"):
+        source = _BufferReader(source)
+    index = []
+    raw_offset = 0
+    stored_offset = 0
+    while True:
+        header = source.read(_HEADER.size)
+        if not header:
+            return index
+        if len(header) < _HEADER.size:
+            raise IOError("Error - truncated FileHandle payload")
+        ident, raw_length, stored_length = _HEADER.unpack(header)
+        stored_offset += _HEADER.size
+        index.append((raw_offset, raw_length, stored_offset, stored_length, ident))
+        raw_offset += raw_length
+        stored_offset += stored_length
+        source.seek(stored_offset)
+
+
+class BlockReader(io.RawIOBase):  # pylint: disable=too-many-instance-attributes
+    """
+    A seekable, read-only raw stream over a block-compressed payload.
+
+    Reads only decompress the blocks they touch, and the most recently
+    decompressed block is kept, so sequential small reads decompress each
+    block once.
+
+    args:
+        source (file-like or bytes-like): the payload, or a seekable binary
+            file-like object
+        index (list, optional): the block index from build_index(), built
+            here if not given
+        close_source (bool, optional): close source when the reader is closed
+        stats (IOStats, optional): where to record decompression time
+
+    """
+
+    def __init__(self, source, index=None, close_source=False, stats=None):
+        super().__init__()
+        self._stats = stats
+        if not hasattr(source, "read"):
+            source = _BufferReader(source)
+        self._source = source
+        self._close_source = close_source
+        if index is None:
+            source.seek(0)
+            index = build_index(source)
+        self._index = index
+        self._starts = [block[0] for block in index]
+        self._size = index[-1][0] + index[-1][1] if index else 0
+        self._pos = 0
+        self._block = None
+        self._data = b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError(f"Error - invalid whence {whence}")
+        if pos < 0:
+            raise ValueError(f"Error - negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def _load(self, block):
+        """
+        Decompress a block, unless it is the current one.
+        """
+        if block != self._block:
+            _, raw_length, stored_offset, stored_length, ident = self._index[block]
+            self._source.seek(stored_offset)
+            stored = self._source.read(stored_length)
+            if len(stored) < stored_length:
+                raise IOError("Error - truncated FileHandle payload")
+            start = time.perf_counter()
+            self._data = get_codec(ident).decompress(stored, raw_length)
+            if self._stats is not None:
+                self._stats.add(decompress_seconds=time.perf_counter() - start)
+            self._block = block
+        return self._data
+
+    def readinto(self, buffer):
+        if self._pos >= self._size:
+            return 0
+        block = bisect.bisect_right(self._starts, self._pos) - 1
+        data = self._load(block)
+        start = self._pos - self._starts[block]
+        view = memoryview(buffer).cast("B")
+        n = min(len(view), len(data) - start)
+        view[:n] = data[start : start + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed and self._close_source:
+            self._source.close()
+        self._data = b""
+        super().close()
@@ -3,3 +3,163 @@ config.py: Allow configurable options.
 """
 
 STAGE_POINT = None
+
+# Files are streamed through FileHandles in chunks of this many bytes, so
+# this bounds the raw data held in memory at any one time.
+BUFFER_SIZE = 16 * 1024 * 1024
+
+# Payloads are compressed in independent blocks of this many raw bytes, so
+# a random-access read only decompresses the blocks it touches.
+BLOCK_SIZE = 1024 * 1024
+
+# The codec used to compress FileHandle payloads: "auto" chooses one per
+# file, or give the name of any codec in crossflow.compression, e.g. "none",
+# "zlib", "bz2", "zstd" or "lz4".
+COMPRESSION = "auto"
+
+# Files with these extensions are already compressed, so in "auto" mode
+# they are stored as they are.
+INCOMPRESSIBLE_EXTENSIONS = {
+    ".bz2",
+    ".gz",
+    ".h5",
+    ".jpg",
+    ".lz4",
+    ".nc",
+    ".png",
+    ".tng",
+    ".xtc",
+    ".xz",
+    ".zip",
+    ".zst",
+}
+
+# Each worker process keeps a cache of decompressed FileHandle content in a
+# directory under CACHE_DIR (None means the system temporary directory),
+# evicting the least recently used files once it holds CACHE_SIZE bytes.
+CACHE_DIR = None
+CACHE_SIZE = 4 * 1024**3
+
+# How cached files are placed into task directories: "auto" tries
+# "reflink", then "copy". "hardlink" saves the copy, but the placed files
+# are then read-only and shared with the cache, so only use it if no task
+# modifies its input files.
+LINK_MODE = "auto"
+
+# Reference mode: if the client and the workers share a filesystem, files
+# on it can be passed to workers as just a path and a (size, mtime) stamp,
+# and only read when a worker uses them. SHARED_FILESYSTEM may be False
+# (never), True (every local file) or "auto" (files under one of
+# SHARED_PATHS, or on a filesystem of one of SHARED_FS_TYPES). Files that do
+# not qualify are copied as usual. With HASH_SHARED_FILES the stamp also
+# includes a content hash, which costs a full read when the file is loaded.
+SHARED_FILESYSTEM = False
+SHARED_PATHS = []
+SHARED_FS_TYPES = {"beegfs", "cephfs", "gpfs", "lustre", "nfs", "nfs4", "panfs"}
+HASH_SHARED_FILES = False
+
+# The number of threads FileHandler.load_many() uses to read and compress
+# files, and SubprocessTask uses to stage its input files; None means one
+# per CPU core.
+LOAD_THREADS = None
+
+# Garbage collection at the stage point: each process lists the staged
+# files it still uses in a lease file, refreshed every STAGING_HEARTBEAT
+# seconds. If STAGING_GC is True, a Client with a stage point runs a
+# collector every STAGING_GC_INTERVAL seconds that deletes staged files no
+# live lease refers to once they are STAGING_GRACE seconds old. Only files
+# named as crossflow names them are ever deleted.
+STAGING_GC = False
+STAGING_GC_INTERVAL = 60
+STAGING_GRACE = 600
+STAGING_HEARTBEAT = 30
+
+# The maximum number of bytes to keep at the stage point, or None for no
+# limit. New uploads wait, for up to STAGING_TIMEOUT seconds, while the
+# stage point is over quota.
+STAGING_QUOTA = None
+STAGING_TIMEOUT = 600
+
+# Files loaded from http(s) URLs are cached under URL_CACHE_DIR (None means
+# a directory in the system temporary directory), up to URL_CACHE_SIZE
+# bytes. A cached copy checked with the server less than URL_MAX_AGE
+# seconds ago is used without asking again. URL_TIMEOUT is the network
+# timeout, in seconds.
+URL_CACHE_DIR = None
+URL_CACHE_SIZE = 1024**3
+URL_MAX_AGE = 0
+URL_TIMEOUT = 60
+
+# SubprocessTasks with caching turned on store their results under
+# RESULT_CACHE_DIR (None means ~/.cache/crossflow/results), up to
+# RESULT_CACHE_SIZE bytes. RESULT_CACHE_JOURNAL is the SQLite journal mode
+# of the cache index: "auto" uses "WAL", which is faster, unless the cache
+# is on a filesystem of one of SHARED_FS_TYPES (e.g. NFS or Lustre), where
+# WAL is not safe and "DELETE" (a rollback journal) is used instead.
+RESULT_CACHE_DIR = None
+RESULT_CACHE_SIZE = 10 * 1024**3
+RESULT_CACHE_JOURNAL = "auto"
+
+# Where tasks run: in SCRATCH_SHM (a RAM-backed filesystem, e.g.
+# "/dev/shm") if their input files total less than SCRATCH_SHM_SIZE bytes,
+# in SCRATCH_LARGE (e.g. a node-local SSD) if they total at least
+# SCRATCH_LARGE_SIZE bytes, and otherwise in SCRATCH_ROOT (None means the
+# system temporary directory). SCRATCH_SHM and SCRATCH_LARGE are off (None)
+# by default; small inputs do not mean small outputs, so only use
+# SCRATCH_SHM for tasks that write little.
+SCRATCH_ROOT = None
+SCRATCH_SHM = None
+SCRATCH_SHM_SIZE = 64 * 1024 * 1024
+SCRATCH_LARGE = None
+SCRATCH_LARGE_SIZE = 1024**3
+
+# The number of empty task working directories each process keeps ready
+# for reuse in each scratch root.
+SANDBOX_POOL_SIZE = 8
+
+# The standard output and error of a SubprocessTask are each held in
+# memory up to CAPTURE_SIZE bytes, and spilled to a file beyond that. If
+# STDERR_TAIL is not None, only the last STDERR_TAIL kilobytes of standard
+# error are kept.
+CAPTURE_SIZE = 1024 * 1024
+STDERR_TAIL = None
+
+# A SubprocessTask that declares how many cores it needs runs with these
+# environment variables set to that number and, if PIN_THREADS is True,
+# pinned to that many cores no other task on the node is using.
+PIN_THREADS = True
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+
+# How often, in seconds, a running SubprocessTask checks whether it has
+# been cancelled (e.g. because a speculative copy finished first).
+CANCEL_POLL_INTERVAL = 1.0
+
+# Speculative execution in Client.map(..., speculate=factor): once this
+# fraction of the tasks have finished, tasks running for longer than factor
+# times their median run time are duplicated. Progress is checked every
+# SPECULATION_INTERVAL seconds.
+SPECULATION_QUORUM = 0.5
+SPECULATION_INTERVAL = 1.0
+
+# FunctionTasks with the "process" executor run in a pool of this many
+# processes per worker (None for one per usable core). Argument and result
+# buffers of at least SHARED_MEMORY_THRESHOLD bytes go through shared
+# memory, and up to FUNCTION_POOL_STAGED input files are kept staged.
+FUNCTION_PROCESSES = None
+SHARED_MEMORY_THRESHOLD = 64 * 1024
+FUNCTION_POOL_STAGED = 256
+
+# The number of Dask task keys each process keeps the phase timings of
+# runs for, see crossflow.timings.
+TIMINGS_HISTORY = 10000
+
+# A SubprocessTask run with Client.stream() checks its working directory
+# for files matching its stream patterns every STREAM_INTERVAL seconds, and
+# publishes a file once it has been unchanged for STREAM_SETTLE seconds
+# (or a later file matching the same pattern appears).
+STREAM_INTERVAL = 2.0
+STREAM_SETTLE = 10.0
+
+# A ServerTask waits up to SERVER_STARTUP_TIMEOUT seconds for a new server
+# process to become ready, see crossflow.servers.
+SERVER_STARTUP_TIMEOUT = 60
@@ -1,3 +1,4 @@
+# pylint: disable=too-many-lines
 """
 filehanding.py: this module provides classes for passing files between
 processes on distributed computing platforms that may not share a common
@@ -22,15 +23,27 @@ be used e.g.
         ...
 """
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import glob
+import hashlib
+import io
+import itertools
 import os
 import os.path as op
+import pickle
+import shutil
 import tempfile
+import threading
+import time
 import uuid
-import zlib
+import weakref
 
+from distributed.protocol import dask_deserialize, dask_serialize
 import fsspec
 
-from . import config
+from . import compression, config, iostats, singleton, staging, urlcache
 
 
 def set_stage_point(stage_point):
@@ -41,6 +54,410 @@ def set_stage_point(stage_point):
     config.STAGE_POINT = stage_point
 
 
+def _is_url(path):
+    """
+    Returns True if path looks like a URL that fsspec should fetch.
+    """
+    return isinstance(path, str) and (
+        path.startswith("http://")
+        or path.startswith("https://")
+        or path.startswith("ftp://")
+    )
+
+
+def _file_stamp(path):
+    """
+    Returns a (path, size, mtime) tuple identifying the current version of
+    a local file, or None if path is not a local file.
+    """
+    if _is_url(path):
+        return None
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError, ValueError):
+        return None
+    return (op.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def _iter_chunks(source):
+    """
+    Yield successive chunks of at most config.BUFFER_SIZE bytes from a
+    binary file-like object.
+    """
+    while True:
+        chunk = source.read(config.BUFFER_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _hash_file(path):
+    """
+    Returns the SHA-256 hex digest of a local file.
+    """
+    hasher = hashlib.sha256()
+    with open(path, "rb") as s:
+        for chunk in _iter_chunks(s):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def _mounts():
+    """
+    Returns (mountpoint, fstype) pairs for this machine, longest first.
+    """
+    try:
+        import psutil  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return []
+    partitions = psutil.disk_partitions(all=True)
+    mounts = [(p.mountpoint, p.fstype.lower()) for p in partitions]
+    return sorted(mounts, key=lambda m: len(m[0]), reverse=True)
+
+
+def filesystem_type(path):
+    """
+    Returns the type of the filesystem a local path is on (e.g. "nfs"), or
+    None if it cannot be told.
+    """
+    path = op.realpath(path)
+    for mountpoint, fstype in _mounts():
+        if path == mountpoint or path.startswith(mountpoint.rstrip(os.sep) + os.sep):
+            return fstype
+    return None
+
+
+def _on_shared_filesystem(path):
+    """
+    Decide whether a local file should be passed to workers by reference,
+    according to config.SHARED_FILESYSTEM.
+    """
+    setting = config.SHARED_FILESYSTEM
+    if setting is True:
+        return True
+    if setting != "auto":
+        return False
+    path = op.realpath(path)
+    for prefix in config.SHARED_PATHS:
+        prefix = op.realpath(prefix)
+        if path == prefix or path.startswith(prefix.rstrip(os.sep) + os.sep):
+            return True
+    return filesystem_type(path) in config.SHARED_FS_TYPES
+
+
+def visible_directories(directories):
+    """
+    Returns, for each of a list of directories, whether it exists here; run
+    on the workers to check they can see the files passed by reference.
+    """
+    return [op.isdir(d) for d in directories]
+
+
+def _touch(fs, path):
+    """
+    Update the modification time of an existing staged file, where the
+    filesystem allows, so the garbage collector sees it as recently used.
+    """
+    try:
+        fs.touch(path, truncate=False)
+    except (NotImplementedError, ValueError, OSError):
+        pass
+
+
+class ContentStore:
+    """
+    A process-wide, reference-counted registry of FileHandle payloads.
+
+    Payloads are keyed by the FileHandle uid, which is derived from a hash
+    of the file content, so identical files share a single compressed copy
+    however many times they are loaded or unpickled. The store also
+    remembers the digest of recently loaded local files, so re-loading an
+    unchanged file does not need to read it again.
+
+    """
+
+    def __init__(self, max_stamps=10000):
+        self._lock = threading.Lock()
+        self._payloads = {}
+        self._refcounts = {}
+        self._stamps = OrderedDict()
+        self.max_stamps = max_stamps
+
+    def lookup(self, stamp):
+        """
+        Return the uid previously recorded for a file stamp, if any.
+
+        args:
+            stamp (tuple): as returned by _file_stamp()
+
+        returns:
+            str or None: the uid
+        """
+        if stamp is None:
+            return None
+        with self._lock:
+            uid = self._stamps.get(stamp)
+            if uid is not None:
+                self._stamps.move_to_end(stamp)
+            return uid
+
+    def remember(self, stamp, uid):
+        """
+        Record the uid for a file stamp.
+
+        args:
+            stamp (tuple): as returned by _file_stamp()
+            uid (str): the content-derived uid
+        """
+        if stamp is None:
+            return
+        with self._lock:
+            self._stamps[stamp] = uid
+            self._stamps.move_to_end(stamp)
+            while len(self._stamps) > self.max_stamps:
+                self._stamps.popitem(last=False)
+
+    def get(self, uid):
+        """
+        Return the payload registered for uid, or None.
+        """
+        with self._lock:
+            return self._payloads.get(uid)
+
+    def acquire(self, uid, payload=None):
+        """
+        Register a new reference to uid.
+
+        args:
+            uid (str): the content-derived uid
+            payload (bytes, optional): the payload to share, used only if
+                no payload is registered for uid yet
+
+        returns:
+            bytes or None: the shared payload for uid
+        """
+        with self._lock:
+            self._refcounts[uid] = self._refcounts.get(uid, 0) + 1
+            if payload is not None:
+                payload = self._payloads.setdefault(uid, payload)
+            return payload
+
+    def release(self, uid):
+        """
+        Drop a reference to uid.
+
+        args:
+            uid (str): the content-derived uid
+
+        returns:
+            bool: True if that was the last reference
+        """
+        with self._lock:
+            count = self._refcounts.get(uid, 0) - 1
+            if count > 0:
+                self._refcounts[uid] = count
+                return False
+            self._refcounts.pop(uid, None)
+            self._payloads.pop(uid, None)
+            return True
+
+    def refcount(self, uid):
+        """
+        Return the number of live references to uid.
+        """
+        with self._lock:
+            return self._refcounts.get(uid, 0)
+
+
+_STORE = ContentStore()
+
+_FICLONE = 0x40049409
+
+
+def _reflink(src, dest):
+    """
+    Make dest a copy-on-write clone of src, where the filesystem supports it.
+    """
+    import fcntl  # pylint: disable=import-outside-toplevel
+
+    with open(src, "rb") as s:
+        with open(dest, "wb") as d:
+            try:
+                fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+            except OSError:
+                d.close()
+                os.remove(dest)
+                raise
+
+
+def link_or_copy(src, dest, mode=None):
+    """
+    Place a copy of src at dest by reflink, hardlink or copy, according to
+    mode (config.LINK_MODE by default). Only "hardlink" mode makes dest a
+    hardlink, so in any other mode dest can be changed without changing src.
+    """
+    if op.lexists(dest):
+        os.remove(dest)
+    if mode is None:
+        mode = config.LINK_MODE
+    if mode in ("auto", "reflink"):
+        try:
+            _reflink(src, dest)
+            return
+        except (ImportError, OSError):
+            if mode == "reflink":
+                raise
+    if mode == "hardlink":
+        os.link(src, dest)
+        return
+    shutil.copyfile(src, dest)
+
+
+def _stat_stamp(path):
+    """
+    Returns (size, mtime) for path, or None if it does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+class MaterializationCache:
+    """
+    A per-process, size-capped LRU cache of materialized FileHandle content.
+
+    Each unique payload is decompressed into the cache directory once, and
+    place() then puts it into task directories by reflink where the
+    filesystem allows, falling back to a copy, so each task gets a private,
+    writable file (see config.LINK_MODE). On POSIX systems cached files are
+    read-only, and a cached file that is found to have been modified is
+    materialized again.
+
+    """
+
+    def __init__(self, directory=None, max_size=None):
+        if directory is None:
+            directory = config.CACHE_DIR
+        self.directory = tempfile.mkdtemp(prefix="crossflow-cache-", dir=directory)
+        self.max_size = config.CACHE_SIZE if max_size is None else max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.directory, True)
+
+    def __contains__(self, uid):
+        with self._lock:
+            return uid in self._entries
+
+    def get(self, handle):
+        """
+        Return the path of a cached copy of a FileHandle's content,
+        materializing it if needed.
+
+        args:
+            handle (FileHandle): the handle
+
+        returns:
+            str or None: the path, or None if the content is too big to cache
+        """
+        if handle.digest is None and handle.reference is None:
+            return None
+        uid = handle.uid
+        path = op.join(self.directory, uid)
+        with self._lock:
+            stamp = self._entries.get(uid)
+            if stamp is not None:
+                if _stat_stamp(path) == stamp:
+                    self._entries.move_to_end(uid)
+                    handle.stats.add(cache_hits=1)
+                    return path
+                self._forget(uid)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+        handle.save(tmp_path)
+        size = op.getsize(tmp_path)
+        if size > self.max_size:
+            os.remove(tmp_path)
+            return None
+        if os.name != "nt":
+            os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._forget(uid, remove=False)
+            self._entries[uid] = _stat_stamp(path)
+            self.size += size
+            self._evict()
+        return path
+
+    def place(self, handle, dest):
+        """
+        Put a copy of a FileHandle's content at dest.
+
+        args:
+            handle (FileHandle): the handle
+            dest (str): the destination path
+
+        returns:
+            str: the destination path
+        """
+        start = time.perf_counter()
+        src = self.get(handle)
+        try:
+            if src is not None:
+                try:
+                    link_or_copy(src, dest)
+                    return dest
+                except FileNotFoundError:  # evicted by another thread
+                    pass
+            return handle.save(dest)
+        finally:
+            handle.stats.add(
+                materializations=1, materialize_seconds=time.perf_counter() - start
+            )
+
+    def clear(self):
+        """
+        Remove everything from the cache.
+        """
+        with self._lock:
+            for uid in list(self._entries):
+                self._forget(uid)
+
+    def _forget(self, uid, remove=True):
+        """
+        Drop an entry; the caller must hold the lock.
+        """
+        stamp = self._entries.pop(uid, None)
+        if stamp is None:
+            return
+        self.size -= stamp[0]
+        if remove:
+            try:
+                os.remove(op.join(self.directory, uid))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        """
+        Drop least recently used entries until the cache fits in max_size;
+        the caller must hold the lock.
+        """
+        while self.size > self.max_size and self._entries:
+            self._forget(next(iter(self._entries)))
+
+
+_CACHE = singleton.PerProcess(MaterializationCache)
+
+
+def get_cache():
+    """
+    Returns the MaterializationCache for this process, creating it if needed.
+    """
+    return _CACHE.get()
+
+
 class FileHandler:
     """
     Handle file operations
@@ -52,20 +469,96 @@ class FileHandler:
             self.stage_point = config.STAGE_POINT
         else:
             self.stage_point = stage_point
+        self._stats = iostats.IOStats(parent=iostats.TOTALS)
+
+    def stats(self):
+        """
+        Returns the I/O counters for the FileHandles created by this
+        FileHandler, see crossflow.iostats.
+
+        returns:
+            dict: the value of each counter
+        """
+        return self._stats.snapshot()
 
-    def load(self, path):
+    def load(self, path, copy=False):
         """
         Method to load file.
 
         args:
             path (str): file path or URL
+            copy (bool): if True, copy the content even of a file on a
+                shared filesystem, e.g. one in a task's working directory
+                that is about to be removed
 
         returns:
             FileHandle: a FileHandle object
 
         """
 
-        return FileHandle(path, self.stage_point, must_exist=True)
+        return FileHandle(
+            path, self.stage_point, must_exist=True, stats=self._stats, copy=copy
+        )
+
+    def load_many(self, paths, ignore_errors=False, copy=False):
+        """
+        Method to load many files in parallel.
+
+        Files are read and compressed on a pool of config.LOAD_THREADS
+        threads. Glob patterns that match any files are expanded, in sorted
+        order, to a list of FileHandles; FileHandles are passed through
+        unchanged.
+
+        args:
+            paths (list): file paths, URLs or glob patterns
+            ignore_errors (bool): if True, items that cannot be loaded are
+                returned unchanged, rather than raising an IOError
+            copy (bool): as for load()
+
+        returns:
+            list: a FileHandle (or list of FileHandles, for a glob pattern)
+                for each item in paths, in the same order
+
+        """
+
+        def expand(item):
+            if isinstance(item, str) and ("*" in item or "?" in item):
+                matches = sorted(glob.glob(item))
+                if matches:
+                    return matches
+            return None
+
+        expanded = [expand(item) for item in paths]
+        flat = []
+        for item, matches in zip(paths, expanded):
+            flat.extend([item] if matches is None else matches)
+
+        def is_path(item):
+            return isinstance(item, (str, os.PathLike)) and not isinstance(
+                item, FileHandle
+            )
+
+        def load(item):
+            if isinstance(item, FileHandle):
+                return item
+            try:
+                return self.load(item, copy)
+            except IOError:
+                if ignore_errors:
+                    return item
+                raise
+
+        # Each distinct path is only loaded once, however often it appears.
+        unique = {os.fspath(item): item for item in flat if is_path(item)}
+        with ThreadPoolExecutor(max_workers=config.LOAD_THREADS) as pool:
+            handles = dict(zip(unique, pool.map(load, unique.values())))
+        loaded = iter(
+            [handles[os.fspath(item)] if is_path(item) else load(item) for item in flat]
+        )
+        return [
+            next(loaded) if matches is None else [next(loaded) for _ in matches]
+            for matches in expanded
+        ]
 
     def create(self, path):
         """
@@ -79,10 +572,10 @@ class FileHandler:
 
         """
 
-        return FileHandle(path, self.stage_point, must_exist=False)
+        return FileHandle(path, self.stage_point, must_exist=False, stats=self._stats)
 
 
-class FileHandle:
+class FileHandle:  # pylint: disable=too-many-instance-attributes
     """
     A portable container for a file.
 
@@ -110,55 +603,324 @@ class FileHandle:
         fh.write_binary(data)
         fh.write_text(text)
 
+    The size attribute is the size of the file in bytes.
+
+    Payloads are compressed with a codec chosen per file, see
+    crossflow.compression.
+
+    Files on a filesystem that all workers share can instead be passed by
+    reference, see config.SHARED_FILESYSTEM: the handle then carries just
+    the path and a stamp used to check the file has not changed. With
+    copy=True the content is copied regardless.
+
+    FileHandles are content-addressed: the uid is a hash of the file
+    content, and handles with the same content share one payload in
+    memory and one copy at the stage point. The local copy that str()
+    returns belongs to the handle, and is removed with it.
+
     """
 
-    def __init__(self, path, stage_point, must_exist=True):
+    def __init__(
+        self, path, stage_point, must_exist=True, stats=None, copy=False
+    ):  # pylint: disable=too-many-arguments,too-many-positional-arguments
         if not isinstance(path, (os.PathLike, str, bytes)):
             raise IOError(f"Error - illegal argument type {type(path)} for {path}")
+        self.path = path
+        self.ext = os.path.splitext(path)[1]
+        self.stage_point = stage_point
+        self.staging_path = None
+        self.local_path = None
+        self.digest = None
+        self.codec = None
+        self.store = None
+        self.reference = None
+        self.ref_stamp = None
+        self.index = None
+        self.size = None
+        self.stats = iostats.IOStats(parent=iostats.TOTALS if stats is None else stats)
         if must_exist:
-            if isinstance(path, str) and (
-                path.startswith("http://")
-                or path.startswith("https://")
-                or path.startswith("ftp://")
-            ):
-                try:
-                    source = fsspec.open(path)
-                    with source as s:
-                        s.read(1)
-                except Exception as e:
-                    raise IOError("Error - no such file") from e
+            if _is_url(path):
+                if not urlcache.is_http(path):
+                    try:
+                        with fsspec.open(path) as s:
+                            self._set_content(s)
+                    except Exception as e:
+                        raise IOError("Error - no such file") from e
+                    return
+                source_path = urlcache.get_url_cache().fetch(path)
             else:
                 if not os.path.exists(path):
                     raise IOError("Error - no such file")
-            source = fsspec.open(path)
-            ext = os.path.splitext(path)[1]
-            self.path = path
-            self.uid = str(uuid.uuid4()) + ext
-            self.local_path = None
-            if stage_point is None:
-                self.staging_path = None
-                with source as s:
-                    self.store = zlib.compress(s.read())
-            else:
-                self.staging_path = op.join(stage_point, self.uid)
-                self.store = fsspec.open(self.staging_path, "wb", compression="bz2")
-                with source as s:
-                    with self.store as d:
-                        d.write(s.read())
-                source.close()  # pylint: disable=no-member
-                self.store.close()
-                self.store.mode = "rb"
+                if not copy and _on_shared_filesystem(path):
+                    self._set_reference(path)
+                    return
+                source_path = path
+            stamp = _file_stamp(source_path)
+            uid = _STORE.lookup(stamp)
+            if uid is not None and self._attach(uid):
+                self.size = stamp[1]
+                self.stats.add(reuses=1)
+                return
+            with fsspec.open(source_path) as s:
+                self._set_content(s, None if stamp is None else stamp[1])
+            _STORE.remember(stamp, self.uid)
         else:
             if os.path.exists(path):
                 raise IOError("Error - file already exists")
-            ext = os.path.splitext(path)[1]
-            self.uid = str(uuid.uuid4()) + ext
-            self.local_path = None
-            if stage_point is None:
-                self.staging_path = None
+            self.uid = str(uuid.uuid4()) + self.ext
+
+    def _attach(self, uid):
+        """
+        Try to attach this handle to an already-registered payload.
+
+        returns:
+            bool: True if the payload was available without reading the file
+        """
+        digest = uid[: len(uid) - len(self.ext)] if self.ext else uid
+        if self.stage_point is None:
+            payload = _STORE.get(uid)
+            if payload is None:
+                return False
+        else:
+            staging_path = op.join(self.stage_point, uid)
+            fs, _, _ = fsspec.core.get_fs_token_paths(staging_path)
+            if not fs.exists(staging_path):
+                return False
+            _touch(fs, staging_path)
+            self.staging_path = staging_path
+            self.store = fsspec.open(staging_path, "rb")
+            payload = None
+        self.digest = digest
+        self.uid = uid
+        payload = self._acquire(payload)
+        if self.staging_path is None:
+            self.store = payload
+        return True
+
+    def _set_content(self, source, size=None):
+        """
+        Stream the content of the handle from a binary file-like object,
+        sharing any existing payload.
+
+        Only config.BUFFER_SIZE bytes of raw data are held at a time.
+
+        args:
+            source (file-like): the raw file content
+            size (int, optional): the size of the content, if known
+        """
+        self._release()
+        self.reference = None
+        self.ref_stamp = None
+        self.index = None
+        hasher = hashlib.sha256()
+        chunks = _iter_chunks(source)
+        first = next(chunks, b"")
+        codec = compression.select_codec(self.path, first, size)
+        self.codec = codec.name
+
+        def encode(sink):
+            raw = 0
+            written = 0
+            elapsed = 0.0
+            block_size = config.BLOCK_SIZE
+            for chunk in itertools.chain([first], chunks):
+                hasher.update(chunk)
+                raw += len(chunk)
+                view = memoryview(chunk)
+                for start in range(0, len(view), block_size):
+                    block = view[start : start + block_size]
+                    t = time.perf_counter()
+                    written += compression.write_block(sink, codec, block)
+                    elapsed += time.perf_counter() - t
+            self.size = raw
+            self.stats.add(
+                loads=1, raw_bytes=raw, stored_bytes=written, compress_seconds=elapsed
+            )
+            return written
+
+        if self.stage_point is None:
+            sink = io.BytesIO()
+            encode(sink)
+            self.digest = hasher.hexdigest()
+            self.uid = self.digest + self.ext
+            self.store = self._acquire(sink.getvalue())
+        else:
+            staging.TRACKER.wait_for_space(self.stage_point)
+            tmp_path = op.join(self.stage_point, f"{uuid.uuid4().hex}.part")
+            with fsspec.open(tmp_path, "wb") as sink:
+                written = encode(sink)
+            self.digest = hasher.hexdigest()
+            self.uid = self.digest + self.ext
+            self.staging_path = op.join(self.stage_point, self.uid)
+            fs, _, _ = fsspec.core.get_fs_token_paths(self.staging_path)
+            if fs.exists(self.staging_path):
+                fs.rm(tmp_path)
+                _touch(fs, self.staging_path)
+            else:
+                fs.mv(tmp_path, self.staging_path)
+                staging.TRACKER.record_write(self.stage_point, written)
+            self._acquire()
+            self.store = fsspec.open(self.staging_path, "rb")
+
+    def _set_reference(self, path):
+        """
+        Make the handle a reference to a file on a shared filesystem.
+
+        args:
+            path (str): the file path
+        """
+        self.reference = op.realpath(path)
+        stat = os.stat(self.reference)
+        file_hash = _hash_file(self.reference) if config.HASH_SHARED_FILES else None
+        self.ref_stamp = (stat.st_size, stat.st_mtime_ns, file_hash)
+        self.size = stat.st_size
+        if file_hash is None:
+            key = f"{self.reference}:{stat.st_size}:{stat.st_mtime_ns}"
+            self.uid = hashlib.sha256(key.encode()).hexdigest() + self.ext
+        else:
+            self.uid = file_hash + self.ext
+
+    def dereference(self):
+        """
+        Turn a reference to a file on a shared filesystem into a copy of
+        its content, e.g. for workers that cannot see the file. Does
+        nothing if the handle is not a reference.
+        """
+        if self.reference is None:
+            return
+        self._check_reference()
+        with open(self.reference, "rb") as s:
+            self._set_content(s, self.size)
+
+    def _check_reference(self):
+        """
+        Check that the referenced file is visible here and unchanged.
+        """
+        try:
+            stat = os.stat(self.reference)
+        except OSError as e:
+            raise IOError(
+                f"Error - shared file {self.reference} is not visible here"
+            ) from e
+        size, mtime, file_hash = self.ref_stamp
+        if stat.st_size != size or (file_hash is None and stat.st_mtime_ns != mtime):
+            raise IOError(
+                f"Error - shared file {self.reference} has changed since it was loaded"
+            )
+
+    def _iter_reference(self):
+        """
+        Yield the content of the referenced file, checking it as it is read.
+        """
+        self._check_reference()
+        file_hash = self.ref_stamp[2]
+        hasher = hashlib.sha256()
+        with open(self.reference, "rb") as s:
+            for chunk in _iter_chunks(s):
+                if file_hash is not None:
+                    hasher.update(chunk)
+                yield chunk
+        if file_hash is not None and hasher.hexdigest() != file_hash:
+            raise IOError(
+                f"Error - shared file {self.reference} has changed since it was loaded"
+            )
+
+    def _iter_content(self):
+        """
+        Yield the raw content of the handle, one stored block at a time.
+        """
+        if self.reference is not None:
+            yield from self._iter_reference()
+            return
+        if self.store is None:
+            return
+        if self.staging_path is None:
+            yield from self._timed(compression.iter_blocks(self.store))
+        else:
+            with self.store as s:
+                yield from self._timed(compression.iter_blocks(s))
+
+    def _timed(self, blocks):
+        """
+        Yield from an iterator of decompressed blocks, recording the time
+        taken to read and decompress each.
+        """
+        while True:
+            start = time.perf_counter()
+            block = next(blocks, None)
+            if block is None:
+                return
+            self.stats.add(decompress_seconds=time.perf_counter() - start)
+            yield block
+
+    def _acquire(self, payload=None):
+        """
+        Register this handle's reference to its payload, and to its staged
+        copy if it has one.
+
+        args:
+            payload (bytes, optional): the in-memory payload
+
+        returns:
+            bytes or None: the shared payload
+        """
+        if self.staging_path is not None:
+            staging.TRACKER.track(self.stage_point, self.uid)
+        return _STORE.acquire(self.uid, payload)
+
+    def _release(self):
+        """
+        Drop this handle's reference to its payload, and remove its local
+        copy.
+        """
+        self._remove_local_copy()
+        if getattr(self, "digest", None) is None:
+            return
+        if self.staging_path is not None:
+            staging.TRACKER.untrack(self.stage_point, self.uid)
+        _STORE.release(self.uid)
+        self.digest = None
+
+    def _remove_local_copy(self):
+        """
+        Remove the local copy made by __fspath__(), if there is one.
+        """
+        if getattr(self, "local_path", None) is None:
+            return
+        try:
+            os.remove(self.local_path)
+        except (FileNotFoundError, PermissionError):
+            # on Windows a file that is still open cannot be removed
+            pass
+        self.local_path = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["local_path"] = None
+        state["index"] = None
+        return state
+
+    def __reduce_ex__(self, protocol):
+        # With pickle protocol 5 (as used by Dask) the payload is passed as
+        # an out-of-band buffer, so it can be sent without being copied.
+        state = self.__getstate__()
+        store = state["store"]
+        if isinstance(store, (bytes, bytearray, memoryview)):
+            if protocol >= 5:
+                state["store"] = pickle.PickleBuffer(store)
+            elif isinstance(store, memoryview):
+                state["store"] = store.tobytes()
+        return (_new_filehandle, (type(self),), state)
+
+    def __setstate__(self, state):
+        if isinstance(state["store"], pickle.PickleBuffer):
+            state["store"] = state["store"].raw()
+        self.__dict__.update(state)
+        if self.digest is not None:
+            if self.staging_path is None:
+                self.store = self._acquire(self.store)
             else:
-                self.staging_path = op.join(stage_point, self.uid)
-            self.store = None
+                self._acquire()
 
     def __str__(self):
         return self.__fspath__()
@@ -173,54 +935,131 @@ class FileHandle:
         returns:
             str: the path
         """
-        source = self.store
-        dest = fsspec.open(path, "wb")
-        if self.staging_path is None:
-            with dest as d:
-                d.write(zlib.decompress(source))
-        else:
-            with source as s:
-                with dest as d:
-                    d.write(s.read())
-        dest.close()  # pylint: disable=no-member
+        with fsspec.open(path, "wb") as d:
+            for chunk in self._iter_content():
+                d.write(chunk)
         return path
 
+    def materialize(self, path):
+        """
+        Put a copy of the file at path via the local materialization cache,
+        so each unique file is only decompressed once per process.
+
+        With config.LINK_MODE = "hardlink" the copy is a hardlink to the
+        cached file, so it must then be treated as read-only.
+
+        args:
+            path (str): file path
+
+        returns:
+            str: the path
+        """
+        return get_cache().place(self, path)
+
     def __fspath__(self):
         """
         Returns a path on the current local file system which
         points at the file
         """
+        if self.reference is not None:
+            self._check_reference()
+            return self.reference
         if self.local_path is None:
-            self.local_path = os.path.join(tempfile.gettempdir(), self.uid)
-        if not op.exists(self.local_path):  # pylint: disable=no-else-return
-            return self.save(self.local_path)
-        else:
-            return self.local_path
+            # a name of its own, as other handles with this content, here
+            # or in other processes sharing the directory, may remove theirs
+            self.local_path = os.path.join(
+                tempfile.gettempdir(), str(uuid.uuid4()) + self.ext
+            )
+        if not op.exists(self.local_path):
+            tmp_path = f"{self.local_path}.{uuid.uuid4().hex}.part"
+            self.materialize(tmp_path)
+            os.replace(tmp_path, self.local_path)
+        return self.local_path
 
     def __del__(self):
         if not hasattr(self, "local_path"):  # fix for odd bug...
             return
-        if self.local_path is not None:
-            try:
-                os.remove(self.local_path)
-            except FileNotFoundError:
-                pass
+        self._release()
+
+    def open(self, mode="rb", encoding="utf-8"):
+        """
+        Open the file for reading, without materializing it.
+
+        The file object is seekable, and reads only decompress the blocks of
+        the payload that they touch, so small reads from big files are cheap:
+
+            with fh.open() as f:
+                f.seek(1024)
+                header = f.read(80)
+
+        args:
+            mode (str, optional): "rb" (the default) or "r"
+            encoding (str, optional): the text encoding, for mode "r"
+
+        returns:
+            file-like: a readable, seekable file object
+        """
+        if mode not in ("r", "rb"):
+            raise ValueError("Error - FileHandles can only be opened for reading")
+        if self.reference is not None:
+            self._check_reference()
+            f = open(self.reference, "rb")  # pylint: disable=consider-using-with
+        elif self.store is None:
+            f = io.BytesIO()
+        else:
+            if self.staging_path is None:
+                source = self.store
+            else:
+                source = self.store.open()
+            if self.index is None:
+                self.index = compression.build_index(source)
+            raw = compression.BlockReader(
+                source,
+                self.index,
+                close_source=self.staging_path is not None,
+                stats=self.stats,
+            )
+            f = io.BufferedReader(raw)
+        if mode == "r":
+            return io.TextIOWrapper(f, encoding=encoding)
+        return f
+
+    def read_range(self, offset, length):
+        """
+        Read part of the file.
+
+        args:
+            offset (int): the position of the first byte to read
+            length (int): the number of bytes to read
+
+        returns:
+            bytes: the data, which is shorter than length if the file ends
+                first
+        """
+        with self.open() as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def iter_lines(self, encoding="utf-8"):
+        """
+        Iterate over the lines of a text file, reading it one block at a
+        time.
+
+        args:
+            encoding (str, optional): the text encoding
+
+        yields:
+            str: each line, including its line ending
+        """
+        with self.open("r", encoding=encoding) as f:
+            yield from f
 
     def read_binary(self):
         """
         A method for reading binary file formats
         """
 
-        source = self.store
-        if source is None:
-            return "".encode("utf-8")
-
-        if self.staging_path is None:
-            data = zlib.decompress(source)
-        else:
-            with source as s:
-                data = s.read()
-        return data
+        return b"".join(self._iter_content())
 
     def read_text(self):
         """
@@ -238,14 +1077,7 @@ class FileHandle:
 
         """
 
-        compressed_data = zlib.compress(data)
-        if self.staging_path is None:
-            self.store = compressed_data
-        else:
-            self.store = fsspec.open(self.staging_path, "wb", compression="bz2")
-            with self.store as s:
-                s.write(data)
-            self.store.mode = "rb"
+        self._set_content(io.BytesIO(data), len(data))
 
     def write_text(self, text):
         """
@@ -257,3 +1089,36 @@ class FileHandle:
         """
 
         self.write_binary(text.encode("utf-8"))
+
+
+def _new_filehandle(cls):
+    """
+    Create an uninitialized FileHandle, for unpickling.
+    """
+    return cls.__new__(cls)
+
+
+@dask_serialize.register(FileHandle)
+def _serialize_filehandle(handle):
+    """
+    Serialize a FileHandle for Dask, passing any in-memory payload as a
+    separate frame so it is not copied into the header.
+    """
+    state = handle.__getstate__()
+    frames = []
+    if isinstance(state["store"], (bytes, bytearray, memoryview)):
+        frames.append(state.pop("store"))
+    return {"state": pickle.dumps(state)}, frames
+
+
+@dask_deserialize.register(FileHandle)
+def _deserialize_filehandle(header, frames):
+    """
+    Rebuild a FileHandle serialized by _serialize_filehandle().
+    """
+    state = pickle.loads(header["state"])
+    if frames:
+        state["store"] = frames[0]
+    handle = _new_filehandle(FileHandle)
+    handle.__setstate__(state)
+    return handle
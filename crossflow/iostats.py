@@ -0,0 +1,134 @@
+"""
+iostats.py: counters for the I/O done by FileHandles.
+
+Every FileHandle records the bytes it reads and stores, the time spent
+compressing and decompressing its payload, and how it is materialized, in
+an IOStats object. The counts are added to those of the FileHandler that
+created the handle, and to the totals for the process:
+
+    fh = FileHandler()
+    pf = fh.load('big.dat')
+    print(pf.stats.snapshot())
+    print(fh.stats())
+    print(snapshot())
+
+On a cluster, IOStatsPlugin publishes each worker's totals in its
+heartbeat, and Client.io_stats() adds them up.
+"""
+
+import threading
+
+from distributed import WorkerPlugin
+
+# The counters kept for each handle, handler and process.
+FIELDS = (
+    "loads",
+    "reuses",
+    "raw_bytes",
+    "stored_bytes",
+    "compress_seconds",
+    "decompress_seconds",
+    "materializations",
+    "cache_hits",
+    "materialize_seconds",
+)
+
+
+class IOStats:
+    """
+    A thread-safe set of I/O counters.
+
+    args:
+        parent (IOStats, optional): counts are also added to this
+
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self._counts = dict.fromkeys(FIELDS, 0)
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        """
+        Add to some counters, and to those of the parent.
+        """
+        with self._lock:
+            for key, value in counts.items():
+                self._counts[key] += value
+        if self.parent is not None:
+            self.parent.add(**counts)
+
+    def snapshot(self):
+        """
+        Returns a copy of the counters.
+
+        returns:
+            dict: the value of each counter
+        """
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        """
+        Set all the counters to zero.
+        """
+        with self._lock:
+            self._counts = dict.fromkeys(FIELDS, 0)
+
+    def __reduce__(self):
+        # The counts travel with a pickled handle, but are added to the
+        # totals of the process that unpickles it from then on.
+        return (_restore, (self.snapshot(),))
+
+
+def _restore(counts):
+    """
+    Recreate a pickled IOStats object.
+    """
+    stats = IOStats()
+    stats.add(**counts)
+    stats.parent = TOTALS
+    return stats
+
+
+TOTALS = IOStats()
+
+
+def snapshot():
+    """
+    Returns the I/O counters for this process.
+    """
+    return TOTALS.snapshot()
+
+
+def aggregate(snapshots):
+    """
+    Add up several snapshots.
+
+    args:
+        snapshots (iterable): snapshots from IOStats.snapshot()
+
+    returns:
+        dict: the summed counters
+    """
+    total = dict.fromkeys(FIELDS, 0)
+    for counts in snapshots:
+        for key in FIELDS:
+            total[key] += counts.get(key, 0)
+    return total
+
+
+class IOStatsPlugin(WorkerPlugin):
+    """
+    A Dask worker plugin that reports each worker's I/O counters to the
+    scheduler with its heartbeat, as the "crossflow_io" worker metric.
+
+    """
+
+    name = "crossflow-iostats"
+
+    def setup(self, worker):
+        worker.metrics["crossflow_io"] = lambda worker: snapshot()
+
+    def teardown(self, worker):
+        worker.metrics.pop("crossflow_io", None)
@@ -0,0 +1,348 @@
+"""
+procpool.py: run FunctionTask functions in a warm process pool.
+
+Pure-Python functions hold the GIL, so a threaded worker runs them one at a
+time. A FunctionTask set to the "process" executor:
+
+    task.set_executor("process")
+
+instead runs its function in a pool of config.FUNCTION_PROCESSES processes
+that each worker starts the first time it is needed and keeps for reuse.
+
+Arguments and results are pickled with protocol 5; buffers of at least
+config.SHARED_MEMORY_THRESHOLD bytes (e.g. the data of numpy arrays) go
+through a shared memory block rather than the pool's pipes. Input files
+are staged once per pool, in a directory all the pool's processes read
+from, and the most recent config.FUNCTION_POOL_STAGED of them are kept.
+
+Dask worker processes are daemonic by default, and multiprocessing does
+not let daemonic processes start children. Workers started with the Dask
+setting distributed.worker.daemon set to False are not daemonic, and need
+nothing special. Otherwise the pool clears the (private) daemon flag of
+the worker process while it starts its processes, which is safe as they
+are not daemonic themselves: each one watches its parent and exits when
+the parent does, so none outlive a worker that is killed. If this version
+of Python keeps the flag elsewhere, a clear error asks for the setting.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import contextlib
+import hashlib
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import os.path as op
+import pickle
+import shutil
+import tempfile
+import threading
+
+import cloudpickle
+
+from . import config, sandbox, singleton
+
+
+def _pack(obj):
+    """
+    Pickle an object, putting large buffers in a shared memory block.
+
+    returns:
+        tuple: (message, block), where message can be sent to another
+            process and passed to _unpack(), and block is the SharedMemory
+            (or None), which the caller must close
+    """
+    buffers = []
+
+    def out_of_band(buffer):
+        if buffer.raw().nbytes < config.SHARED_MEMORY_THRESHOLD:
+            return True
+        buffers.append(buffer.raw())
+        return False
+
+    payload = cloudpickle.dumps(obj, protocol=5, buffer_callback=out_of_band)
+    if not buffers:
+        return (payload, None, []), None
+    block = shared_memory.SharedMemory(create=True, size=sum(b.nbytes for b in buffers))
+    layout = []
+    offset = 0
+    for buffer in buffers:
+        block.buf[offset : offset + buffer.nbytes] = buffer
+        layout.append((offset, buffer.nbytes))
+        offset += buffer.nbytes
+    return (payload, block.name, layout), block
+
+
+def _unpack(message, unlink=False):
+    """
+    Unpickle a message from _pack().
+
+    args:
+        message (tuple): the message
+        unlink (bool, optional): if True, remove the shared memory block
+            once it has been read
+    """
+    payload, name, layout = message
+    if name is None:
+        return pickle.loads(payload)
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        buffers = []
+        for offset, size in layout:
+            with block.buf[offset : offset + size] as view:
+                buffers.append(bytearray(view))
+    finally:
+        block.close()
+        if unlink:
+            block.unlink()
+    return pickle.loads(payload, buffers=buffers)
+
+
+# functions unpickled in this (pool) process, by the hash of their pickle
+_FUNCTIONS = {}
+
+# serializes changes to the daemon flag of this process, see _allow_children()
+_DAEMON_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def _allow_children():
+    """
+    Let this process start child processes for the duration of a with
+    block, even if it is daemonic (as Dask worker processes are, unless
+    distributed.worker.daemon is False).
+
+    raises:
+        RuntimeError: if the process is daemonic and its daemon flag is not
+            where multiprocessing has kept it up to now
+    """
+    process = multiprocessing.current_process()
+    with _DAEMON_LOCK:
+        if not process.daemon:
+            yield
+            return
+        # multiprocessing has no public way to do this
+        process_config = getattr(process, "_config", None)
+        if not isinstance(process_config, dict) or "daemon" not in process_config:
+            raise RuntimeError(
+                "Error - the process executor cannot start its pool in a daemonic "
+                "process with this version of Python; start the Dask workers "
+                "with the setting distributed.worker.daemon: False"
+            )
+        process_config["daemon"] = False
+        try:
+            yield
+        finally:
+            process_config["daemon"] = True
+
+
+def _watch_parent():
+    """
+    Start a thread in a pool process that exits the process once its
+    parent has gone, as a daemonic parent does not stop its children.
+    """
+    parent = multiprocessing.parent_process()
+    if parent is None:
+        return
+
+    def watch():
+        parent.join()
+        os._exit(1)
+
+    threading.Thread(target=watch, name="crossflow-parent", daemon=True).start()
+
+
+def _call(key, func_payload, message, directory):
+    """
+    Run a function in a pool process.
+
+    returns:
+        tuple: the result, packed by _pack(); the block is left for the
+            caller to unlink
+    """
+    func = _FUNCTIONS.get(key)
+    if func is None:
+        if len(_FUNCTIONS) >= 64:
+            _FUNCTIONS.clear()
+        func = _FUNCTIONS[key] = pickle.loads(func_payload)
+    kwargs = _unpack(message)
+    # a pool process runs one function at a time, so it can change directory
+    with sandbox.current_directory(directory):
+        result = func(**kwargs)
+    reply, block = _pack(result)
+    if block is not None:
+        block.close()
+    return reply
+
+
+class FunctionPool:
+    """
+    A warm pool of processes to run functions in, with a directory of
+    staged input files they share.
+
+    args:
+        max_workers (int, optional): the number of processes,
+            config.FUNCTION_PROCESSES by default, or one per usable core
+            if that is None
+
+    """
+
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = config.FUNCTION_PROCESSES
+        if max_workers is None:
+            try:
+                max_workers = len(os.sched_getaffinity(0))
+            except AttributeError:  # not available on this platform
+                max_workers = os.cpu_count() or 1
+        self.max_workers = max_workers
+        self.directory = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._staged = OrderedDict()
+        self._pending = {}
+        self._in_use = {}
+
+    def _get_executor(self):
+        """
+        Returns the executor, starting it if needed.
+        """
+        with self._lock:
+            if self._executor is None:
+                methods = multiprocessing.get_all_start_methods()
+                method = "forkserver" if "forkserver" in methods else "spawn"
+                self._executor = ProcessPoolExecutor(
+                    self.max_workers,
+                    mp_context=multiprocessing.get_context(method),
+                    initializer=_watch_parent,
+                )
+            return self._executor
+
+    def stage(self, filehandle):
+        """
+        Returns the path of a copy of a file in the pool's staging
+        directory, creating it if it is not there already. Each call must
+        be matched by a call to unstage().
+
+        args:
+            filehandle (FileHandle): the file
+        """
+        key = filehandle.uid
+        while True:
+            with self._lock:
+                if self.directory is None:
+                    self.directory = tempfile.mkdtemp(
+                        prefix="crossflow-pool-", dir=sandbox.choose_root()
+                    )
+                path = self._staged.get(key)
+                if path is not None:
+                    self._use(key)
+                    return path
+                pending = self._pending.get(key)
+                if pending is None:
+                    pending = self._pending[key] = threading.Event()
+                    directory = self.directory
+                    break
+            # another thread is staging it; if that fails, try again
+            pending.wait()
+        # materialize without the lock, so other files can be staged meanwhile
+        try:
+            os.makedirs(op.join(directory, key), exist_ok=True)
+            path = filehandle.materialize(
+                op.join(directory, key, op.basename(filehandle.path))
+            )
+            with self._lock:
+                self._staged[key] = path
+                self._use(key)
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.set()
+        return path
+
+    def _use(self, key):
+        """
+        Mark a staged file as in use and most recently used; the caller
+        must hold the lock.
+        """
+        self._staged.move_to_end(key)
+        self._in_use[key] = self._in_use.get(key, 0) + 1
+        self._evict()
+
+    def unstage(self, filehandle):
+        """
+        Release a file staged by stage().
+        """
+        with self._lock:
+            key = filehandle.uid
+            self._in_use[key] -= 1
+            if not self._in_use[key]:
+                del self._in_use[key]
+            self._evict()
+
+    def _evict(self):
+        """
+        Remove the least recently used staged files that are not in use,
+        down to config.FUNCTION_POOL_STAGED; the caller must hold the lock.
+        """
+        excess = len(self._staged) - config.FUNCTION_POOL_STAGED
+        for key in list(self._staged):
+            if excess <= 0:
+                break
+            if key not in self._in_use:
+                del self._staged[key]
+                shutil.rmtree(op.join(self.directory, key), ignore_errors=True)
+                excess -= 1
+
+    def call(self, func, kwargs, directory):
+        """
+        Run func(**kwargs) in a pool process, in the directory
+        directory, and return the result.
+        """
+        func_payload = cloudpickle.dumps(func)
+        key = hashlib.sha256(func_payload).hexdigest()
+        message, block = _pack(kwargs)
+        try:
+            executor = self._get_executor()
+            try:
+                # the executor starts its processes as they are needed
+                with _allow_children():
+                    future = executor.submit(
+                        _call, key, func_payload, message, directory
+                    )
+                reply = future.result()
+            except BrokenProcessPool:
+                with self._lock:
+                    if self._executor is executor:
+                        self._executor = None
+                raise
+        finally:
+            if block is not None:
+                block.close()
+                block.unlink()
+        return _unpack(reply, unlink=True)
+
+    def shutdown(self):
+        """
+        Stop the processes and remove the staged files.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+            directory, self.directory = self.directory, None
+            self._staged.clear()
+            self._in_use.clear()
+        if executor is not None:
+            executor.shutdown()
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+_POOL = singleton.PerProcess(FunctionPool, shutdown=True)
+
+
+def get_pool():
+    """
+    Returns the FunctionPool for this process, creating it if needed.
+    """
+    return _POOL.get()
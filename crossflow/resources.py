@@ -0,0 +1,223 @@
+"""
+resources.py: resource declarations for tasks, and thread pinning.
+
+A task can declare what each run needs:
+
+    task.set_resources(cores=8, memory='16GB', scratch=1)
+
+Client.submit() and Client.map() pass the declaration to Dask as worker
+resources, so a worker only runs as many tasks at once as the resources
+it was started with allow, e.g.:
+
+    dask worker scheduler:8786 --resources "cores=32,memory=128e9,scratch=1"
+
+When a SubprocessTask that declares cores is launched, the thread count
+environment variables in config.THREAD_ENV_VARS are set to that number,
+and, if config.PIN_THREADS is True, the process is pinned to that many
+CPU cores that no other task on the node is using. Several worker
+processes may run on one node (e.g. dask worker --nworkers 4), so the
+cores each process has reserved are recorded in an allocation file in
+the system temporary directory, which is locked while it is read and
+updated; entries of processes that have exited are ignored. The file is
+named after the host too, as pids are only unique on one node and the
+temporary directory could be on a shared filesystem.
+"""
+
+import contextlib
+import json
+import os
+import os.path as op
+import shutil
+import socket
+import tempfile
+import threading
+import uuid
+
+from dask.utils import parse_bytes
+
+from . import config
+
+
+def dask_resources(cores=None, memory=None, **others):
+    """
+    Convert a resource declaration to Dask worker resources.
+
+    args:
+        cores (int, optional): the number of CPU cores
+        memory (int or str, optional): the memory, in bytes or as a string
+            such as "16GB"
+        others: any other resources, e.g. scratch=1
+
+    returns:
+        dict: the Dask resources
+    """
+    resources = {}
+    if cores is not None:
+        if int(cores) < 1:
+            raise ValueError(f"Error - a task needs at least one core, not {cores}")
+        resources["cores"] = int(cores)
+    if memory is not None:
+        resources["memory"] = parse_bytes(memory) if isinstance(memory, str) else memory
+    for key, value in others.items():
+        if not isinstance(value, (int, float)):
+            raise TypeError(
+                f"Error - resource {key} must be a number, not of type {type(value)}"
+            )
+        resources[key] = value
+    return resources
+
+
+def thread_environment(cores, env=None):
+    """
+    Returns a copy of an environment with the thread count variables in
+    config.THREAD_ENV_VARS set.
+
+    args:
+        cores (int): the number of threads
+        env (dict, optional): the environment, os.environ by default
+    """
+    env = dict(os.environ if env is None else env)
+    for name in config.THREAD_ENV_VARS:
+        env[name] = str(cores)
+    return env
+
+
+def _alive(pid):
+    """
+    Returns True if a process with this pid is running.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # another user's process
+        return True
+    return True
+
+
+class CoreAllocator:
+    """
+    Hands out disjoint sets of the CPU cores this process may use, so
+    concurrent tasks on a node are pinned to different cores. Allocators
+    in different processes coordinate through an allocation file.
+
+    args:
+        path (str, optional): the allocation file, by default
+            crossflow-cores-<host>-<uid>.json in the system temporary
+            directory
+
+    """
+
+    def __init__(self, path=None):
+        try:
+            self.cores = sorted(os.sched_getaffinity(0))
+        except AttributeError:  # not available on this platform
+            self.cores = []
+        self.path = path
+        self._held = set()
+        self._lock = threading.Lock()
+        self._token = uuid.uuid4().hex[:8]
+
+    def _key(self):
+        """
+        Returns the key of this allocator's entry in the allocation file;
+        it starts with the pid, which changes in a forked child.
+        """
+        return f"{os.getpid()}:{self._token}"
+
+    @contextlib.contextmanager
+    def _allocations(self):
+        """
+        Lock the allocation file for the duration of a with block, yielding
+        the cores reserved by each live allocator, by key; changes to the
+        dict are written back. If the file cannot be used, an empty dict is
+        yielded, and only this allocator's own reservations are respected.
+        """
+        try:
+            import fcntl  # pylint: disable=import-outside-toplevel
+
+            path = self.path
+            if path is None:
+                name = f"crossflow-cores-{socket.gethostname()}-{os.getuid()}.json"
+                path = op.join(tempfile.gettempdir(), name)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        except (ImportError, OSError):  # e.g. on Windows
+            yield {}
+            return
+        with os.fdopen(fd, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                allocations = json.loads(f.read() or "{}")
+            except ValueError:
+                allocations = {}
+            allocations = {
+                key: cores
+                for key, cores in allocations.items()
+                if _alive(int(key.split(":")[0]))
+            }
+            yield allocations
+            f.seek(0)
+            f.truncate()
+            json.dump(allocations, f)
+
+    def acquire(self, n):
+        """
+        Reserve n cores.
+
+        returns:
+            list or None: the cores, or None if there are not enough free
+        """
+        with self._lock, self._allocations() as allocations:
+            key = self._key()
+            taken = set(self._held)
+            for other, cores in allocations.items():
+                if other != key:
+                    taken.update(cores)
+            free = [c for c in self.cores if c not in taken]
+            if n > len(free):
+                return None
+            cores = free[:n]
+            self._held.update(cores)
+            allocations[key] = sorted(self._held)
+            return cores
+
+    def release(self, cores):
+        """
+        Return cores reserved by acquire().
+        """
+        if cores is None:
+            return
+        with self._lock, self._allocations() as allocations:
+            self._held.difference_update(cores)
+            if self._held:
+                allocations[self._key()] = sorted(self._held)
+            else:
+                allocations.pop(self._key(), None)
+
+
+ALLOCATOR = CoreAllocator()
+
+
+def pinned_command(command, cores):
+    """
+    Returns the arguments to run a shell command pinned to some cores, or
+    None if that is not possible here.
+
+    args:
+        command (str): the shell command line
+        cores (list): the cores
+    """
+    taskset = shutil.which("taskset")
+    if taskset is None:
+        return None
+    return [taskset, "-c", ",".join(str(c) for c in cores), "/bin/sh", "-c", command]
+
+
+def pin(pid, cores):
+    """
+    Pin a running process to some cores, if the platform allows.
+    """
+    try:
+        os.sched_setaffinity(pid, cores)
+    except (AttributeError, OSError):
+        pass
@@ -0,0 +1,290 @@
+"""
+resultcache.py: a persistent, on-disk cache of SubprocessTask results.
+
+A SubprocessTask with caching turned on:
+
+    task.set_cache(True)
+
+looks its results up in a ResultCache before running, keyed by a hash of
+the command template, the values of its variables and the content of its
+input files, and stores them there afterwards, so re-running an unchanged
+task returns the stored outputs without launching the subprocess.
+
+Each cache is a directory holding an SQLite index and one entry directory
+per result, with a copy of each output file. Once the cache holds more
+than its maximum size, the least recently used entries are removed. The
+index uses write-ahead logging, except on network filesystems, where
+SQLite cannot share its log between processes safely (see
+config.RESULT_CACHE_JOURNAL).
+"""
+
+import hashlib
+import io
+import os
+import os.path as op
+import pickle
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+from . import config
+from .filehandling import FileHandle, filesystem_type
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+)
+"""
+
+
+def default_directory():
+    """
+    Returns the default cache directory, config.RESULT_CACHE_DIR or a
+    directory under the user's cache directory.
+    """
+    if config.RESULT_CACHE_DIR is not None:
+        return str(config.RESULT_CACHE_DIR)
+    base = os.environ.get("XDG_CACHE_HOME", op.join(op.expanduser("~"), ".cache"))
+    return op.join(base, "crossflow", "results")
+
+
+def journal_mode(directory):
+    """
+    Returns the SQLite journal mode for a cache index in a directory, see
+    config.RESULT_CACHE_JOURNAL.
+    """
+    if config.RESULT_CACHE_JOURNAL != "auto":
+        return config.RESULT_CACHE_JOURNAL
+    if filesystem_type(directory) in config.SHARED_FS_TYPES:
+        return "DELETE"
+    return "WAL"
+
+
+def task_key(template, variables, files, outputs):
+    """
+    Returns the cache key for a task run.
+
+    args:
+        template (str): the command template
+        variables (dict): the values of the template variables
+        files (list): (file name, FileHandle) for each input file
+        outputs (list): the output names
+
+    returns:
+        str: a hex digest
+    """
+    hasher = hashlib.sha256()
+    for part in [
+        template,
+        repr(sorted((k, repr(v)) for k, v in variables.items())),
+        repr(sorted((name, handle.uid) for name, handle in files)),
+        repr(list(outputs)),
+    ]:
+        hasher.update(part.encode())
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+class _Pickler(pickle.Pickler):
+    """
+    Pickles task outputs, copying each FileHandle into an entry directory.
+    """
+
+    def __init__(self, file, directory):
+        super().__init__(file)
+        self.directory = directory
+        self.count = 0
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, FileHandle):
+            return None
+        name = op.basename(os.fspath(obj.path)) or obj.uid
+        relpath = op.join("files", str(self.count), name)
+        self.count += 1
+        path = op.join(self.directory, relpath)
+        os.makedirs(op.dirname(path))
+        obj.save(path)
+        return relpath
+
+
+class _Unpickler(pickle.Unpickler):
+    """
+    Unpickles task outputs, loading each stored file as a FileHandle.
+    """
+
+    def __init__(self, file, directory, filehandler):
+        super().__init__(file)
+        self.directory = directory
+        self.filehandler = filehandler
+
+    def persistent_load(self, pid):
+        # cache entries may be evicted, so never pass them by reference
+        return self.filehandler.load(op.join(self.directory, pid), copy=True)
+
+
+def _tree_size(directory):
+    """
+    Returns the total size of the files under a directory.
+    """
+    size = 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            size += op.getsize(op.join(root, name))
+    return size
+
+
+class ResultCache:
+    """
+    A persistent cache of task results, see the module docstring.
+
+    args:
+        directory (str, optional): the cache directory, see
+            default_directory()
+        max_size (int, optional): the maximum size of the cache in bytes,
+            config.RESULT_CACHE_SIZE by default
+
+    """
+
+    def __init__(self, directory=None, max_size=None):
+        self.directory = default_directory() if directory is None else directory
+        self.max_size = config.RESULT_CACHE_SIZE if max_size is None else max_size
+        self._entries = op.join(self.directory, "entries")
+        os.makedirs(self._entries, exist_ok=True)
+        self.journal_mode = journal_mode(self.directory)
+        self._lock = threading.Lock()
+        self._query(_SCHEMA)
+
+    def _connect(self):
+        """
+        Returns a connection to the index; several processes may share it.
+        """
+        db = sqlite3.connect(op.join(self.directory, "index.sqlite"), timeout=60)
+        db.execute(f"PRAGMA journal_mode={self.journal_mode}")
+        return db
+
+    def _query(self, sql, params=()):
+        """
+        Run one statement against the index, and return all its rows.
+        """
+        with self._lock:
+            db = self._connect()
+            try:
+                with db:
+                    return db.execute(sql, params).fetchall()
+            finally:
+                db.close()
+
+    def get(self, key, filehandler):
+        """
+        Look up a stored result.
+
+        args:
+            key (str): the key, from task_key()
+            filehandler (FileHandler): used to load the stored output files
+
+        returns:
+            tuple or None: (outputs, stdout), or None if there is no result
+        """
+        if not self._query("SELECT key FROM results WHERE key = ?", (key,)):
+            return None
+        entry = op.join(self._entries, key)
+        try:
+            with open(op.join(entry, "result.pickle"), "rb") as f:
+                result = _Unpickler(f, entry, filehandler).load()
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.remove(key)
+            return None
+        self._query("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+        return result
+
+    def put(self, key, outputs, stdout):
+        """
+        Store a result.
+
+        args:
+            key (str): the key, from task_key()
+            outputs: the task outputs
+            stdout (str): the task's standard output
+        """
+        entry = op.join(self._entries, key)
+        tmp_entry = op.join(self._entries, f"{key}.{uuid.uuid4().hex}.part")
+        os.makedirs(tmp_entry)
+        try:
+            buffer = io.BytesIO()
+            _Pickler(buffer, tmp_entry).dump((outputs, stdout))
+            with open(op.join(tmp_entry, "result.pickle"), "wb") as f:
+                f.write(buffer.getvalue())
+            size = _tree_size(tmp_entry)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.replace(tmp_entry, entry)
+        except Exception:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            raise
+        now = time.time()
+        self._query(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, size, now, now)
+        )
+        self._evict(keep=key)
+
+    def remove(self, key):
+        """
+        Remove a stored result.
+        """
+        self._query("DELETE FROM results WHERE key = ?", (key,))
+        shutil.rmtree(op.join(self._entries, key), ignore_errors=True)
+
+    def size(self):
+        """
+        Returns the total size of the stored results, in bytes.
+        """
+        return self._query("SELECT COALESCE(SUM(size), 0) FROM results")[0][0]
+
+    def clear(self):
+        """
+        Remove every stored result.
+        """
+        for (key,) in self._query("SELECT key FROM results"):
+            self.remove(key)
+
+    def _evict(self, keep=None):
+        """
+        Remove the least recently used results, other than keep, until the
+        cache fits in max_size.
+        """
+        total = self.size()
+        if total <= self.max_size:
+            return
+        rows = self._query("SELECT key, size FROM results ORDER BY accessed")
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total -= size
+
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def get_result_cache(directory=None):
+    """
+    Returns the ResultCache for a directory in this process, creating it if
+    needed.
+
+    args:
+        directory (str, optional): the cache directory, see
+            default_directory()
+    """
+    if directory is None:
+        directory = default_directory()
+    with _CACHES_LOCK:
+        if directory not in _CACHES:
+            _CACHES[directory] = ResultCache(directory)
+        return _CACHES[directory]
@@ -0,0 +1,273 @@
+"""
+sandbox.py: a pool of reusable working directories for tasks.
+
+Creating and deleting a fresh temporary directory for every task run
+costs several filesystem metadata operations, which adds up for short
+tasks on a network /tmp. Instead, tasks borrow a directory from the
+pool for this process:
+
+    with sandbox(input_size) as td:
+        ...
+
+and give it back afterwards. Returned directories are emptied on a
+background thread and kept for reuse, up to config.SANDBOX_POOL_SIZE
+per scratch root.
+
+The scratch root is chosen by choose_root(): if they are set, tasks whose
+inputs total less than config.SCRATCH_SHM_SIZE bytes run in
+config.SCRATCH_SHM (a RAM-backed filesystem), and tasks with inputs of at
+least config.SCRATCH_LARGE_SIZE bytes run in config.SCRATCH_LARGE (e.g. a
+node-local SSD); all others run in config.SCRATCH_ROOT.
+"""
+
+import atexit
+from collections import deque
+import contextlib
+import logging
+import os
+import os.path as op
+import queue
+import shutil
+import tempfile
+import threading
+
+from . import config, singleton
+
+logger = logging.getLogger(__name__)
+
+# the working directory of the FunctionTask running in each thread
+_WORKDIR = threading.local()
+
+# os.chdir() changes the current directory of every thread in the process,
+# so runs that need it take turns
+_CHDIR_LOCK = threading.RLock()
+
+
+def _usable(directory):
+    """
+    Returns True if directory exists and this process can create files in
+    it.
+    """
+    return (
+        directory is not None
+        and op.isdir(directory)
+        and os.access(directory, os.W_OK | os.X_OK)
+    )
+
+
+def choose_root(input_size=None):
+    """
+    Choose where to create a task's working directory.
+
+    args:
+        input_size (int, optional): the total size of the task's input
+            files in bytes, if known
+
+    returns:
+        str: the scratch root directory
+    """
+    if input_size is not None:
+        if input_size < config.SCRATCH_SHM_SIZE and _usable(config.SCRATCH_SHM):
+            return str(config.SCRATCH_SHM)
+        if input_size >= config.SCRATCH_LARGE_SIZE and _usable(config.SCRATCH_LARGE):
+            return str(config.SCRATCH_LARGE)
+    if config.SCRATCH_ROOT is not None:
+        return str(config.SCRATCH_ROOT)
+    return tempfile.gettempdir()
+
+
+def _empty(directory):
+    """
+    Remove everything inside a directory, but not the directory itself.
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+class SandboxPool:
+    """
+    A pool of empty working directories, grouped by scratch root.
+
+    args:
+        max_size (int, optional): the number of empty directories to keep
+            for each root, config.SANDBOX_POOL_SIZE by default
+
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = config.SANDBOX_POOL_SIZE if max_size is None else max_size
+        self._ready = {}
+        self._lock = threading.Lock()
+        self._dirty = queue.Queue()
+        self._thread = None
+
+    def acquire(self, root=None):
+        """
+        Take an empty working directory from the pool, creating one if
+        none are ready.
+
+        args:
+            root (str, optional): the scratch root, see choose_root()
+
+        returns:
+            str: the directory path
+        """
+        root = op.abspath(choose_root() if root is None else root)
+        with self._lock:
+            ready = self._ready.get(root)
+            if ready:
+                return ready.pop()
+        return tempfile.mkdtemp(prefix="crossflow-", dir=root)
+
+    def release(self, directory):
+        """
+        Give a working directory back to the pool. It is emptied in the
+        background before it is reused.
+
+        args:
+            directory (str): a directory from acquire()
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="crossflow-sandbox", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.clear)
+        self._dirty.put(directory)
+
+    def wait(self):
+        """
+        Block until every released directory has been cleaned.
+        """
+        self._dirty.join()
+
+    def clear(self):
+        """
+        Remove every directory that is ready for reuse.
+        """
+        with self._lock:
+            ready, self._ready = self._ready, {}
+        for directories in ready.values():
+            for directory in directories:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def _run(self):
+        """
+        The background thread: empty released directories, and keep them
+        if there is room in the pool.
+        """
+        while True:
+            directory = self._dirty.get()
+            try:
+                self._recycle(directory)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Failed to clean up %s", directory)
+            finally:
+                self._dirty.task_done()
+
+    def _recycle(self, directory):
+        """
+        Empty a directory and return it to the pool, or remove it if the
+        pool is full.
+        """
+        root = op.dirname(directory)
+        with self._lock:
+            keep = len(self._ready.get(root, ())) < self.max_size
+        if not keep:
+            shutil.rmtree(directory, ignore_errors=True)
+            return
+        _empty(directory)
+        if os.listdir(directory):
+            shutil.rmtree(directory, ignore_errors=True)
+            return
+        with self._lock:
+            self._ready.setdefault(root, deque()).append(directory)
+
+
+_POOL = singleton.PerProcess(SandboxPool)
+
+
+def get_pool():
+    """
+    Returns the SandboxPool for this process, creating it if needed.
+    """
+    return _POOL.get()
+
+
+@contextlib.contextmanager
+def sandbox(input_size=None):
+    """
+    Borrow a working directory from the pool for the duration of a with
+    block.
+
+    args:
+        input_size (int, optional): the total size of the task's input
+            files in bytes, used to choose the scratch root
+
+    yields:
+        str: the directory path
+    """
+    pool = get_pool()
+    directory = pool.acquire(choose_root(input_size))
+    try:
+        yield directory
+    finally:
+        pool.release(directory)
+
+
+def workdir():
+    """
+    Returns the working directory of the FunctionTask running in this
+    thread, or None outside one.
+
+    A function run by a FunctionTask does not run with this as its current
+    directory (unless it is set to set_chdir(True)), so it should write its
+    output files here; relative paths it returns are relative to it:
+
+        def make_copy(a):
+            path = os.path.join(tasks.workdir(), "out.dat")
+            shutil.copy(a, path)
+            return "out.dat"
+
+    """
+    return getattr(_WORKDIR, "path", None)
+
+
+@contextlib.contextmanager
+def working_directory(directory):
+    """
+    Make directory the value of workdir() in this thread for the duration
+    of a with block, without changing the current directory.
+    """
+    previous = workdir()
+    _WORKDIR.path = directory
+    try:
+        yield directory
+    finally:
+        _WORKDIR.path = previous
+
+
+@contextlib.contextmanager
+def current_directory(directory):
+    """
+    Make directory both the current directory of the process and the value
+    of workdir() for the duration of a with block. As the process has only
+    one current directory, with blocks in different threads wait for each
+    other.
+    """
+    with _CHDIR_LOCK:
+        previous = os.getcwd()
+        os.chdir(directory)
+        try:
+            with working_directory(directory):
+                yield directory
+        finally:
+            os.chdir(previous)
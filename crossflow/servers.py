@@ -0,0 +1,331 @@
+"""
+servers.py: long-lived tool processes for ServerTasks.
+
+Some tools take seconds to start and milliseconds to handle each input.
+A ServerTask starts its tool once and sends it one request per run:
+
+    server = get_pool().acquire(command, transport, ready, env)
+    response = server.request("score ligand.pdb\\n", terminator="END")
+    get_pool().release(server)
+
+Each process keeps a pool of idle servers for each command, so a worker
+starts one per thread that uses it, and reuses them. A server that has
+exited is replaced with a fresh one when it is next acquired.
+
+Requests go to the tool's standard input ("stdio"), with the response read
+from its standard output, or over a Unix socket ("socket"), whose path
+replaces {socket} in the command; there each request gets a connection of
+its own. A response ends at a line equal to the terminator or, without
+one, after one line (stdio) or when the server closes the connection
+(socket). Each server runs in a directory of its own, and keeps the last
+config.CAPTURE_SIZE bytes of its standard error for error messages.
+
+Responses are read with selectors, which only work on pipes and Unix
+sockets on POSIX platforms, so ServerTasks do not run on Windows.
+"""
+
+import os
+import os.path as op
+import selectors
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+from . import capture, config, sandbox, singleton
+
+
+def _key(command, transport, ready, env):
+    """
+    Returns the key the idle servers for some settings are kept under.
+    """
+    return (command, transport, ready, None if env is None else tuple(env.items()))
+
+
+class ToolServer:  # pylint: disable=too-many-instance-attributes
+    """
+    A running tool process that handles requests one at a time.
+
+    args:
+        command (str): the command line that starts the tool
+        transport (str, optional): "stdio" or "socket"
+        ready (str, optional): a line the tool prints on its standard
+            output when it is ready for requests (stdio only)
+        env (dict, optional): the tool's environment
+
+    """
+
+    def __init__(self, command, transport="stdio", ready=None, env=None):
+        if transport == "socket" and not hasattr(socket, "AF_UNIX"):
+            raise OSError("Error - Unix sockets are not available on this platform")
+        self.command = command
+        self.transport = transport
+        self.key = _key(command, transport, ready, env)
+        self.directory = tempfile.mkdtemp(
+            prefix="crossflow-server-", dir=sandbox.choose_root()
+        )
+        self.socket_path = None
+        if transport == "socket":
+            self.socket_path = op.join(self.directory, "socket")
+            command = command.replace("{socket}", self.socket_path)
+        self.stderr = capture.OutputCapture(tail=config.CAPTURE_SIZE)
+        self._buffer = bytearray()
+        self.process = subprocess.Popen(  # pylint: disable=consider-using-with
+            command,
+            shell=True,
+            stdin=subprocess.PIPE if transport == "stdio" else subprocess.DEVNULL,
+            stdout=subprocess.PIPE if transport == "stdio" else subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            cwd=self.directory,
+            env=env,
+            start_new_session=True,
+        )
+        self._stderr_thread = capture.drain(self.process.stderr, self.stderr)
+        try:
+            self._wait_until_ready(ready)
+        except BaseException:
+            self.close()
+            raise
+
+    def _wait_until_ready(self, ready):
+        """
+        Wait up to config.SERVER_STARTUP_TIMEOUT seconds for the tool to
+        print the ready line, or to create its socket.
+        """
+        deadline = time.monotonic() + config.SERVER_STARTUP_TIMEOUT
+        if self.transport == "stdio":
+            if ready is not None:
+                while self._read_line(deadline).rstrip(b"\r\n") != ready.encode():
+                    pass
+            return
+        # connecting to check would cost the tool a request
+        while not op.exists(self.socket_path):
+            if not self.alive():
+                raise self._crashed()
+            if time.monotonic() >= deadline:
+                raise TimeoutError(
+                    f"Error - server {self.command} did not start listening"
+                )
+            time.sleep(0.05)
+
+    def alive(self):
+        """
+        Returns True if the tool is still running.
+        """
+        return self.process.poll() is None
+
+    def request(self, text, terminator=None, timeout=None):
+        """
+        Send a request to the tool and return its response.
+
+        args:
+            text (str): the request
+            terminator (str, optional): the line that ends the response,
+                which is not included in it
+            timeout (float, optional): seconds to wait for the response
+
+        returns:
+            bytes: the response
+
+        raises:
+            ConnectionError: if the tool exits (or closes the connection)
+                before it finishes responding
+            TimeoutError: if the response takes longer than timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        data = text.encode()
+        if self.transport == "stdio":
+            try:
+                self.process.stdin.write(data)
+                self.process.stdin.flush()
+            except BrokenPipeError:
+                raise self._crashed() from None
+            if terminator is None:
+                return self._read_line(deadline)
+            return self._read_until(terminator, deadline)
+        with socket.socket(socket.AF_UNIX) as s:
+            s.settimeout(timeout)
+            try:
+                try:
+                    s.connect(self.socket_path)
+                except ConnectionRefusedError:
+                    # a new tool may have bound its socket but not yet listen
+                    time.sleep(0.1)
+                    s.connect(self.socket_path)
+                s.sendall(data)
+                s.shutdown(socket.SHUT_WR)
+            except socket.timeout:
+                raise TimeoutError("Error - server did not respond in time") from None
+            except OSError:
+                raise self._crashed() from None
+            try:
+                return self._read_until(terminator, deadline, s)
+            finally:
+                self._buffer = bytearray()
+
+    def _read_until(self, terminator, deadline, connection=None):
+        """
+        Read lines until one equal to terminator or, if terminator is None,
+        until the connection closes.
+        """
+        response = bytearray()
+        while True:
+            try:
+                line = self._read_line(deadline, connection)
+            except EOFError:
+                if terminator is None:
+                    response += self._buffer
+                    self._buffer = bytearray()
+                    return bytes(response)
+                raise self._crashed() from None
+            if terminator is not None and line.rstrip(b"\r\n") == terminator.encode():
+                return bytes(response)
+            response += line
+
+    def _read_line(self, deadline, connection=None):
+        """
+        Read one line (including its newline) from the tool's standard
+        output, or from connection.
+        """
+        with selectors.DefaultSelector() as selector:
+            if connection is None:
+                source = self.process.stdout.fileno()
+                selector.register(source, selectors.EVENT_READ)
+            else:
+                selector.register(connection, selectors.EVENT_READ)
+            while b"\n" not in self._buffer:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not selector.select(remaining):
+                        raise TimeoutError("Error - server did not respond in time")
+                else:
+                    selector.select()
+                if connection is None:
+                    chunk = os.read(source, 64 * 1024)
+                else:
+                    chunk = connection.recv(64 * 1024)
+                if not chunk:
+                    if connection is None:
+                        raise self._crashed()
+                    raise EOFError
+                self._buffer += chunk
+        end = self._buffer.index(b"\n") + 1
+        line = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return line
+
+    def _crashed(self):
+        """
+        Returns the error for a tool that has stopped responding.
+        """
+        try:
+            returncode = self.process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            returncode = None
+        self._stderr_thread.join(timeout=1)
+        return ConnectionError(
+            f'Error: server "{self.command}" stopped responding (return code '
+            f'{returncode}); STDERR="{self.stderr.getvalue()}"'
+        )
+
+    def close(self):
+        """
+        Stop the tool, with any processes it started, and remove its
+        directory.
+        """
+        if self.process.stdin is not None:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        except AttributeError:
+            # no process groups (e.g. on Windows)
+            self.process.kill()
+        self.process.wait()
+        self._stderr_thread.join()
+        for stream in (self.process.stdout, self.process.stderr):
+            if stream is not None:
+                stream.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ServerPool:
+    """
+    The idle ToolServers of this process, by command.
+
+    """
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, command, transport="stdio", ready=None, env=None):
+        """
+        Take an idle server for a command, starting one if there is none
+        (or only ones that have exited). The arguments are as for
+        ToolServer.
+
+        returns:
+            ToolServer: the server, which must be given back with release()
+        """
+        key = _key(command, transport, ready, env)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                server = idle.pop() if idle else None
+            if server is None:
+                return ToolServer(command, transport, ready, env)
+            if server.alive():
+                return server
+            server.close()
+
+    def release(self, server, broken=False):
+        """
+        Give a server back to the pool.
+
+        args:
+            server (ToolServer): a server from acquire()
+            broken (bool, optional): if True, the server's state is unknown
+                (e.g. it did not finish responding), so stop it instead
+        """
+        if broken or not server.alive():
+            server.close()
+            return
+        with self._lock:
+            self._idle.setdefault(server.key, []).append(server)
+
+    def shutdown(self):
+        """
+        Stop every idle server.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for servers in idle.values():
+            for server in servers:
+                server.close()
+
+
+_POOL = singleton.PerProcess(ServerPool, shutdown=True)
+
+
+def get_pool():
+    """
+    Returns the ServerPool for this process, creating it if needed.
+    """
+    return _POOL.get()
+
+
+def shutdown():
+    """
+    Stop the idle servers of this process, e.g. on every worker with
+    Client.run(servers.shutdown).
+    """
+    get_pool().shutdown()
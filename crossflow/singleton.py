@@ -0,0 +1,40 @@
+"""
+singleton.py: per-process shared objects.
+
+Several crossflow modules keep one object per process (a pool of workers,
+a cache) that is created the first time it is needed. PerProcess holds
+that object and the lock that guards its creation.
+"""
+
+import atexit
+import threading
+
+
+class PerProcess:
+    """
+    Creates an object the first time it is asked for and returns the same
+    object afterwards.
+    """
+
+    def __init__(self, factory, shutdown=False):
+        """
+        args:
+            factory (callable): called with no arguments to create the object
+            shutdown (bool): if True, the object's shutdown() method is
+                called when the process exits
+        """
+        self.factory = factory
+        self.shutdown = shutdown
+        self.instance = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the object for this process, creating it if needed.
+        """
+        with self._lock:
+            if self.instance is None:
+                self.instance = self.factory()
+                if self.shutdown:
+                    atexit.register(self.instance.shutdown)
+            return self.instance
@@ -0,0 +1,295 @@
+"""
+speculation.py: speculative re-execution of straggling tasks.
+
+With speculation, Client.map() watches the tasks it submitted. Once
+config.SPECULATION_QUORUM of them have finished, any task that has been
+running for more than factor times the median run time of those that
+finished is submitted again. Whichever copy finishes first provides the
+result, and the other is cancelled (which kills a SubprocessTask's
+command):
+
+    results = client.map(md_task, inputs, speculate=2.0)
+
+Run times are measured from when the scheduler is first seen to report a
+task as processing (checked every config.SPECULATION_INTERVAL seconds),
+or from submission for tasks that finished before they were seen; tasks
+still waiting for a worker are never duplicated.
+
+A SpeculativeFuture passed to Client.submit() or Client.map() before its
+race is decided becomes a small selector task, which waits on a worker
+(without holding one of its threads) for the client to publish the
+winning copy in a Dask Variable, and returns its result.
+"""
+
+import logging
+import operator
+import statistics
+import threading
+import time
+import uuid
+
+from dask.distributed import Client as DaskClient
+from dask.distributed import Variable, get_client, rejoin, secede
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+
+class _Race:  # pylint: disable=too-many-instance-attributes
+    """
+    One element of a speculative map(): the original future, any
+    duplicate, and which of them won.
+    """
+
+    def __init__(self, submit):
+        self._submit = submit
+        self._lock = threading.Lock()
+        self.futures = []
+        self.winner = None
+        self.submitted = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.decided = threading.Event()
+        self.losers_cancelled = False
+        self._callbacks = []
+        self._add(submit())
+
+    def _add(self, future):
+        """
+        Add a copy to the race; the caller must hold the lock, or be the
+        constructor.
+        """
+        self.futures.append(future)
+        future.add_done_callback(self._on_done)
+
+    def _on_done(self, _):
+        """
+        Called (on the client's event loop) when any copy finishes.
+        """
+        with self._lock:
+            if self.decided.is_set():
+                return
+            for future in self.futures:
+                if future.status == "finished":
+                    self.winner = future
+                    break
+            else:
+                if any(not f.done() for f in self.futures):
+                    return
+            self.finished = time.monotonic()
+            self.decided.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def duplicate(self):
+        """
+        Submit another copy, if the race is still open and has not been
+        duplicated already.
+        """
+        with self._lock:
+            if self.decided.is_set() or len(self.futures) > 1:
+                return
+            self._add(self._submit())
+
+    def cancel_losers(self, client):
+        """
+        Cancel every copy but the winner, once the race is decided.
+        """
+        if self.losers_cancelled or not self.decided.is_set():
+            return
+        self.losers_cancelled = True
+        losers = [f for f in self.futures if f is not self.winner and not f.done()]
+        if losers:
+            client.cancel(losers)
+
+    def add_callback(self, callback):
+        """
+        Call callback() once the race is decided.
+        """
+        with self._lock:
+            if not self.decided.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def final(self, timeout=None):
+        """
+        Wait for the race to be decided, and return the winning future, or
+        the original future if every copy failed.
+        """
+        if not self.decided.wait(timeout):
+            raise TimeoutError("Error - timed out waiting for the result")
+        return self.winner if self.winner is not None else self.futures[0]
+
+
+def _select(name, output):
+    """
+    Run on a worker: wait for the winning copy of a race to be published
+    in the Variable called name, and return its result (or one output of
+    it).
+    """
+    variable = Variable(name, client=get_client())
+    secede()
+    try:
+        result = variable.get().result()
+    finally:
+        rejoin()
+    return result if output is None else result[output]
+
+
+class SpeculativeFuture:
+    """
+    A future for one element (or one output of one element) of a
+    speculative Client.map(), whose result comes from whichever copy of
+    the task finishes first.
+
+    It behaves like a Dask future for result(), done(), exception() and
+    add_done_callback(), and can be passed to Client.gather(),
+    Client.submit() and Client.map(), which do not wait for the race to
+    be decided.
+
+    """
+
+    def __init__(self, client, race, output=None):
+        self._client = client
+        self.race = race
+        self.output = output
+        self._future = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<SpeculativeFuture: {self.status}, copies={len(self.race.futures)}>"
+
+    @property
+    def status(self):
+        """
+        "finished" or "error" once a copy has won (or all have failed),
+        and "pending" until then.
+        """
+        if not self.race.decided.is_set():
+            return "pending"
+        return self.race.final().status
+
+    def result(self, timeout=None):
+        """
+        Wait for and return the result.
+        """
+        result = self.race.final(timeout).result()
+        return result if self.output is None else result[self.output]
+
+    def done(self):
+        """
+        Returns True once a copy has won, or all have failed.
+        """
+        return self.race.decided.is_set()
+
+    def exception(self, timeout=None):
+        """
+        Returns the exception raised, if every copy failed.
+        """
+        return self.race.final(timeout).exception()
+
+    def cancel(self):
+        """
+        Cancel every copy.
+        """
+        self._client.cancel(list(self.race.futures))
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(self) once a copy has won, or all have failed.
+        """
+        self.race.add_callback(lambda: fn(self))
+
+    def future(self):
+        """
+        Returns a Dask future for the result, without waiting for a copy
+        to win: until one has, it is the future of a selector task that
+        waits for the winner on a worker.
+        """
+        with self._lock:
+            if self._future is not None:
+                return self._future
+            if self.race.decided.is_set():
+                winner = self.race.final()
+                if self.output is None:
+                    self._future = winner
+                else:
+                    self._future = DaskClient.submit(
+                        self._client, operator.getitem, winner, self.output
+                    )
+                return self._future
+            variable = Variable(f"crossflow-race-{uuid.uuid4().hex}", self._client)
+            self._future = DaskClient.submit(
+                self._client, _select, variable.name, self.output, pure=False
+            )
+            selector = self._future
+
+            def publish():
+                # a cancelled selector has already given up on the variable
+                if not selector.done():
+                    variable.set(self.race.final())
+
+            self.race.add_callback(publish)
+            selector.add_done_callback(lambda _: variable.delete())
+            return selector
+
+
+class Speculator(threading.Thread):
+    """
+    A background thread that watches the races of one speculative map(),
+    duplicates stragglers, and cancels the losing copies.
+
+    args:
+        client (Client): the client
+        races (list): the races to watch
+        factor (float): duplicate tasks running for more than factor times
+            the median run time of the finished ones
+
+    """
+
+    def __init__(self, client, races, factor):
+        super().__init__(name="crossflow-speculator", daemon=True)
+        self.client = client
+        self.races = races
+        self.factor = factor
+
+    def run(self):
+        try:
+            while not self._step():
+                time.sleep(config.SPECULATION_INTERVAL)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Speculation stopped")
+
+    def _step(self):
+        """
+        One round of checks; returns True when every race is decided and
+        cleaned up.
+        """
+        now = time.monotonic()
+        if self.client.status != "running":
+            return True
+        running = set()
+        for keys in self.client.processing().values():
+            running.update(keys)
+        durations = []
+        for race in self.races:
+            if race.started is None and any(f.key in running for f in race.futures):
+                race.started = now
+            race.cancel_losers(self.client)
+            if race.winner is not None:
+                # a task that finished between checks was never seen running
+                durations.append(race.finished - (race.started or race.submitted))
+        undecided = [race for race in self.races if not race.decided.is_set()]
+        if not undecided:
+            return all(race.losers_cancelled for race in self.races)
+        if durations and len(self.races) - len(undecided) >= (
+            config.SPECULATION_QUORUM * len(self.races)
+        ):
+            limit = self.factor * statistics.median(durations)
+            for race in undecided:
+                if race.started is not None and now - race.started > limit:
+                    race.duplicate()
+        return False
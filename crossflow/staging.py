@@ -0,0 +1,412 @@
+"""
+staging.py: lifetime tracking, garbage collection and quotas for the
+stage point.
+
+Every process that holds FileHandles staged at a stage point records the
+uids of those handles in a lease file under the stage point, refreshed
+every config.STAGING_HEARTBEAT seconds by a background thread. Results
+held by Dask futures stay leased by the worker holding them, and the
+inputs of a submitted task by the client until the task is done, so a
+staged file is live for as long as any handle or future in any process
+refers to it. Leases that are not refreshed (e.g. because their process died)
+expire.
+
+The collector deletes staged files that no live lease refers to once they
+are older than config.STAGING_GRACE seconds. Only files whose names
+crossflow gives them (a sha256 digest, with the original extension, and
+the ".part" files uploads are written to first) are ever deleted, so
+anything else kept at the stage point is left alone:
+
+    freed = collect('/shared/scratch/stage')
+
+and usage() reports what is at the stage point:
+
+    print(usage('/shared/scratch/stage'))
+
+A Client with a stage point starts a background collector if
+config.STAGING_GC is True (it is off by default); the same information is
+available from the command line:
+
+    crossflow staging /shared/scratch/stage [--collect]
+"""
+
+import atexit
+from collections import Counter
+import json
+import logging
+import os.path as op
+import re
+import socket
+import threading
+import time
+import uuid
+
+import fsspec
+
+from . import config
+
+LEASE_DIR = ".crossflow-leases"
+
+# the names crossflow gives staged files, and the files they are uploaded to
+_STAGED_NAME = re.compile(r"[0-9a-f]{64}(\.[^.]*)?")
+_PART_NAME = re.compile(r"[0-9a-f]{32}\.part")
+
+logger = logging.getLogger(__name__)
+
+
+def _fs(stage_point):
+    """
+    Returns the fsspec filesystem and root path for a stage point.
+    """
+    return fsspec.core.url_to_fs(str(stage_point))
+
+
+def _mtime(fs, info):
+    """
+    Returns the modification time of a file from its fsspec info.
+    """
+    if "mtime" in info:
+        return info["mtime"]
+    return fs.modified(info["name"]).timestamp()
+
+
+class StagingTracker:  # pylint: disable=too-many-instance-attributes
+    """
+    Tracks the staged files used by this process, keeps its leases up to
+    date, and runs the background collector and quota checks.
+
+    """
+
+    def __init__(self):
+        self.owner = f"{socket.gethostname()}-{uuid.uuid4().hex[:12]}"
+        self._lock = threading.Lock()
+        self._live = {}
+        self._dirty = set()
+        self._usage = {}
+        self._collecting = {}
+        self._measure = set()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def track(self, stage_point, uid):
+        """
+        Record that a handle in this process uses a staged file.
+        """
+        stage_point = str(stage_point)
+        with self._lock:
+            counts = self._live.setdefault(stage_point, Counter())
+            counts[uid] += 1
+            if counts[uid] == 1:
+                self._dirty.add(stage_point)
+                self._start()
+        self._wakeup.set()
+
+    def untrack(self, stage_point, uid):
+        """
+        Record that a handle in this process no longer uses a staged file.
+        """
+        stage_point = str(stage_point)
+        with self._lock:
+            counts = self._live.get(stage_point)
+            if counts is None or counts[uid] == 0:
+                return
+            counts[uid] -= 1
+            if counts[uid] == 0:
+                del counts[uid]
+                self._dirty.add(stage_point)
+
+    def live(self, stage_point):
+        """
+        Returns the uids of the staged files this process uses.
+        """
+        with self._lock:
+            return set(self._live.get(str(stage_point), ()))
+
+    def start_collector(self, stage_point, interval=None):
+        """
+        Start collecting garbage at a stage point in the background.
+
+        args:
+            stage_point (str): the stage point
+            interval (float, optional): seconds between collections,
+                config.STAGING_GC_INTERVAL by default
+        """
+        if interval is None:
+            interval = config.STAGING_GC_INTERVAL
+        with self._lock:
+            self._collecting[str(stage_point)] = [interval, time.monotonic()]
+            self._start()
+
+    def stop_collector(self, stage_point):
+        """
+        Stop collecting garbage at a stage point.
+        """
+        with self._lock:
+            self._collecting.pop(str(stage_point), None)
+
+    def record_usage(self, stage_point, nbytes):
+        """
+        Set the usage estimate for a stage point, e.g. after a collection.
+        """
+        with self._lock:
+            self._usage[str(stage_point)] = nbytes
+
+    def record_write(self, stage_point, nbytes):
+        """
+        Add a newly staged file to the usage estimate for a stage point.
+        """
+        with self._lock:
+            if str(stage_point) in self._usage:
+                self._usage[str(stage_point)] += nbytes
+
+    def wait_for_space(self, stage_point):
+        """
+        Block while the stage point holds more than config.STAGING_QUOTA
+        bytes, collecting garbage to make space. This is the backpressure
+        applied to new uploads.
+
+        raises:
+            IOError: if there is still no space after config.STAGING_TIMEOUT
+                seconds
+        """
+        quota = config.STAGING_QUOTA
+        if quota is None:
+            return
+        stage_point = str(stage_point)
+        with self._lock:
+            estimate = self._usage.get(stage_point)
+            if estimate is None:
+                # measure in the background rather than hold up the upload
+                self._measure.add(stage_point)
+                self._start()
+        if estimate is None:
+            self._wakeup.set()
+            return
+        if estimate < quota:
+            return
+        deadline = time.monotonic() + config.STAGING_TIMEOUT
+        while True:
+            self.write_lease(stage_point)
+            collect(stage_point)
+            if self._usage[stage_point] < quota:
+                return
+            if time.monotonic() > deadline:
+                raise IOError(
+                    f"Error - stage point {stage_point} is over its quota of "
+                    f"{quota} bytes"
+                )
+            time.sleep(min(5.0, config.STAGING_HEARTBEAT))
+
+    def write_lease(self, stage_point):
+        """
+        Write (or remove) this process's lease file for a stage point.
+        """
+        stage_point = str(stage_point)
+        live = self.live(stage_point)
+        fs, root = _fs(stage_point)
+        lease = f"{root}/{LEASE_DIR}/{self.owner}.json"
+        if live:
+            fs.makedirs(f"{root}/{LEASE_DIR}", exist_ok=True)
+            tmp_path = f"{lease}.{uuid.uuid4().hex}.part"
+            with fs.open(tmp_path, "w") as f:
+                json.dump(sorted(live), f)
+            fs.mv(tmp_path, lease)
+        elif fs.exists(lease):
+            fs.rm(lease)
+
+    def _start(self):
+        """
+        Start the background thread, if it is not running; the caller must
+        hold the lock.
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="crossflow-staging", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self._remove_leases)
+
+    def _run(self):
+        """
+        The background thread: refresh leases and collect garbage.
+        """
+        last_heartbeat = 0.0
+        while True:
+            self._wakeup.wait(timeout=1.0)
+            self._wakeup.clear()
+            now = time.monotonic()
+            with self._lock:
+                if now - last_heartbeat >= config.STAGING_HEARTBEAT:
+                    self._dirty.update(self._live)
+                    last_heartbeat = now
+                dirty, self._dirty = self._dirty, set()
+                measure, self._measure = self._measure, set()
+                due = []
+                for stage_point, schedule in self._collecting.items():
+                    if now - schedule[1] >= schedule[0]:
+                        schedule[1] = now
+                        due.append(stage_point)
+            for stage_point in dirty:
+                try:
+                    self.write_lease(stage_point)
+                except Exception:  # pylint: disable=broad-exception-caught
+                    logger.exception("Failed to write lease at %s", stage_point)
+            for stage_point in due:
+                try:
+                    collect(stage_point)
+                except Exception:  # pylint: disable=broad-exception-caught
+                    logger.exception("Failed to collect garbage at %s", stage_point)
+            for stage_point in measure - set(due):
+                try:
+                    usage(stage_point)
+                except Exception:  # pylint: disable=broad-exception-caught
+                    logger.exception("Failed to measure %s", stage_point)
+
+    def _remove_leases(self):
+        """
+        Remove this process's lease files, e.g. at exit.
+        """
+        with self._lock:
+            stage_points = list(self._live)
+            self._live.clear()
+        for stage_point in stage_points:
+            try:
+                self.write_lease(stage_point)
+            except Exception:  # pylint: disable=broad-exception-caught
+                pass
+
+
+TRACKER = StagingTracker()
+
+
+def _leases(fs, root, now):
+    """
+    Returns the lists of uids leased by each other live process at a stage
+    point, removing expired leases.
+    """
+    leases = []
+    lease_dir = f"{root}/{LEASE_DIR}"
+    if not fs.exists(lease_dir):
+        return leases
+    own_lease = f"{TRACKER.owner}.json"
+    for info in fs.ls(lease_dir, detail=True):
+        name = op.basename(info["name"])
+        if not name.endswith(".json") or name == own_lease:
+            continue
+        if now - _mtime(fs, info) > 3 * config.STAGING_HEARTBEAT:
+            fs.rm(info["name"])
+            continue
+        try:
+            with fs.open(info["name"], "r") as f:
+                leases.append(json.load(f))
+        except (FileNotFoundError, ValueError):
+            pass
+    return leases
+
+
+def _scan(stage_point):
+    """
+    Returns (fs, staged file infos, leases, time) for a stage point, where
+    leases includes the staged files used by this process. Files crossflow
+    did not create are left out.
+    """
+    fs, root = _fs(stage_point)
+    now = time.time()
+    leases = _leases(fs, root, now)
+    leases.append(TRACKER.live(stage_point))
+    files = [
+        info
+        for info in fs.ls(root, detail=True)
+        if info["type"] == "file" and _is_staged(op.basename(info["name"]))
+    ]
+    return fs, files, leases, now
+
+
+def _is_staged(name):
+    """
+    Returns True if name is one crossflow gives staged files (or the files
+    they are uploaded to).
+    """
+    return bool(_STAGED_NAME.fullmatch(name) or _PART_NAME.fullmatch(name))
+
+
+def usage(stage_point=None):
+    """
+    Report how much is stored at a stage point, and update the estimate
+    that config.STAGING_QUOTA is checked against.
+
+    args:
+        stage_point (str, optional): the stage point, config.STAGE_POINT by
+            default
+
+    returns:
+        dict: the number and total size of staged files, of those that are
+            leased by a live process, and the number of live processes
+    """
+    if stage_point is None:
+        stage_point = config.STAGE_POINT
+    _, files, leases, _ = _scan(stage_point)
+    leased = set().union(*leases)
+    live = [info for info in files if op.basename(info["name"]) in leased]
+    TRACKER.record_usage(stage_point, sum(info["size"] for info in files))
+    return {
+        "files": len(files),
+        "bytes": sum(info["size"] for info in files),
+        "live_files": len(live),
+        "live_bytes": sum(info["size"] for info in live),
+        "processes": sum(1 for lease in leases if lease),
+    }
+
+
+def collect(stage_point=None, grace=None):
+    """
+    Delete staged files that are no longer used by any live process.
+
+    args:
+        stage_point (str, optional): the stage point, config.STAGE_POINT by
+            default
+        grace (float, optional): only delete files older than this many
+            seconds, config.STAGING_GRACE by default
+
+    returns:
+        dict: the number of files and bytes deleted
+    """
+    if stage_point is None:
+        stage_point = config.STAGE_POINT
+    if grace is None:
+        grace = config.STAGING_GRACE
+    fs, files, leases, now = _scan(stage_point)
+    leased = set().union(*leases)
+    removed = 0
+    freed = 0
+    remaining = 0
+    for info in files:
+        name = op.basename(info["name"])
+        if name in leased or now - _mtime(fs, info) < grace:
+            remaining += info["size"]
+            continue
+        try:
+            fs.rm(info["name"])
+        except FileNotFoundError:
+            continue
+        removed += 1
+        freed += info["size"]
+    TRACKER.record_usage(stage_point, remaining)
+    return {"files": removed, "bytes": freed}
+
+
+def start_collector(stage_point=None, interval=None):
+    """
+    Start collecting garbage at a stage point in a background thread of
+    this process.
+
+    args:
+        stage_point (str, optional): the stage point, config.STAGE_POINT by
+            default
+        interval (float, optional): seconds between collections,
+            config.STAGING_GC_INTERVAL by default
+    """
+    if stage_point is None:
+        stage_point = config.STAGE_POINT
+    TRACKER.start_collector(stage_point, interval)
@@ -0,0 +1,221 @@
+"""
+streaming.py: publishing output files while a SubprocessTask runs.
+
+A SubprocessTask with stream patterns (see SubprocessTask.set_stream())
+can watch its working directory while its command runs:
+
+    task.run_streamed(publish, *args)
+
+calls publish(name, filehandle) for each file matching one of the
+patterns once that file is complete, i.e. when:
+
+    - a later file (in sorted order) matching the same pattern appears,
+      as when a program writes numbered trajectory chunks;
+    - its size and modification time have not changed for
+      config.STREAM_SETTLE seconds; or
+    - the command finishes successfully.
+
+A file that is rewritten, such as a restart file, is published again each
+time it settles. The directory is checked every config.STREAM_INTERVAL
+seconds.
+
+Client.stream() runs a task this way on a worker. Each file is scattered
+to that worker, and its future is sent to the client through a Dask
+Queue; the OutputStream it returns yields (name, future) pairs as they
+arrive, so downstream tasks can start while the command is still running.
+"""
+
+import glob
+import os
+import os.path as op
+import threading
+import time
+
+from distributed import Queue
+from distributed.worker import get_client, get_worker
+
+from . import config
+
+
+class OutputWatcher:  # pylint: disable=too-many-instance-attributes
+    """
+    Publishes the files matching some glob patterns in a directory as they
+    are completed.
+
+    args:
+        directory (str): the directory to watch
+        patterns (list): glob patterns, relative to directory
+        publish (callable): called with the name (relative to directory)
+            and a FileHandle for each completed file
+        filehandler (FileHandler): loads the files
+        interval (float, optional): seconds between checks,
+            config.STREAM_INTERVAL by default
+        settle (float, optional): seconds a file must stay unchanged to be
+            complete, config.STREAM_SETTLE by default
+
+    """
+
+    def __init__(
+        self, directory, patterns, publish, filehandler, interval=None, settle=None
+    ):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.directory = directory
+        self.patterns = patterns
+        self.publish = publish
+        self.filehandler = filehandler
+        self.interval = config.STREAM_INTERVAL if interval is None else interval
+        self.settle = config.STREAM_SETTLE if settle is None else settle
+        self._seen = {}
+        self._published = {}
+        self._error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+
+    def start(self):
+        """
+        Start watching, on a background thread.
+        """
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop watching, re-raising any error from publishing a file.
+        """
+        self._stop.set()
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def flush(self):
+        """
+        Publish every matching file not yet published in its current state,
+        complete or not. Call this after stop(), once the command has
+        finished.
+        """
+        self._scan(final=True)
+
+    def _watch(self):
+        """
+        Check the directory every interval seconds until stopped.
+        """
+        while not self._stop.wait(self.interval):
+            try:
+                self._scan()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                self._error = e
+                return
+
+    def _scan(self, final=False):
+        """
+        Publish the matching files that are complete (or, if final, all
+        of them) and have changed since they were last published.
+        """
+        now = time.monotonic()
+        for pattern in self.patterns:
+            paths = sorted(glob.glob(op.join(self.directory, pattern)))
+            for i, path in enumerate(paths):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                stamp = (stat.st_size, stat.st_mtime_ns)
+                if self._published.get(path) == stamp:
+                    continue
+                seen = self._seen.get(path)
+                if seen is None or seen[0] != stamp:
+                    self._seen[path] = (stamp, now)
+                    settled = False
+                else:
+                    settled = now - seen[1] >= self.settle
+                if final or settled or i < len(paths) - 1:
+                    filehandle = self.filehandler.load(path, copy=True)
+                    self._published[path] = stamp
+                    self.publish(op.relpath(path, self.directory), filehandle)
+
+
+def watch(directory, patterns, publish, filehandler):
+    """
+    Start an OutputWatcher, if there is anything to publish.
+
+    returns:
+        OutputWatcher or None: the watcher, or None if publish is None or
+            there are no patterns
+    """
+    if publish is None or not patterns:
+        return None
+    return OutputWatcher(directory, patterns, publish, filehandler).start()
+
+
+class QueueSink:
+    """
+    Publishes files from a task running on a Dask worker to the Dask Queue
+    called name: each file is scattered to the worker and sent as its name
+    followed by its future. close() sends None, to mark the end.
+
+    args:
+        name (str): the name of the Queue
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, name, filehandle):
+        client = get_client()
+        future = client.scatter(filehandle, workers=[get_worker().address])
+        queue = Queue(self.name, client=client)
+        queue.put(name)
+        queue.put(future)
+
+    def close(self):
+        """
+        Mark the end of the stream.
+        """
+        Queue(self.name, client=get_client()).put(None)
+
+
+class OutputStream:
+    """
+    The files published by a task run started with Client.stream().
+
+    Iterating over it yields a (name, future) pair for each file as it is
+    published, where the future's result is a FileHandle, and ends once
+    the run has finished (successfully or not). The future (or tuple of
+    futures, one per output) for the run's outputs is in outputs, as
+    returned by Client.submit().
+
+    args:
+        queue (Queue): the Dask Queue the files are sent through
+        outputs (Future or tuple): the futures for the outputs of the run
+        run (Future): the future of the run itself
+
+    """
+
+    def __init__(self, queue, outputs, run):
+        self.queue = queue
+        self.outputs = outputs
+        self.run = run
+
+    def __repr__(self):
+        return f"<OutputStream: {self.run.status}, queue={self.queue.name}>"
+
+    def __iter__(self):
+        while True:
+            try:
+                name = self.queue.get(timeout=config.STREAM_INTERVAL)
+            except TimeoutError:
+                # a run that finished normally always sends the end marker
+                if self.run.done() and self.run.status != "finished":
+                    return
+                continue
+            if name is None:
+                return
+            yield name, self.queue.get()
+
+    def result(self, timeout=None):
+        """
+        Wait for the run to finish and return its outputs.
+        """
+        if isinstance(self.outputs, tuple):
+            return tuple(f.result(timeout) for f in self.outputs)
+        return self.outputs.result(timeout)
@@ -1,20 +1,28 @@
+# pylint: disable=too-many-lines
 """
 tasks.py: wrappers round subprocess calls and python functions for
 execution on a crossflow cluster
 """
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import copy
+import functools
 import glob
 from math import log10
 import os
 import os.path as op
 import re
 import shutil
+import signal
 import subprocess
-import tempfile
+import time
 
-from . import config
-from .filehandling import FileHandler
+from . import config, procpool, resources, sandbox, servers, streaming, timings
+from .capture import OutputCapture, drain
+from .filehandling import FileHandler, link_or_copy
+from .resultcache import default_directory, get_result_cache, task_key
+from .sandbox import workdir  # pylint: disable=unused-import
 
 STDOUT = "STDOUT"
 DEBUGINFO = "DEBUGINFO"
@@ -39,7 +47,170 @@ def _gen_filenames(pattern, n_files):
     return filenames
 
 
-class SubprocessTask:
+def _in_parallel(func, items):
+    """
+    Apply func to each of a list of items on a pool of config.LOAD_THREADS
+    threads (or directly, if there is only one), returning the results in
+    order.
+    """
+    if len(items) < 2:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=config.LOAD_THREADS) as pool:
+        return list(pool.map(func, items))
+
+
+def _input_size(files):
+    """
+    Returns the total size in bytes of a list of (name, FileHandle), as
+    far as it is known.
+    """
+    return sum(getattr(f, "size", None) or 0 for _, f in files)
+
+
+def _stage(files, td):
+    """
+    Put copies of a list of (name, FileHandle) in the directory td, in
+    parallel.
+    """
+    _in_parallel(lambda item: item[1].materialize(op.join(td, item[0])), files)
+
+
+class _LocalFile(str):
+    """
+    The path of a file produced by a step of a TaskChain, which later steps
+    use directly rather than through a FileHandle.
+    """
+
+
+def _place(value, path):
+    """
+    Put a copy of an input file (a FileHandle or a _LocalFile) at path for
+    a step of a TaskChain.
+
+    returns:
+        the _LocalFile for the copy, or value itself if it is not a file
+    """
+    if isinstance(value, _LocalFile):
+        # never a hardlink: the step may change its input in place
+        link_or_copy(value, path, mode="auto")
+        return _LocalFile(path)
+    if hasattr(value, "materialize"):
+        return _LocalFile(value.materialize(path))
+    return value
+
+
+def _completed(command, returncode, out, err):
+    """
+    Returns the record of a finished process; if standard output or error
+    was spilled to a file, only its last config.CAPTURE_SIZE bytes are kept.
+    """
+    stdout = out.tail(config.CAPTURE_SIZE) if out.spilled else out.getvalue()
+    stderr = err.tail(config.CAPTURE_SIZE) if err.spilled else err.getvalue()
+    return subprocess.CompletedProcess(command, returncode, stdout, stderr)
+
+
+def _cancel_check():
+    """
+    Returns a function that reports whether the Dask task this thread is
+    running has been cancelled, or None outside a Dask worker.
+    """
+    try:
+        # pylint: disable=import-outside-toplevel
+        from distributed.worker import get_worker, thread_state
+
+        worker = get_worker()
+        key = thread_state.key
+    except (ImportError, ValueError, AttributeError):
+        return None
+
+    def cancelled():
+        ts = worker.state.tasks.get(key)
+        return ts is None or ts.state in ("cancelled", "released", "forgotten")
+
+    return cancelled
+
+
+def _kill(process):
+    """
+    Kill a process started in its own session, with all its children.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (AttributeError, OSError):
+        process.kill()
+    process.wait()
+
+
+def _wait(process, command, timeout=None, cancelled=None):
+    """
+    Wait for a process to finish, killing it if it runs for more than
+    timeout seconds or if cancelled() becomes True.
+
+    returns:
+        int: the return code
+    """
+    if timeout is None and cancelled is None:
+        return process.wait()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        interval = config.CANCEL_POLL_INTERVAL
+        if deadline is not None:
+            interval = max(0.0, min(interval, deadline - time.monotonic()))
+        try:
+            return process.wait(timeout=interval)
+        except subprocess.TimeoutExpired:
+            pass
+        if deadline is not None and time.monotonic() >= deadline:
+            _kill(process)
+            raise TaskTimeoutError(command, timeout)
+        if cancelled is not None and cancelled():
+            _kill(process)
+            raise TaskCancelledError(f'Error: command "{command}" was cancelled')
+
+
+async def _kill_async(process):
+    """
+    Kill an asyncio subprocess started in its own session, with all its
+    children.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    except AttributeError:
+        # no process groups (e.g. on Windows)
+        process.kill()
+    await process.wait()
+
+
+async def _drain_async(stream, output):
+    """
+    Copy everything from an asyncio stream into an OutputCapture.
+    """
+    while True:
+        chunk = await stream.read(64 * 1024)
+        if not chunk:
+            break
+        output.write(chunk)
+
+
+def _run_with_retries(run_once, args, retries, retry_on, delay):
+    """
+    Call run_once(*args), retrying up to retries times, after delay
+    seconds (doubling each time), if it raises one of the exceptions in
+    retry_on.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return run_once(*args)
+        except retry_on:
+            if attempt == retries:
+                raise
+            time.sleep(delay * 2**attempt)
+    return None
+
+
+class SubprocessTask:  # pylint: disable=too-many-instance-attributes
     """
     A task that runs a command-line executable
 
@@ -47,7 +218,17 @@ class SubprocessTask:
         set_inputs: set the inputs the task requires
         set_outputs: set the outputs the task produces
         set_constant: set a constant for the task
+        set_cache: turn caching of results on or off
+        set_capture: choose how standard output and error are captured
+        set_resources: declare the resources each run needs
+        set_timeout: set a time limit for each run
+        set_retries: retry runs that fail with transient errors
+        set_executor: choose between blocking and asyncio execution
+        set_stream: choose output files to publish while the task runs
         run: execute the task
+        run_async: execute the task, as a coroutine
+        run_streamed: execute the task, publishing output files as they
+            are completed
 
     """
 
@@ -62,6 +243,16 @@ class SubprocessTask:
         self.outputs = []
         self.constants = []
         self.stdout = None
+        self.cache_dir = None
+        self.stdout_filehandle = False
+        self.stderr_tail = None
+        self.resources = {}
+        self.timeout = None
+        self.retries = 0
+        self.retry_on = None
+        self.retry_delay = 1.0
+        self.executor = "thread"
+        self.stream_patterns = []
         self.filehandler = FileHandler(config.STAGE_POINT)
 
         self.variables = []
@@ -120,15 +311,269 @@ class SubprocessTask:
         if key in self.inputs:
             self.inputs.remove(key)
 
+    def set_cache(self, cache):
+        """
+        Turn caching of results on or off
+
+        With caching on, results are stored in a persistent ResultCache,
+        keyed by the template, the variable values and the content of the
+        input files; a run that matches a stored result returns it without
+        launching the subprocess. See crossflow.resultcache.
+
+        args:
+            cache (bool or str): True to cache results in the default cache
+                directory, a path to cache them there, or False to turn
+                caching off
+
+        """
+        if cache is True:
+            self.cache_dir = default_directory()
+        elif not cache:
+            self.cache_dir = None
+        else:
+            self.cache_dir = os.fspath(cache)
+
+    def set_capture(self, stdout_filehandle=False, stderr_tail=None):
+        """
+        Choose how standard output and error are captured
+
+        Each is held in memory up to config.CAPTURE_SIZE bytes while the
+        command runs, and spilled to a file beyond that. A STDOUT output is
+        always a string, read back from the file if need be, unless
+        stdout_filehandle is True.
+
+        args:
+            stdout_filehandle (bool): if True, the STDOUT output is returned
+                as a FileHandle rather than a string, so it never has to be
+                held in memory
+            stderr_tail (int, optional): keep only the last stderr_tail
+                kilobytes of standard error (config.STDERR_TAIL by default)
+
+        """
+        self.stdout_filehandle = stdout_filehandle
+        self.stderr_tail = stderr_tail
+
+    def set_resources(self, cores=None, memory=None, **others):
+        """
+        Declare the resources each run of the task needs
+
+        These become Dask worker resources when the task is submitted, see
+        crossflow.resources. A task that declares cores runs with
+        OMP_NUM_THREADS (etc.) set to that number, pinned to that many
+        cores if config.PIN_THREADS is True.
+
+        args:
+            cores (int, optional): the number of CPU cores
+            memory (int or str, optional): the memory, e.g. "16GB"
+            others: any other resources, e.g. scratch=1
+
+        """
+        self.resources = resources.dask_resources(cores, memory, **others)
+
+    def set_timeout(self, timeout):
+        """
+        Set a time limit for each run
+
+        A run that takes longer is killed, with any processes it started,
+        and raises a TaskTimeoutError.
+
+        args:
+            timeout (float or None): the limit in seconds, or None for no
+                limit
+
+        """
+        self.timeout = timeout
+
+    def set_retries(self, retries, retry_on=None, delay=1.0):
+        """
+        Retry runs that fail with transient errors
+
+        Errors from the command itself (CalledProcessError) are not
+        retried unless they are included in retry_on.
+
+        args:
+            retries (int): the maximum number of retries
+            retry_on (tuple, optional): the exception types to retry,
+                (TaskTimeoutError, OSError) by default
+            delay (float, optional): seconds to wait before the first retry,
+                doubled for each one after
+
+        """
+        self.retries = retries
+        self.retry_on = retry_on
+        self.retry_delay = delay
+
+    def set_executor(self, executor):
+        """
+        Choose how Client.submit() and Client.map() run the task
+
+        With "async", Dask runs run_async() on the worker's event loop, so
+        a worker thread is not blocked for the lifetime of each command
+        and a worker can drive as many commands as it has task slots (its
+        --nthreads) and resources for.
+
+        args:
+            executor (str): "thread" (run(), the default) or "async"
+
+        """
+        if executor not in ("thread", "async"):
+            raise ValueError(
+                f'Error - executor must be "thread" or "async", not {executor}'
+            )
+        self.executor = executor
+
+    def set_stream(self, patterns):
+        """
+        Choose output files to publish while the task runs
+
+        With run_streamed() (or Client.stream()), each file in the working
+        directory matching one of the patterns is published as soon as it
+        is complete, see crossflow.streaming. The patterns need not be
+        among the outputs.
+
+        args:
+            patterns (list): glob patterns for the files, e.g. ["md_*.xtc"]
+
+        """
+        if not isinstance(patterns, list):
+            raise TypeError(
+                f"Error - patterns must be of type list, not of type {type(patterns)}"
+            )
+        self.stream_patterns = patterns
+
     def copy(self):
         """
         Return a copy of the task
         """
         return copy.deepcopy(self)
 
+    def _launch_settings(self, command):
+        """
+        Work out how to launch a command according to the declared cores.
+
+        returns:
+            tuple: (Popen args, environment or None, reserved cores or None);
+                the args are command itself if it should run with shell=True
+        """
+        cores = self.resources.get("cores")
+        if cores is None:
+            return command, None, None
+        env = resources.thread_environment(cores)
+        pinned = resources.ALLOCATOR.acquire(cores) if config.PIN_THREADS else None
+        if pinned is None:
+            return command, env, None
+        return resources.pinned_command(command, pinned) or command, env, pinned
+
+    def _captures(self):
+        """
+        Returns OutputCaptures for the standard output and standard error
+        of a run. They spill to disk, in config.SCRATCH_ROOT (or the system
+        temporary directory), never in a RAM-backed scratch root.
+        """
+        tail = config.STDERR_TAIL if self.stderr_tail is None else self.stderr_tail
+        spill_dir = sandbox.choose_root()
+        out = OutputCapture(
+            limit=0 if self.stdout_filehandle else config.CAPTURE_SIZE,
+            directory=spill_dir,
+        )
+        err = OutputCapture(
+            limit=config.CAPTURE_SIZE,
+            directory=spill_dir,
+            tail=None if tail is None else int(tail * 1024),
+        )
+        return out, err
+
+    def _execute(self, command, td):
+        """
+        Run a command in a working directory, capturing its output.
+
+        If standard output or error is spilled to a file, only its last
+        config.CAPTURE_SIZE bytes are kept in the returned process record.
+
+        args:
+            command (str): the command line
+            td (str): the working directory
+
+        returns:
+            tuple: (subprocess.CompletedProcess, OutputCapture of stdout)
+        """
+        out, err = self._captures()
+        args, env, pinned = self._launch_settings(command)
+        cancelled = _cancel_check()
+        killable = self.timeout is not None or cancelled is not None
+        try:
+            with subprocess.Popen(
+                args,
+                shell=args is command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=td,
+                env=env,
+                start_new_session=killable,
+            ) as process:
+                if pinned is not None and args is command:
+                    resources.pin(process.pid, pinned)
+                threads = [
+                    drain(process.stdout, out),
+                    drain(process.stderr, err),
+                ]
+                try:
+                    returncode = _wait(process, command, self.timeout, cancelled)
+                finally:
+                    for thread in threads:
+                        thread.join()
+            return _completed(command, returncode, out, err), out
+        except BaseException:
+            out.close()
+            raise
+        finally:
+            err.close()
+            resources.ALLOCATOR.release(pinned)
+
+    async def _execute_async(self, command, td):
+        """
+        Run a command in a working directory, capturing its output, as
+        _execute() does, but without blocking the event loop.
+        """
+        out, err = self._captures()
+        args, env, pinned = self._launch_settings(command)
+        options = {
+            "stdout": subprocess.PIPE,
+            "stderr": subprocess.PIPE,
+            "cwd": td,
+            "env": env,
+            "start_new_session": True,
+        }
+        try:
+            # the platform's shell, as with shell=True in _execute()
+            if args is command:
+                process = await asyncio.create_subprocess_shell(command, **options)
+            else:
+                process = await asyncio.create_subprocess_exec(*args, **options)
+            if pinned is not None and args is command:
+                resources.pin(process.pid, pinned)
+            drains = asyncio.gather(
+                _drain_async(process.stdout, out), _drain_async(process.stderr, err)
+            )
+            try:
+                returncode = await asyncio.wait_for(process.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                await _kill_async(process)
+                raise TaskTimeoutError(command, self.timeout) from None
+            except asyncio.CancelledError:
+                await _kill_async(process)
+                raise
+            finally:
+                await drains
+            return _completed(command, returncode, out, err), out
+        except BaseException:
+            out.close()
+            raise
+        finally:
+            err.close()
+            resources.ALLOCATOR.release(pinned)
+
     def run(self, *args):
-        # pylint: disable=too-many-branches
-        # pylint: disable=too-many-statements
         """
         Run the task with the given inputs.
         Args:
@@ -138,77 +583,477 @@ class SubprocessTask:
             tuple : outputs in the order they appear in
                 self.outputs
         """
-        outputs = []
-        td = tempfile.mkdtemp()
+        retry_on = self.retry_on or (TaskTimeoutError, OSError)
+        return _run_with_retries(
+            self._run_once, args, self.retries, retry_on, self.retry_delay
+        )
+
+    def run_streamed(self, publish, *args):
+        """
+        Run the task with the given inputs, publishing files that match its
+        stream patterns (see set_stream()) while the command runs.
+
+        Streamed runs do not look for a result in the cache (though a
+        successful run is still stored), and a retried run publishes its
+        files again.
+
+        Args:
+            publish (callable): called with the name and a FileHandle for
+                each completed file
+            args: positional arguments whose order should match self.inputs
+
+        Returns:
+            tuple : outputs in the order they appear in
+                self.outputs
+        """
+        retry_on = self.retry_on or (TaskTimeoutError, OSError)
+        return _run_with_retries(
+            functools.partial(self._run_once, publish=publish),
+            args,
+            self.retries,
+            retry_on,
+            self.retry_delay,
+        )
+
+    async def run_async(self, *args):
+        """
+        Run the task with the given inputs, as a coroutine.
+
+        The command runs as an asyncio subprocess, and file staging and
+        output ingestion run on other threads, so one event loop can drive
+        many runs at once. Client.submit() and Client.map() use this for
+        tasks set to the "async" executor, see set_executor().
+
+        Args:
+            args: positional arguments whose order should match self.inputs
+
+        Returns:
+            tuple : outputs in the order they appear in
+                self.outputs
+        """
+        retry_on = self.retry_on or (TaskTimeoutError, OSError)
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._run_once_async(*args)
+            except retry_on:
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(self.retry_delay * 2**attempt)
+        return None
+
+    def _run_once(self, *args, publish=None):
+        """
+        Run the task once with the given inputs, passing completed stream
+        files to publish, if given.
+        """
+        profile = timings.Profile()
+        try:
+            with profile.phase("inputs"):
+                var_dict, files, constants = self._resolve_inputs(args)
+                cache, key, cached = self._check_cache(var_dict, files + constants)
+            if cached is not None and publish is None:
+                return cached
+            collected = self._run_in_sandbox(
+                var_dict, files, constants, publish, profile
+            )
+            with profile.phase("stage_out"):
+                return self._finish(collected, cache, key)
+        finally:
+            profile.finish()
+
+    def _run_in_sandbox(
+        self, var_dict, files, constants, publish, profile
+    ):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """
+        Stage the input files in a working directory from the sandbox pool,
+        run the command there, and collect its outputs, as _collect_outputs()
+        returns them.
+        """
+        pool = sandbox.get_pool()
+        with profile.phase("sandbox"):
+            td = pool.acquire(sandbox.choose_root(_input_size(files + constants)))
+        try:
+            with profile.phase("stage_in"):
+                _stage(files, td)
+            with profile.phase("constants"):
+                _stage(constants, td)
+            with profile.phase("execute"):
+                watcher = streaming.watch(
+                    td, self.stream_patterns, publish, self.filehandler
+                )
+                try:
+                    result, out = self._execute(self._command(var_dict, td), td)
+                finally:
+                    if watcher is not None:
+                        watcher.stop()
+            with profile.phase("stage_out"):
+                collected = self._collect_outputs(result, out, td, profile)
+                if watcher is not None and result.returncode == 0:
+                    watcher.flush()
+        finally:
+            with profile.phase("cleanup"):
+                pool.release(td)
+        return collected
+
+    async def _run_once_async(self, *args):
+        """
+        Run the task once with the given inputs, as a coroutine.
+        """
+        profile = timings.Profile()
+        try:
+            with profile.phase("inputs"):
+                var_dict, files, constants = await asyncio.to_thread(
+                    self._resolve_inputs, args
+                )
+                cache, key, cached = await asyncio.to_thread(
+                    self._check_cache, var_dict, files + constants
+                )
+            if cached is not None:
+                return cached
+            pool = sandbox.get_pool()
+            with profile.phase("sandbox"):
+                td = pool.acquire(sandbox.choose_root(_input_size(files + constants)))
+            try:
+                with profile.phase("stage_in"):
+                    await asyncio.to_thread(_stage, files, td)
+                with profile.phase("constants"):
+                    await asyncio.to_thread(_stage, constants, td)
+                with profile.phase("execute"):
+                    command = self._command(var_dict, td)
+                    result, out = await self._execute_async(command, td)
+                with profile.phase("stage_out"):
+                    collected = await asyncio.to_thread(
+                        self._collect_outputs, result, out, td, profile
+                    )
+            finally:
+                with profile.phase("cleanup"):
+                    pool.release(td)
+            with profile.phase("stage_out"):
+                return await asyncio.to_thread(self._finish, collected, cache, key)
+        finally:
+            profile.finish()
+
+    def _resolve_inputs(self, args):
+        """
+        Sort the arguments of a run into template variables and input
+        files, loading any files given as paths.
+
+        returns:
+            tuple: (dict of variables, list of (name, FileHandle) for the
+                inputs, and the same for the constants)
+        """
         var_dict = {}
+        files = []
         for i, arg in enumerate(args):
             if self.inputs[i] in self.variables:
                 var_dict[self.inputs[i]] = arg
+            elif isinstance(arg, list):
+                files.extend(zip(_gen_filenames(self.inputs[i], len(arg)), arg))
             else:
-                if isinstance(args[i], list):
-                    fnames = _gen_filenames(self.inputs[i], len(args[i]))
-                    for j, f in enumerate(args[i]):
-                        if not hasattr(f, "save"):
-                            f = self.filehandler.load(f)
-                        f.save(op.join(td, fnames[j]))
-                else:
-                    f = args[i]
-                    if not hasattr(f, "save"):
-                        f = self.filehandler.load(f)
-                    f.save(op.join(td, self.inputs[i]))
+                files.append((self.inputs[i], arg))
+        unloaded = [f for _, f in files if not hasattr(f, "materialize")]
+        if unloaded:
+            loaded = iter(self.filehandler.load_many(unloaded))
+            files = [
+                (name, f if hasattr(f, "materialize") else next(loaded))
+                for name, f in files
+            ]
+        constants = []
         for d in self.constants:
-            if hasattr(d["value"], "result"):
-                dtmp = d["value"].result()
-                if hasattr(dtmp, "save"):
-                    dtmp.save(op.join(td, d["name"]))
-                else:
-                    var_dict[d["name"]] = dtmp
+            value = d["value"]
+            if hasattr(value, "result"):
+                value = value.result()
+            if hasattr(value, "materialize"):
+                constants.append((d["name"], value))
             else:
-                try:
-                    d["value"].save(op.join(td, d["name"]))
-                except AttributeError:
-                    var_dict[d["name"]] = d["value"]
+                var_dict[d["name"]] = value
+        return var_dict, files, constants
+
+    def _command(self, var_dict, td):  # pylint: disable=unused-argument
+        """
+        Returns the command line for a run with the variables var_dict in
+        the working directory td.
+        """
+        return self.template.format(**var_dict)
+
+    def _cache_template(self):
+        """
+        Returns the text that identifies the task in result cache keys.
+        """
+        return self.template
+
+    def _check_cache(self, var_dict, files):
+        """
+        Look a run up in the result cache, if the task has one.
+
+        returns:
+            tuple: (ResultCache or None, key, cached outputs or None)
+        """
+        if self.cache_dir is None:
+            return None, None, None
+        cache = get_result_cache(self.cache_dir)
+        key = task_key(self._cache_template(), var_dict, files, self.outputs)
+        cached = cache.get(key, self.filehandler)
+        if cached is None:
+            return cache, key, None
+        outputs, self.stdout = cached
+        return cache, key, outputs
+
+    def _collect_outputs(self, result, out, td, profile, load=True):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        # pylint: disable=too-many-branches
+        """
+        Turn the finished process and the files it left in td into the
+        task's outputs. The process record (or error) gets the timings of
+        profile as its timings attribute. If load is False, output files
+        are left in td and returned as _LocalFiles rather than loaded.
+
+        returns:
+            tuple: (the process record or CalledProcessError, list of
+                outputs, standard output)
+        """
         try:
-            result = subprocess.run(
-                self.template.format(**var_dict),
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                cwd=td,
-                check=True,
-            )
-        except subprocess.CalledProcessError as e:
-            result = CalledProcessError(e)
-            if DEBUGINFO not in self.outputs:
-                raise result  # pylint: disable=raise-missing-from
+            if result.returncode != 0:
+                result = CalledProcessError(
+                    subprocess.CalledProcessError(
+                        result.returncode, result.args, result.stdout, result.stderr
+                    )
+                )
+            result.timings = profile.times
+            if result.returncode != 0 and DEBUGINFO not in self.outputs:
+                raise result
+            if self.stdout_filehandle and not load:
+                stdout = _LocalFile(shutil.move(out.to_file(), op.join(td, STDOUT)))
+            elif self.stdout_filehandle:
+                stdout = self.filehandler.load(out.to_file(), copy=True)
+            elif not out.spilled or STDOUT in self.outputs:
+                # the STDOUT output is a string whatever its size
+                stdout = out.getvalue().decode()
+            else:
+                stdout = None
+        finally:
+            out.close()
+        # concurrent runs of this task can overwrite self.stdout, so the
+        # outputs use the local copy
+        self.stdout = stdout
 
-        self.stdout = result.stdout.decode()
+        # find every output file first, so they are all loaded in parallel
+        paths = []
         for outfile in self.outputs:
             if outfile not in [STDOUT, DEBUGINFO]:
                 outfile = op.join(td, outfile)
             if "*" in outfile or "?" in outfile:
-                outputs.append(
-                    [self.filehandler.load(f) for f in sorted(glob.glob(outfile))]
-                )
+                paths.append(sorted(glob.glob(outfile)))
+            elif op.exists(outfile):
+                paths.append(outfile)
             else:
-                if op.exists(outfile):
-                    outputs.append(self.filehandler.load(outfile))
-                elif outfile == STDOUT:
-                    outputs.append(self.stdout)
-                elif outfile == DEBUGINFO:
-                    outputs.append(result)
-                else:
-                    outputs.append(None)
-        shutil.rmtree(td, ignore_errors=True)
+                paths.append(None)
+        flat = []
+        for path in paths:
+            if isinstance(path, list):
+                flat.extend(path)
+            elif path is not None:
+                flat.append(path)
+        if not load:
+            handles = iter(_LocalFile(path) for path in flat)
+        else:
+            handles = iter(self.filehandler.load_many(flat, copy=True) if flat else [])
+        outputs = []
+        for outfile, path in zip(self.outputs, paths):
+            if isinstance(path, list):
+                outputs.append([next(handles) for _ in path])
+            elif path is not None:
+                outputs.append(next(handles))
+            elif outfile == STDOUT:
+                outputs.append(stdout)
+            elif outfile == DEBUGINFO:
+                outputs.append(result)
+            else:
+                outputs.append(None)
+        return result, outputs, stdout
+
+    def _run_step(self, values, sd, profile):
+        """
+        Run the task once as a step of a TaskChain, in the directory sd.
+
+        args:
+            values (dict): the value of each input; files are FileHandles
+                or _LocalFiles (or lists of them, for wildcard inputs)
+            sd (str): the working directory
+            profile (Profile): the timings of the chain's run
+
+        returns:
+            list: the outputs, with output files left in sd as _LocalFiles
+        """
+        var_dict = {}
+        for name in self.inputs:
+            value = values[name]
+            if name in self.variables:
+                var_dict[name] = value
+            elif isinstance(value, list):
+                for filename, item in zip(_gen_filenames(name, len(value)), value):
+                    _place(item, op.join(sd, filename))
+            else:
+                _place(value, op.join(sd, name))
+        for d in self.constants:
+            value = d["value"]
+            if hasattr(value, "result"):
+                value = value.result()
+            if hasattr(value, "materialize"):
+                value.materialize(op.join(sd, d["name"]))
+            else:
+                var_dict[d["name"]] = value
+        result, out = self._execute(self._command(var_dict, sd), sd)
+        _, outputs, _ = self._collect_outputs(result, out, sd, profile, load=False)
+        return outputs
 
+    def _finish(self, collected, cache, key):
+        """
+        Shape the outputs of a run, from _collect_outputs(), for returning,
+        storing them in the result cache if there is one and the run
+        succeeded.
+        """
+        result, outputs, stdout = collected
         if len(outputs) == 1:
             outputs = outputs[0]
         else:
             outputs = tuple(outputs)
+        if cache is not None and result.returncode == 0:
+            cache.put(key, outputs, stdout)
         return outputs
 
 
-class FunctionTask:
+class ServerTask(SubprocessTask):
+    """
+    A task that sends each run, as a request, to a long-lived command-line
+    tool, so the tool's startup cost is paid once per worker thread rather
+    than once per run, see crossflow.servers.
+
+    The request is made from the template as a SubprocessTask's command
+    line is, with {workdir} replaced by the run's own working directory,
+    where its input files are staged and its output files are looked for;
+    the tool runs elsewhere, so the request must give their full paths.
+    The response is the STDOUT output. A tool that exits is restarted for
+    the next run.
+
+    Methods:
+        set_protocol: choose how requests and responses are exchanged
+        and those of SubprocessTask, except set_executor (only "thread")
+        and set_stream
+
+    """
+
+    def __init__(self, command, template):
+        """
+        Initialize the ServerTask.
+        args:
+            command (str): the command line that starts the tool
+            template (str): a template for each request
+        """
+        super().__init__(template)
+        self.command = command
+        self.transport = "stdio"
+        self.terminator = None
+        self.ready = None
+        self.error = None
+
+    def set_protocol(self, terminator=None, ready=None, error=None, transport="stdio"):
+        """
+        Choose how requests and responses are exchanged
+
+        args:
+            terminator (str, optional): a line the tool prints after each
+                response; without one, a response is a single line (stdio)
+                or everything the tool sends before closing the connection
+                (socket)
+            ready (str, optional): a line the tool prints once it has
+                started and is ready for requests (stdio only)
+            error (str, optional): a regular expression; a response with a
+                line matching it fails, as a command with a non-zero exit
+                status would
+            transport (str, optional): "stdio" to write requests to the
+                tool's standard input and read responses from its standard
+                output, or "socket" to send each over a new connection to
+                the Unix socket whose path replaces {socket} in the command
+
+        """
+        if transport not in ("stdio", "socket"):
+            raise ValueError(
+                f'Error - transport must be "stdio" or "socket", not {transport}'
+            )
+        if transport == "socket" and "{socket}" not in self.command:
+            raise ValueError("Error - the command must contain {socket}")
+        self.terminator = terminator
+        self.ready = ready
+        self.error = error
+        self.transport = transport
+
+    def set_executor(self, executor):
+        """
+        ServerTasks only run in worker threads.
+        """
+        if executor != "thread":
+            raise ValueError(f'Error - executor must be "thread", not {executor}')
+        self.executor = executor
+
+    def set_stream(self, patterns):
+        """
+        ServerTasks do not stream their outputs.
+        """
+        raise TypeError("Error - ServerTasks cannot stream their outputs")
+
+    async def run_async(self, *args):
+        """
+        Run the task with the given inputs, as a coroutine, on another
+        thread.
+        """
+        return await asyncio.to_thread(self.run, *args)
+
+    def _command(self, var_dict, td):
+        if not self.template.endswith("\n"):
+            return self.template.format(workdir=td, **var_dict) + "\n"
+        return self.template.format(workdir=td, **var_dict)
+
+    def _cache_template(self):
+        return f"{self.command}\n{self.template}"
+
+    def _execute(self, command, td):
+        """
+        Send a request to a server for the task's tool, capturing the
+        response as standard output.
+
+        returns:
+            tuple: (subprocess.CompletedProcess, OutputCapture of stdout)
+        """
+        env = None
+        if self.resources.get("cores") is not None:
+            env = resources.thread_environment(self.resources["cores"])
+        pool = servers.get_pool()
+        server = None
+        broken = True
+        try:
+            server = pool.acquire(self.command, self.transport, self.ready, env)
+            response = server.request(command, self.terminator, self.timeout)
+            broken = False
+        except TimeoutError:
+            raise TaskTimeoutError(command, self.timeout) from None
+        except ConnectionError as e:
+            raise ServerError(str(e)) from e
+        finally:
+            if server is not None:
+                pool.release(server, broken)
+        returncode = 0
+        if self.error is not None and re.search(
+            self.error, response.decode(errors="replace"), re.MULTILINE
+        ):
+            returncode = 1
+        out, err = self._captures()
+        out.write(response)
+        err.close()
+        return _completed(command, returncode, out, err), out
+
+
+class FunctionTask:  # pylint: disable=too-many-instance-attributes
     """
     A task that runs a function
     """
@@ -224,6 +1069,12 @@ class FunctionTask:
         self.outputs = []
         self.constants = {}
         self.tmpdir = None
+        self.resources = {}
+        self.retries = 0
+        self.retry_on = None
+        self.retry_delay = 1.0
+        self.executor = "thread"
+        self.chdir = False
         self.filehandler = FileHandler(config.STAGE_POINT)
 
     def __call__(self, *args):
@@ -263,6 +1114,84 @@ class FunctionTask:
         except IOError:
             self.constants[key] = value
 
+    def set_resources(self, cores=None, memory=None, **others):
+        """
+        Declare the resources each run of the task needs
+
+        These become Dask worker resources when the task is submitted, see
+        crossflow.resources.
+
+        args:
+            cores (int, optional): the number of CPU cores
+            memory (int or str, optional): the memory, e.g. "16GB"
+            others: any other resources, e.g. scratch=1
+
+        """
+        self.resources = resources.dask_resources(cores, memory, **others)
+
+    def set_retries(self, retries, retry_on=None, delay=1.0):
+        """
+        Retry runs that fail with transient errors
+
+        args:
+            retries (int): the maximum number of retries
+            retry_on (tuple, optional): the exception types to retry,
+                (OSError,) by default
+            delay (float, optional): seconds to wait before the first retry,
+                doubled for each one after
+
+        """
+        self.retries = retries
+        self.retry_on = retry_on
+        self.retry_delay = delay
+
+    def set_executor(self, executor):
+        """
+        Choose where the function runs
+
+        With "process", the function runs in a warm pool of processes in
+        each worker, so functions that hold the GIL can run in parallel,
+        see crossflow.procpool.
+
+        args:
+            executor (str): "thread" (the worker thread, the default) or
+                "process"
+
+        """
+        if executor not in ("thread", "process"):
+            raise ValueError(
+                f'Error - executor must be "thread" or "process", not {executor}'
+            )
+        self.executor = executor
+
+    def set_chdir(self, chdir):
+        """
+        Choose whether the function runs with its working directory as the
+        current directory
+
+        By default the function should write its files in workdir();
+        relative paths it returns are taken to be relative to that. A
+        function that writes files relative to the current directory needs
+        chdir True, but a worker process has only one current directory,
+        so such functions run one at a time in each worker (runs with the
+        "process" executor each have a process of their own).
+
+        args:
+            chdir (bool): True to change directory for each run, False (the
+                default) to leave the current directory alone
+
+        """
+        self.chdir = chdir
+
+    def _directory(self, td):
+        """
+        Returns a context manager that runs the function in the directory
+        td in this thread, as set_chdir() chose.
+        """
+        if self.chdir:
+            return sandbox.current_directory(td)
+        return sandbox.working_directory(td)
+
     def copy(self):
         """
         Return a copy of the task
@@ -270,7 +1199,6 @@ class FunctionTask:
         return copy.copy(self)
 
     def run(self, *args):
-        # pylint: disable=too-many-branches
         """
         Run the task/function with the given arguments.
 
@@ -278,59 +1206,351 @@ class FunctionTask:
             Whatever the function returns, with output files converted
                 to FileHandle objects
         """
-        od = os.getcwd()
-        td = tempfile.mkdtemp()
-        os.chdir(td)
-        indict = {}
-        for i, v in enumerate(args):
-            if isinstance(v, dict):
-                for k in v:
-                    if k in self.inputs:
-                        f = v[k]
-                        try:
-                            f = self.filehandler.load(f)
-                        except IOError:
-                            pass
-                        try:
-                            indict[k] = f.save(os.path.basename(v[k].path))
-                        except AttributeError:
-                            indict[k] = f
-            else:
-                try:
-                    v = self.filehandler.load(v)
-                except IOError:
-                    pass
-                try:
-                    indict[self.inputs[i]] = v.save(os.path.basename(v.path))
-                except AttributeError:
-                    indict[self.inputs[i]] = v
-        for k in self.constants:  # pylint: disable=consider-using-dict-items
-            try:
-                indict[k] = self.constants[k].save(
-                    os.path.basename(self.constants[k].path)
-                )
-            except AttributeError:
-                indict[k] = self.constants[k]
-        result = self.func(**indict)
-        if not isinstance(result, list):
-            result = [result]
-        outputs = []
-        for i, v in enumerate(result):
-            if isinstance(v, str):
-                if os.path.exists(v):
-                    outputs.append(self.filehandler.load(v))
+        return _run_with_retries(
+            self._run_once,
+            args,
+            self.retries,
+            self.retry_on or (OSError,),
+            self.retry_delay,
+        )
+
+    def _run_once(self, *args):
+        # pylint: disable=too-many-branches
+        """
+        Run the task/function once with the given arguments.
+
+        The function runs in a working directory of its own, which it can
+        find with workdir(), and which is also its current directory if
+        set_chdir(True) was called. Input files are copied there and passed as
+        absolute paths. Returned strings that name files relative to it
+        (or absolute paths) become FileHandles.
+        """
+        profile = timings.Profile()
+        pool = sandbox.get_pool()
+        with profile.phase("sandbox"):
+            td = pool.acquire(sandbox.choose_root())
+        function_pool = self._function_pool()
+        staged = []
+        try:
+            indict = {}
+            with profile.phase("stage_in"):
+                for i, v in enumerate(args):
+                    if isinstance(v, dict):
+                        for k in v:
+                            if k in self.inputs:
+                                indict[k] = self._stage_input(v[k], td, staged)
+                    else:
+                        indict[self.inputs[i]] = self._stage_input(v, td, staged)
+            with profile.phase("constants"):
+                for k in self.constants:  # pylint: disable=consider-using-dict-items
+                    indict[k] = self._stage_input(self.constants[k], td, staged)
+            with profile.phase("execute"):
+                if function_pool is None:
+                    with self._directory(td):
+                        result = self.func(**indict)
                 else:
-                    outputs.append(v)
-            else:
-                outputs.append(v)
-            shutil.rmtree(td, ignore_errors=True)
-        os.chdir(od)
+                    result = function_pool.call(self.func, indict, td)
+            if not isinstance(result, list):
+                result = [result]
+            outputs = []
+            with profile.phase("stage_out"):
+                for v in result:
+                    if isinstance(v, str) and v and op.exists(op.join(td, v)):
+                        outputs.append(self.filehandler.load(op.join(td, v), copy=True))
+                    else:
+                        outputs.append(v)
+        finally:
+            with profile.phase("cleanup"):
+                for filehandle in staged:
+                    function_pool.unstage(filehandle)
+                pool.release(td)
+            profile.finish()
         if len(outputs) == 1:
             outputs = outputs[0]
         else:
             outputs = tuple(outputs)
         return outputs
 
+    def _run_step(self, values, sd, profile):  # pylint: disable=unused-argument
+        """
+        Run the function once as a step of a TaskChain, in the directory sd.
+
+        args:
+            values (dict): the value of each input; files are FileHandles
+                or _LocalFiles
+            sd (str): the working directory
+            profile (Profile): the timings of the chain's run
+
+        returns:
+            list: the outputs, with output files left in sd as _LocalFiles
+        """
+        indict = {}
+        for name, value in [(n, values[n]) for n in self.inputs] + list(
+            self.constants.items()
+        ):
+            if hasattr(value, "materialize") or isinstance(value, _LocalFile):
+                basename = op.basename(getattr(value, "path", value))
+                value = _place(value, op.join(sd, basename))
+            indict[name] = value
+        function_pool = self._function_pool()
+        if function_pool is None:
+            with self._directory(sd):
+                result = self.func(**indict)
+        else:
+            result = function_pool.call(self.func, indict, sd)
+        if not isinstance(result, list):
+            result = [result]
+        return [
+            (
+                _LocalFile(op.join(sd, v))
+                if isinstance(v, str) and v and op.exists(op.join(sd, v))
+                else v
+            )
+            for v in result
+        ]
+
+    def _function_pool(self):
+        """
+        Returns the process pool to run the function in, or None to run it
+        in this thread.
+        """
+        if self.executor != "process":
+            return None
+        return procpool.get_pool()
+
+    def _stage_input(self, value, td, staged):
+        """
+        Returns the absolute path of a copy of an input file in the working
+        directory td (or, with the process executor, in the process pool's
+        staging directory, adding it to the list staged), or the value
+        itself if it is not a file.
+        """
+        try:
+            value = self.filehandler.load(value)
+        except IOError:
+            pass
+        if not hasattr(value, "materialize"):
+            return value
+        function_pool = self._function_pool()
+        if function_pool is None:
+            return value.materialize(op.join(td, op.basename(value.path)))
+        path = function_pool.stage(value)
+        staged.append(value)
+        return path
+
+
+class TaskChain:
+    """
+    A task that runs several SubprocessTasks and FunctionTasks one after
+    another on one worker, passing the files each step produces to the
+    steps after it by path, so only the chain's inputs and final outputs
+    go through FileHandles.
+
+    Each step's inputs are taken, by name, from the chain's inputs and the
+    outputs of the steps before it (the latest, if several have the same
+    name). Each step runs in a directory of its own inside the chain's
+    working directory, and with its own time limit and retries.
+
+    Methods:
+        add_step: add a task to the end of the chain
+        set_inputs: set the inputs the chain requires
+        set_outputs: set the outputs the chain produces
+        run: execute the chain
+
+    """
+
+    def __init__(self, steps=None):
+        """
+        Initialize the TaskChain.
+        args:
+            steps (list, optional): the tasks to run, in order
+        """
+        self.steps = []
+        self.inputs = []
+        self.outputs = []
+        self.filehandler = FileHandler(config.STAGE_POINT)
+        for task in steps or []:
+            self.add_step(task)
+
+    def __call__(self, *args):
+        return self.run(*args)
+
+    def add_step(self, task, links=None):
+        """
+        Add a task to the end of the chain
+
+        args:
+            task (SubprocessTask or FunctionTask): the task
+            links (dict, optional): for inputs of the task whose values
+                come from a chain input or an earlier output with a
+                different name, that name, e.g. {"input.gro": "min.gro"}
+
+        """
+        if not isinstance(task, (SubprocessTask, FunctionTask)):
+            raise TypeError(
+                f"Error - steps must be SubprocessTasks or FunctionTasks, not {type(task)}"
+            )
+        self.steps.append((task, dict(links or {})))
+
+    def set_inputs(self, inputs):
+        """
+        Set the inputs the chain requires
+
+        args:
+            inputs (list): a list of input variable names
+
+        """
+        if not isinstance(inputs, list):
+            raise TypeError(
+                f"Error - inputs must be of type list, not of type {type(inputs)}"
+            )
+        self.inputs = inputs
+
+    def set_outputs(self, outputs):
+        """
+        Set the outputs the chain produces
+
+        args:
+            outputs (list): a list of names of outputs of its steps
+
+        """
+        if not isinstance(outputs, list):
+            raise TypeError(
+                f"Error - outputs must be of type list, not of type {type(outputs)}"
+            )
+        self.outputs = outputs
+
+    @property
+    def resources(self):
+        """
+        The resources the chain needs: as the steps run one at a time, the
+        most any step declares of each.
+        """
+        combined = {}
+        for task, _ in self.steps:
+            for name, amount in task.resources.items():
+                combined[name] = max(amount, combined.get(name, 0))
+        return combined
+
+    def copy(self):
+        """
+        Return a copy of the chain
+        """
+        return copy.deepcopy(self)
+
+    def _check(self):
+        """
+        Check that every step's inputs will have values.
+        """
+        available = set(self.inputs)
+        for i, (task, links) in enumerate(self.steps):
+            missing = [
+                links.get(name, name)
+                for name in task.inputs
+                if links.get(name, name) not in available
+            ]
+            if missing:
+                raise ValueError(f"Error - no value for {missing} in step {i}")
+            available.update(task.outputs)
+
+    def _resolve_inputs(self, args):
+        """
+        Returns the value of each input of the chain, loading any files
+        given as paths.
+        """
+        items = []
+        for a in args:
+            items.extend(a if isinstance(a, list) else [a])
+        loaded = iter(self.filehandler.load_many(items, ignore_errors=True))
+        values = {}
+        for name, a in zip(self.inputs, args):
+            if isinstance(a, list):
+                values[name] = [next(loaded) for _ in a]
+            else:
+                values[name] = next(loaded)
+        return values
+
+    def run(self, *args):
+        """
+        Run the chain with the given inputs.
+        Args:
+            args: positional arguments whose order should match self.inputs
+
+        Returns:
+            tuple : outputs in the order they appear in
+                self.outputs, with output files converted to FileHandles
+        """
+        self._check()
+        profile = timings.Profile()
+        try:
+            with profile.phase("inputs"):
+                values = self._resolve_inputs(args)
+            pool = sandbox.get_pool()
+            with profile.phase("sandbox"):
+                files = [(name, v) for name, v in values.items() if hasattr(v, "size")]
+                td = pool.acquire(sandbox.choose_root(_input_size(files)))
+            try:
+                with profile.phase("execute"):
+                    for i, (task, links) in enumerate(self.steps):
+                        outputs = self._execute_step(
+                            task, links, values, op.join(td, f"step{i}"), profile
+                        )
+                        values.update(zip(task.outputs, outputs))
+                with profile.phase("stage_out"):
+                    outputs = self._load_outputs(values)
+            finally:
+                with profile.phase("cleanup"):
+                    pool.release(td)
+        finally:
+            profile.finish()
+        if len(outputs) == 1:
+            return outputs[0]
+        return tuple(outputs)
+
+    @staticmethod
+    def _execute_step(task, links, values, sd, profile):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """
+        Run one step in a fresh directory sd, with the step's retries.
+        """
+        step_values = {name: values[links.get(name, name)] for name in task.inputs}
+        if isinstance(task, SubprocessTask):
+            retry_on = task.retry_on or (TaskTimeoutError, OSError)
+        else:
+            retry_on = task.retry_on or (OSError,)
+
+        def attempt():
+            shutil.rmtree(sd, ignore_errors=True)
+            os.mkdir(sd)
+            return task._run_step(  # pylint: disable=protected-access
+                step_values, sd, profile
+            )
+
+        return _run_with_retries(attempt, (), task.retries, retry_on, task.retry_delay)
+
+    def _load_outputs(self, values):
+        """
+        Returns the chain's outputs, loading the files among them.
+        """
+        outputs = [values.get(name) for name in self.outputs]
+        paths = []
+        for value in outputs:
+            if isinstance(value, list):
+                paths.extend(v for v in value if isinstance(v, _LocalFile))
+            elif isinstance(value, _LocalFile):
+                paths.append(value)
+        loaded = self.filehandler.load_many(paths, copy=True) if paths else []
+        handles = dict(zip(paths, loaded))
+        result = []
+        for value in outputs:
+            if isinstance(value, list):
+                result.append([handles.get(v, v) for v in value])
+            else:
+                result.append(
+                    handles.get(value, value) if isinstance(value, str) else value
+                )
+        return result
+
 
 class XflowError(Exception):
     """
@@ -351,9 +1571,39 @@ class CalledProcessError(XflowError):
         self.stdout = e.stdout
         self.stderr = e.stderr
         self.output = self.stdout
+        self.timings = None
 
     def __str__(self):
         message = f'Error: command "{self.cmd}"'
         message += f" failed with return code {self.returncode};"
         message += f' STDOUT="{self.stdout}"; STDERR="{self.stderr}"'
         return message
+
+
+class TaskTimeoutError(XflowError):
+    """
+    Exception raised if a task runs for longer than its time limit.
+    """
+
+    def __init__(self, cmd, timeout):
+        super().__init__(cmd, timeout)
+        self.cmd = cmd
+        self.timeout = timeout
+
+    def __str__(self):
+        return f'Error: command "{self.cmd}" timed out after {self.timeout} seconds'
+
+
+class TaskCancelledError(XflowError):
+    """
+    Exception raised in a task that is killed because it was cancelled,
+    e.g. because a speculative copy of it finished first.
+    """
+
+
+class ServerError(XflowError, ConnectionError):
+    """
+    Exception raised if the tool behind a ServerTask exits, or closes its
+    connection, before it finishes responding to a request. It is an
+    OSError, so set_retries() retries it by default.
+    """
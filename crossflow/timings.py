@@ -0,0 +1,208 @@
+"""
+timings.py: per-phase timing of task runs.
+
+Every run of a SubprocessTask or FunctionTask records how long it spent in
+each phase:
+
+    inputs       loading input files given as paths, and checking the
+                 result cache (SubprocessTask only)
+    sandbox      getting a working directory
+    stage_in     putting the input files in the working directory
+    constants    putting constant files in the working directory
+    execute      running the command or function
+    stage_out    capturing output, and loading (and compressing) the
+                 output files
+    cleanup      releasing the working directory
+
+and in total. For a SubprocessTask, the profile is attached to the
+DEBUGINFO output as its timings attribute. Each process also keeps the
+profiles of its recent runs, by Dask task key, in STORE (runs of the
+async executor only count towards the totals, as Dask does not tell a
+coroutine its key). TimingsPlugin publishes the per-phase totals in each
+worker's heartbeat, and Client.phase_summary() summarizes the runs behind
+a list of futures.
+"""
+
+from collections import OrderedDict
+import contextlib
+import threading
+import time
+
+from distributed import WorkerPlugin
+
+from . import config
+
+PHASES = (
+    "inputs",
+    "sandbox",
+    "stage_in",
+    "constants",
+    "execute",
+    "stage_out",
+    "cleanup",
+)
+
+
+def _current_key():
+    """
+    Returns the key of the Dask task this thread is running, or None.
+    """
+    try:
+        # pylint: disable=import-outside-toplevel
+        from distributed.worker import thread_state
+    except ImportError:
+        return None
+    return getattr(thread_state, "key", None)
+
+
+class Profile:
+    """
+    The phase timings of one task run.
+
+    """
+
+    def __init__(self):
+        self.key = _current_key()
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Add the time spent in a with block to a phase.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+
+    def finish(self):
+        """
+        Record the total time, and add the profile to STORE.
+
+        returns:
+            dict: the seconds spent in each phase, and in total
+        """
+        self.times["total"] = time.perf_counter() - self._start
+        STORE.record(self.key, self.times)
+        return self.times
+
+
+class TimingStore:
+    """
+    The profiles of the most recent runs in this process, by Dask task key,
+    and the per-phase totals over all runs.
+
+    args:
+        max_size (int, optional): the number of task keys to keep profiles
+            for, config.TIMINGS_HISTORY by default
+
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = config.TIMINGS_HISTORY if max_size is None else max_size
+        self._lock = threading.Lock()
+        self._profiles = OrderedDict()
+        self._totals = dict.fromkeys(PHASES + ("total",), 0.0)
+        self._runs = 0
+
+    def record(self, key, times):
+        """
+        Add the profile of one run.
+
+        args:
+            key (str or None): the Dask task key, if any
+            times (dict): the seconds spent in each phase
+        """
+        with self._lock:
+            self._runs += 1
+            for phase, seconds in times.items():
+                self._totals[phase] = self._totals.get(phase, 0.0) + seconds
+            if key is None:
+                return
+            # a chunk of a chunked map() runs several times under one key
+            self._profiles.setdefault(key, []).append(dict(times))
+            self._profiles.move_to_end(key)
+            while len(self._profiles) > self.max_size:
+                self._profiles.popitem(last=False)
+
+    def lookup(self, keys):
+        """
+        Returns the profiles recorded for some task keys.
+
+        returns:
+            dict: a list of profiles for each key found
+        """
+        with self._lock:
+            return {k: list(self._profiles[k]) for k in keys if k in self._profiles}
+
+    def totals(self):
+        """
+        Returns the number of runs and the seconds spent in each phase,
+        summed over every run recorded.
+        """
+        with self._lock:
+            return dict(self._totals, runs=self._runs)
+
+    def reset(self):
+        """
+        Forget everything recorded.
+        """
+        with self._lock:
+            self._profiles.clear()
+            self._totals = dict.fromkeys(PHASES + ("total",), 0.0)
+            self._runs = 0
+
+
+STORE = TimingStore()
+
+
+def lookup(keys):
+    """
+    Returns the profiles STORE holds for some task keys, for Client.run().
+    """
+    return STORE.lookup(keys)
+
+
+def summarize(profiles):
+    """
+    Summarize the phase timings of several runs.
+
+    args:
+        profiles (iterable): dicts of seconds per phase, from Profile.finish()
+
+    returns:
+        dict: for each phase (and "total"), the "total", "mean" and "max"
+            seconds, and the "fraction" of all the runs' total time spent
+            in it; and the number of "runs"
+    """
+    profiles = list(profiles)
+    summary = {"runs": len(profiles)}
+    wall = sum(p.get("total", 0.0) for p in profiles)
+    for phase in PHASES + ("total",):
+        values = [p.get(phase, 0.0) for p in profiles]
+        total = sum(values)
+        summary[phase] = {
+            "total": total,
+            "mean": total / len(values) if values else 0.0,
+            "max": max(values, default=0.0),
+            "fraction": total / wall if wall else 0.0,
+        }
+    return summary
+
+
+class TimingsPlugin(WorkerPlugin):
+    """
+    A Dask worker plugin that reports each worker's per-phase totals to the
+    scheduler with its heartbeat, as the "crossflow_phases" worker metric.
+
+    """
+
+    name = "crossflow-timings"
+
+    def setup(self, worker):
+        worker.metrics["crossflow_phases"] = lambda worker: STORE.totals()
+
+    def teardown(self, worker):
+        worker.metrics.pop("crossflow_phases", None)
@@ -0,0 +1,192 @@
+"""
+urlcache.py: fetch http(s) inputs once, and keep them in an on-disk cache.
+
+Files loaded from http:// or https:// URLs are downloaded in a single
+request over a shared, connection-pooled session, into a cache directory
+keyed by the URL. The ETag and Last-Modified headers of the response are
+kept alongside, so loading the same URL again only sends a conditional
+request, and re-uses the cached copy if the server says it has not
+changed:
+
+    path = get_url_cache().fetch('https://files.rcsb.org/download/1ake.pdb')
+"""
+
+import hashlib
+import json
+import os
+import os.path as op
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import config, singleton
+
+
+def is_http(path):
+    """
+    Returns True if path is an http:// or https:// URL.
+    """
+    return isinstance(path, str) and path.startswith(("http://", "https://"))
+
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def get_session():
+    """
+    Returns the requests session shared by this process, creating it if
+    needed.
+    """
+    global _SESSION  # pylint: disable=global-statement
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32)
+            _SESSION.mount("http://", adapter)
+            _SESSION.mount("https://", adapter)
+        return _SESSION
+
+
+class URLCache:
+    """
+    An on-disk cache of files fetched from http(s) URLs.
+
+    Each URL is stored as a data file and a JSON metadata file, named by a
+    hash of the URL. Once the cache holds more than max_size bytes, the
+    least recently used files are removed.
+
+    """
+
+    def __init__(self, directory=None, max_size=None):
+        if directory is None:
+            directory = config.URL_CACHE_DIR
+        if directory is None:
+            directory = op.join(tempfile.gettempdir(), "crossflow-url-cache")
+        self.directory = directory
+        self.max_size = config.URL_CACHE_SIZE if max_size is None else max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return op.join(self.directory, key), op.join(self.directory, key + ".json")
+
+    def fetch(self, url):
+        """
+        Return the path of an up-to-date local copy of a URL.
+
+        args:
+            url (str): the http:// or https:// URL
+
+        returns:
+            str: the path of the cached copy
+
+        raises:
+            IOError: if the URL cannot be fetched
+        """
+        data_path, meta_path = self._paths(url)
+        meta = {}
+        if op.exists(data_path):
+            try:
+                with open(meta_path, encoding="utf-8") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                meta = {}
+        if meta and time.time() - meta.get("checked", 0) < config.URL_MAX_AGE:
+            return data_path
+
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        try:
+            response = get_session().get(
+                url, headers=headers, stream=True, timeout=config.URL_TIMEOUT
+            )
+            with response:
+                if response.status_code == 304 and meta:
+                    self._write_meta(meta_path, meta)
+                    return data_path
+                response.raise_for_status()
+                tmp_path = f"{data_path}.{uuid.uuid4().hex}.part"
+                with open(tmp_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+                os.replace(tmp_path, data_path)
+                meta = {
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                }
+        except requests.RequestException as e:
+            raise IOError(f"Error - cannot fetch {url}") from e
+        self._write_meta(meta_path, meta)
+        self._evict(keep=data_path)
+        return data_path
+
+    def _write_meta(self, meta_path, meta):
+        """
+        Atomically (re)write a metadata file, recording when the cached copy
+        was last checked.
+        """
+        meta["checked"] = time.time()
+        tmp_path = f"{meta_path}.{uuid.uuid4().hex}.part"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def _evict(self, keep=None):
+        """
+        Remove the least recently checked entries, other than keep, until
+        the cache fits in max_size.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            meta_path = op.join(self.directory, name)
+            data_path = meta_path[: -len(".json")]
+            try:
+                size = op.getsize(data_path)
+                checked = op.getmtime(meta_path)
+            except OSError:
+                continue
+            entries.append((checked, data_path, meta_path, size))
+            total += size
+        for _, data_path, meta_path, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            if data_path == keep:
+                continue
+            for path in (data_path, meta_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+    def clear(self):
+        """
+        Remove everything from the cache.
+        """
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(op.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+
+_CACHE = singleton.PerProcess(URLCache)
+
+
+def get_url_cache():
+    """
+    Returns the URLCache for this process, creating it if needed.
+    """
+    return _CACHE.get()
@@ -0,0 +1,35 @@
+import io
+
+from crossflow import capture
+
+
+def test_in_memory(tmpdir):
+    out = capture.OutputCapture(limit=100, directory=str(tmpdir))
+    out.write(b"hello ")
+    out.write(b"world")
+    assert not out.spilled
+    assert out.getvalue() == b"hello world"
+    assert out.tail(5) == b"world"
+
+
+def test_spill(tmpdir):
+    out = capture.OutputCapture(limit=100, directory=str(tmpdir))
+    for i in range(100):
+        out.write(b"%03d\n" % i)
+    assert out.spilled
+    assert out.getvalue() == b"".join(b"%03d\n" % i for i in range(100))
+    assert out.tail(8) == b"098\n099\n"
+    path = out.to_file()
+    out.close()
+    assert not tmpdir.join(path).exists()
+
+
+def test_tail():
+    err = capture.OutputCapture(tail=10)
+    thread = capture.drain(
+        io.BufferedReader(io.BytesIO(b"x" * 1000 + b"0123456789")), err
+    )
+    thread.join()
+    assert not err.spilled
+    assert err.size == 1010
+    assert err.getvalue() == b"0123456789"
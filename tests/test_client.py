@@ -1,9 +1,17 @@
 #!/usr/bin/env python
+import asyncio
+import multiprocessing
+import os
+import os.path as op
 from pathlib import Path
+import time
 
+import dask
+from dask.distributed import LocalCluster
+from distributed.deploy.subprocess import SubprocessCluster
 import pytest
 
-from crossflow import clients, filehandling, tasks
+from crossflow import clients, config, filehandling, staging, tasks
 
 
 @pytest.fixture(scope="session")
@@ -98,6 +106,19 @@ def test_subprocess_test_file(myclient, tmpdir):
         print("Error: result.result() = {}".format(result.result()))
 
 
+def test_subprocess_map_files(myclient, tmpdir):
+    sk = tasks.SubprocessTask("cat file.txt")
+    sk.set_inputs(["file.txt"])
+    sk.set_outputs([tasks.STDOUT])
+    paths = []
+    for i in range(4):
+        p = tmpdir / f"hello{i}.txt"
+        p.write_text(f"content {i}", encoding="utf-8")
+        paths.append(p)
+    results = myclient.map(sk, paths)
+    assert [r.result() for r in results] == [f"content {i}" for i in range(4)]
+
+
 # def test_subprocess_test_s3(myclient, tmpdir):
 #    sk = tasks.SubprocessTask('cat file.txt')
 #    sk.set_inputs(['file.txt'])
@@ -112,3 +133,249 @@ def test_subprocess_test_file(myclient, tmpdir):
 #        assert result.result() == 'content'
 #    except AssertionError:
 #        print('Error: result.result() = {}'.format(result.result()))
+
+
+def test_io_stats(myclient, tmpdir):
+    sk = tasks.SubprocessTask("cat file.txt")
+    sk.set_inputs(["file.txt"])
+    sk.set_outputs([tasks.STDOUT])
+    p = tmpdir / "stats.txt"
+    p.write_text("io stats content", encoding="utf-8")
+    before = myclient.io_stats()
+    assert myclient.submit(sk, str(p)).result() == "io stats content"
+    after = myclient.io_stats()
+    assert after["client"]["loads"] > before["client"]["loads"]
+    assert after["cluster"]["materializations"] > before["cluster"]["materializations"]
+
+
+@pytest.mark.parametrize("chunksize", [3, "auto"])
+def test_subprocess_map_chunks(myclient, chunksize):
+    sk = tasks.SubprocessTask("echo {x}; echo {x} > out.txt")
+    sk.set_inputs(["x"])
+    sk.set_outputs([tasks.STDOUT, "out.txt"])
+    stdouts, files = myclient.map(sk, list(range(10)), chunksize=chunksize)
+    assert [f.result() for f in stdouts] == [f"{i}\n" for i in range(10)]
+    assert [f.result().read_text() for f in files] == [f"{i}\n" for i in range(10)]
+
+
+def test_function_map_chunks(myclient):
+    results = myclient.map(lambda x, y: x * y, list(range(7)), 3, chunksize=2)
+    assert myclient.gather(results) == [3 * i for i in range(7)]
+
+
+def test_map_chunks_as_arguments(myclient):
+    squares = myclient.map(lambda x: x * x, list(range(6)), chunksize=4)
+    assert isinstance(squares[0], clients.ElementFuture)
+    total = myclient.submit(sum, squares)
+    assert total.result() == 55
+    doubled = myclient.map(lambda x: 2 * x, squares)
+    assert myclient.gather(doubled) == [2 * i * i for i in range(6)]
+
+
+@pytest.mark.skipif(os.name == "nt", reason="uses POSIX shell commands")
+def test_resources():
+    cluster = LocalCluster(
+        n_workers=1, threads_per_worker=2, processes=False, resources={"cores": 1}
+    )
+    with clients.Client(cluster) as client:
+        sk = tasks.SubprocessTask("echo $OMP_NUM_THREADS")
+        sk.set_outputs([tasks.STDOUT])
+        sk.set_resources(cores=1)
+        future = client.submit(sk)
+        assert future.result() == "1\n"
+        key = future.key
+        assert client.run_on_scheduler(
+            lambda dask_scheduler: dask_scheduler.tasks[key].resource_restrictions
+        ) == {"cores": 1}
+    cluster.close()
+
+
+@pytest.mark.parametrize("daemon", [True, False])
+def test_process_executor_daemonic_worker(daemon):
+    # Dask worker processes are daemonic by default, but can still start
+    # the pool
+    def parent_pid():
+        return multiprocessing.parent_process().pid
+
+    fk = tasks.FunctionTask(parent_pid)
+    fk.set_outputs(["pid"])
+    fk.set_executor("process")
+    with dask.config.set({"distributed.worker.daemon": daemon}):
+        cluster = LocalCluster(n_workers=1, threads_per_worker=1, processes=True)
+    with clients.Client(cluster) as client:
+        [worker_pid] = client.run(os.getpid).values()
+        [worker_daemon] = client.run(
+            lambda: multiprocessing.current_process().daemon
+        ).values()
+        assert worker_daemon == daemon
+        assert client.submit(fk).result() == worker_pid
+    cluster.close()
+
+
+def test_shared_file_fallback(tmpdir, monkeypatch):
+    # files in a directory the workers cannot see are copied by the client
+    monkeypatch.setattr(config, "SHARED_FILESYSTEM", True)
+    monkeypatch.setattr(clients, "visible_directories", lambda ds: [False] * len(ds))
+    p = tmpdir.join("input.txt")
+    p.write("shared\n")
+    sk = tasks.SubprocessTask("cat input.txt")
+    sk.set_inputs(["input.txt"])
+    sk.set_outputs([tasks.STDOUT])
+    cluster = LocalCluster(n_workers=1, threads_per_worker=1, processes=False)
+    with clients.Client(cluster) as client:
+        handle = client.filehandler.load(str(p))
+        assert handle.reference is not None
+        future = client.submit(sk, handle)
+        p.remove()
+        assert future.result() == "shared\n"
+        assert handle.reference is None
+    cluster.close()
+
+
+def test_staged_inputs_of_queued_task(tmpdir, monkeypatch):
+    # a staged input is kept while its task waits behind a longer one, even
+    # if the scheduler holding the task cannot lease it (here its leases
+    # are removed): the scheduler runs in its own process, as on a cluster
+    stage_point = tmpdir.mkdir("stage")
+    monkeypatch.setattr(config, "STAGE_POINT", str(stage_point))
+    monkeypatch.setattr(config, "STAGING_GRACE", 0)
+    monkeypatch.setenv("PYTHONPATH", op.dirname(op.dirname(clients.__file__)))
+    p = tmpdir.join("queued.txt")
+    p.write("queued\n")
+    blocker = tasks.SubprocessTask("sleep 3; echo done")
+    blocker.set_outputs([tasks.STDOUT])
+    sk = tasks.SubprocessTask("cat queued.txt")
+    sk.set_inputs(["queued.txt"])
+    sk.set_outputs([tasks.STDOUT])
+    cluster = SubprocessCluster(
+        n_workers=1, threads_per_worker=1, dashboard_address=":0"
+    )
+    with clients.Client(cluster) as client:
+        running = client.submit(blocker)
+        future = client.submit(sk, str(p))
+        time.sleep(1)
+        assert not running.done() and future.status == "pending"
+        stage_point.join(staging.LEASE_DIR).remove()
+        assert staging.collect(str(stage_point))["files"] == 0
+        assert future.result(timeout=30) == "queued\n"
+    cluster.close()
+
+
+def test_map_speculate(tmpdir, monkeypatch):
+    monkeypatch.setattr(clients.config, "SPECULATION_INTERVAL", 0.1)
+    marker = tmpdir.join("slow")
+    # the first run for x=3 hangs, any copy of it is fast
+    sk = tasks.SubprocessTask(
+        f"if [ {{x}} = 3 ] && mkdir {marker} 2>/dev/null; then sleep 60; fi; echo {{x}}"
+    )
+    sk.set_inputs(["x"])
+    sk.set_outputs([tasks.STDOUT])
+    cluster = LocalCluster(n_workers=1, threads_per_worker=4, processes=False)
+    with clients.Client(cluster) as client:
+        results = client.map(sk, list(range(6)), speculate=2.0)
+        assert isinstance(results[0], clients.SpeculativeFuture)
+        assert [r.result(timeout=30) for r in results] == [f"{i}\n" for i in range(6)]
+        assert client.gather(results) == [f"{i}\n" for i in range(6)]
+        assert len(results[3].race.futures) == 2
+        with pytest.raises(ValueError):
+            client.map(sk, list(range(6)), speculate=2.0, chunksize=2)
+    cluster.close()
+
+
+def test_speculative_futures_downstream():
+    # downstream work is submitted without waiting for the upstream races
+    sk = tasks.SubprocessTask("sleep 1; echo {x}")
+    sk.set_inputs(["x"])
+    sk.set_outputs([tasks.STDOUT])
+    cluster = LocalCluster(n_workers=1, threads_per_worker=2, processes=False)
+    with clients.Client(cluster) as client:
+        results = client.map(sk, [1, 2], speculate=2.0)
+        start = time.monotonic()
+        total = client.submit(lambda a, b: a + b, *results)
+        assert time.monotonic() - start < 0.5
+        assert not results[0].done()
+        assert total.result(timeout=30) == "1\n2\n"
+    cluster.close()
+
+
+@pytest.mark.skipif(os.name == "nt", reason="uses POSIX shell commands")
+def test_async_executor():
+    sk = tasks.SubprocessTask("sleep 1; echo {x}")
+    sk.set_inputs(["x"])
+    sk.set_outputs([tasks.STDOUT])
+    sk.set_executor("async")
+
+    async def run():
+        async with LocalCluster(
+            n_workers=1, threads_per_worker=8, processes=False, asynchronous=True
+        ) as cluster:
+            async with clients.Client(cluster, asynchronous=True) as client:
+                futures = client.map(sk, list(range(8)))
+                return await client.gather(futures)
+
+    start = time.monotonic()
+    assert asyncio.run(run()) == [f"{i}\n" for i in range(8)]
+    assert time.monotonic() - start < 6
+
+
+def test_phase_summary(myclient):
+    sk = tasks.SubprocessTask("sleep 0.1; echo {x} > out.txt; echo {x}")
+    sk.set_inputs(["x"])
+    sk.set_outputs([tasks.STDOUT, "out.txt"])
+    stdouts, files = myclient.map(sk, list(range(4)))
+    myclient.gather(stdouts)
+    summary = myclient.phase_summary([stdouts, files])
+    assert summary["runs"] == 4
+    assert summary["missing"] == 0
+    assert summary["execute"]["mean"] >= 0.1
+    assert 0 < summary["execute"]["fraction"] <= 1
+    chunked = myclient.map(sk, list(range(4)), chunksize=2)
+    myclient.gather(chunked[0])
+    assert myclient.phase_summary(chunked)["runs"] == 4
+
+
+@pytest.mark.skipif(os.name == "nt", reason="uses POSIX shell commands")
+def test_stream(myclient, monkeypatch):
+    monkeypatch.setattr(clients.config, "STREAM_INTERVAL", 0.1)
+    sk = tasks.SubprocessTask(
+        "for i in 1 2 3; do echo $i > chunk_$i.dat; sleep 0.3; done; echo done"
+    )
+    sk.set_outputs([tasks.STDOUT])
+    sk.set_stream(["chunk_*.dat"])
+    stream = myclient.stream(sk)
+    names = []
+    counts = []
+    for name, future in stream:
+        names.append(name)
+        counts.append(myclient.submit(lambda f: len(f.read_text()), future))
+    assert names == ["chunk_1.dat", "chunk_2.dat", "chunk_3.dat"]
+    assert myclient.gather(counts) == [2, 2, 2]
+    assert stream.result() == "done\n"
+    with pytest.raises(ValueError):
+        myclient.stream(tasks.SubprocessTask("true"))
+
+
+@pytest.mark.skipif(os.name == "nt", reason="ServerTasks need a POSIX platform")
+def test_server_task(myclient):
+    sk = tasks.ServerTask("cat", "{x}")
+    sk.set_inputs(["x"])
+    sk.set_outputs([tasks.STDOUT])
+    assert myclient.gather(myclient.map(sk, list(range(4)))) == [
+        f"{i}\n" for i in range(4)
+    ]
+
+
+def test_task_chain(myclient):
+    first = tasks.SubprocessTask("echo {x} > a.txt")
+    first.set_inputs(["x"])
+    first.set_outputs(["a.txt"])
+    second = tasks.SubprocessTask("cat a.txt a.txt > b.txt")
+    second.set_inputs(["a.txt"])
+    second.set_outputs(["b.txt", tasks.STDOUT])
+    chain = tasks.TaskChain([first, second])
+    chain.set_inputs(["x"])
+    chain.set_outputs(["b.txt"])
+    future = myclient.submit(chain, 1)
+    assert future.result().read_text() == "1\n1\n"
+    results = myclient.gather(myclient.map(chain, [2, 3]))
+    assert [r.read_text() for r in results] == ["2\n2\n", "3\n3\n"]
@@ -0,0 +1,72 @@
+import io
+import os
+
+import pytest
+
+from crossflow import compression, config, filehandling
+
+
+@pytest.mark.parametrize("name", compression.available_codecs())
+def test_codec_roundtrip(name):
+    codec = compression.get_codec(name)
+    data = b"ATOM      1  N   MET A   1      27.340  24.430   2.614\n" * 1000
+    sink = io.BytesIO()
+    compression.write_block(sink, codec, data)
+    compression.write_block(sink, codec, data[:100])
+    sink.seek(0)
+    assert b"".join(compression.iter_blocks(sink)) == data + data[:100]
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        compression.get_codec("no-such-codec")
+
+
+def test_select_by_extension():
+    assert compression.select_codec("traj.xtc", b"\0" * 1000).name == "none"
+    assert compression.select_codec("traj.NC").name == "none"
+    assert compression.select_codec("topol.prmtop", b"\0" * 1000).name != "none"
+
+
+def test_select_by_probe():
+    assert compression.select_codec("data.bin", os.urandom(10000)).name == "none"
+
+
+def test_select_configured(monkeypatch):
+    monkeypatch.setattr(config, "COMPRESSION", "bz2")
+    assert compression.select_codec("traj.xtc").name == "bz2"
+
+
+def test_incompressible_block_stored_raw():
+    data = os.urandom(10000)
+    sink = io.BytesIO()
+    written = compression.write_block(sink, compression.get_codec("zlib"), data)
+    assert written < len(data) + 100
+    sink.seek(0)
+    assert b"".join(compression.iter_blocks(sink)) == data
+
+
+@pytest.mark.parametrize("name", compression.available_codecs())
+def test_filehandle_codecs(tmpdir, monkeypatch, name):
+    monkeypatch.setattr(config, "COMPRESSION", name)
+    p = tmpdir.join("hello.txt")
+    p.write(f"content for {name}\n" * 100)
+    for stage_point in [None, tmpdir.mkdir("stage")]:
+        pf = filehandling.FileHandler(stage_point).load(p)
+        assert pf.codec == name
+        assert pf.read_text() == p.read()
+
+
+def test_block_reader():
+    codec = compression.get_codec("zlib")
+    data = bytes(range(256)) * 100
+    sink = io.BytesIO()
+    for start in range(0, len(data), 1000):
+        compression.write_block(sink, codec, data[start : start + 1000])
+    index = compression.build_index(sink.getvalue())
+    assert len(index) == 26
+    reader = io.BufferedReader(compression.BlockReader(sink.getvalue(), index))
+    reader.seek(12345)
+    assert reader.read(3000) == data[12345:15345]
+    reader.seek(-10, io.SEEK_END)
+    assert reader.read() == data[-10:]
@@ -1,6 +1,13 @@
+import os
 import os.path as op
+import pickle
+import subprocess
+import sys
 
-from crossflow import filehandling
+from distributed.protocol import deserialize, serialize
+import pytest
+
+from crossflow import config, filehandling
 
 
 def test_data_protocol(tmpdir):
@@ -38,6 +45,313 @@ def test_cleanup(tmpdir):
     assert not op.exists(tmppath)
 
 
+def test_deduplication(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, "STAGE_POINT", None)
+    d = tmpdir.mkdir("sub")
+    p = d.join("hello.txt")
+    p.write("deduplicated content")
+    q = d.join("hello2.txt")
+    q.write("deduplicated content")
+    fh = filehandling.FileHandler()
+    pf = fh.load(p)
+    qf = fh.load(q)
+    assert pf.uid == qf.uid
+    assert pf.store is qf.store
+    rf = pickle.loads(pickle.dumps(pf))
+    assert rf.store is pf.store
+    assert filehandling._STORE.refcount(pf.uid) == 3
+
+
+def test_shared_cleanup(tmpdir):
+    # handles with the same content share a payload, not a local copy
+    d = tmpdir.mkdir("sub")
+    p = d.join("hello.txt")
+    p.write("shared cleanup content")
+    fh = filehandling.FileHandler()
+    pf = fh.load(p)
+    qf = fh.load(p)
+    assert pf.uid == qf.uid
+    ppath = str(pf)
+    qpath = str(qf)
+    assert ppath != qpath
+    del pf
+    assert not op.exists(ppath)
+    assert op.exists(qpath)
+    assert qf.read_text() == "shared cleanup content"
+    del qf
+    assert not op.exists(qpath)
+
+
+def test_load_many(tmpdir):
+    d = tmpdir.mkdir("sub")
+    for i in range(5):
+        d.join(f"frame{i}.txt").write(f"frame {i}")
+    p = d.join("single.txt")
+    p.write("single")
+    fh = filehandling.FileHandler()
+    pf = fh.load(p)
+    result = fh.load_many([str(p), str(d.join("frame*.txt")), pf, p])
+    assert result[0].read_text() == "single"
+    assert [f.read_text() for f in result[1]] == [f"frame {i}" for i in range(5)]
+    assert result[2] is pf
+    assert result[3] is result[0]
+
+
+def test_load_many_errors(tmpdir):
+    fh = filehandling.FileHandler()
+    missing = str(tmpdir.join("missing.txt"))
+    assert fh.load_many([missing, 3], ignore_errors=True) == [missing, 3]
+    with pytest.raises(IOError):
+        fh.load_many([missing])
+
+
+def test_materialization_cache(tmpdir, monkeypatch):
+    d = tmpdir.mkdir("sub")
+    p = d.join("hello.txt")
+    p.write("cached content")
+    pf = filehandling.FileHandler().load(p)
+    cache = filehandling.MaterializationCache(str(tmpdir), max_size=1000)
+    cache.place(pf, str(d.join("copy1.txt")))
+    assert pf.uid in cache
+    monkeypatch.setattr(pf, "save", None)
+    cache.place(pf, str(d.join("copy2.txt")))
+    assert d.join("copy2.txt").read() == "cached content"
+
+
+def test_materialization_cache_private_copies(tmpdir):
+    # a tool that appends to its input must not change the cache
+    d = tmpdir.mkdir("sub")
+    p = d.join("hello.txt")
+    p.write("cached content")
+    pf = filehandling.FileHandler().load(p)
+    cache = filehandling.MaterializationCache(str(tmpdir))
+    cache.place(pf, str(d.join("copy1.txt")))
+    with open(d.join("copy1.txt"), "a") as f:
+        f.write(" and more")
+    cache.place(pf, str(d.join("copy2.txt")))
+    assert d.join("copy2.txt").read() == "cached content"
+    assert not op.samefile(d.join("copy2.txt"), cache.get(pf))
+
+
+def test_materialization_cache_hardlink(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, "LINK_MODE", "hardlink")
+    d = tmpdir.mkdir("sub")
+    p = d.join("hello.txt")
+    p.write("cached content")
+    pf = filehandling.FileHandler().load(p)
+    cache = filehandling.MaterializationCache(str(tmpdir))
+    cache.place(pf, str(d.join("copy.txt")))
+    assert op.samefile(d.join("copy.txt"), cache.get(pf))
+
+
+def test_materialization_cache_eviction(tmpdir):
+    d = tmpdir.mkdir("sub")
+    fh = filehandling.FileHandler()
+    cache = filehandling.MaterializationCache(str(tmpdir), max_size=250)
+    handles = []
+    for i in range(3):
+        p = d.join(f"file{i}.txt")
+        p.write(str(i) * 100)
+        handles.append(fh.load(p))
+        cache.place(handles[-1], str(d.join(f"copy{i}.txt")))
+    assert handles[0].uid not in cache
+    assert handles[1].uid in cache
+    assert handles[2].uid in cache
+    assert cache.size == 200
+    assert d.join("copy0.txt").read() == "0" * 100
+
+
+def test_materialization_cache_revalidates(tmpdir):
+    d = tmpdir.mkdir("sub")
+    p = d.join("hello.txt")
+    p.write("original content")
+    pf = filehandling.FileHandler().load(p)
+    cache = filehandling.MaterializationCache(str(tmpdir))
+    cached = cache.get(pf)
+    os.chmod(cached, 0o644)
+    with open(cached, "a") as f:
+        f.write(" and more")
+    cache.place(pf, str(d.join("copy.txt")))
+    assert d.join("copy.txt").read() == "original content"
+
+
+def test_reference_mode(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, "SHARED_FILESYSTEM", True)
+    d = tmpdir.mkdir("sub")
+    p = d.join("hello.txt")
+    p.write("shared content" * 1000)
+    pf = filehandling.FileHandler().load(p)
+    assert pf.reference == op.realpath(p)
+    assert pf.store is None
+    assert len(pickle.dumps(pf)) < 1000
+    q = d.join("hello2.txt")
+    pickle.loads(pickle.dumps(pf)).save(q)
+    assert q.read() == p.read()
+    assert os.fspath(pf) == op.realpath(p)
+    p.write("changed content")
+    with pytest.raises(IOError):
+        pf.read_text()
+
+
+def test_reference_mode_hashed(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, "SHARED_FILESYSTEM", True)
+    monkeypatch.setattr(config, "HASH_SHARED_FILES", True)
+    p = tmpdir.join("hello.txt")
+    p.write("shared content")
+    pf = filehandling.FileHandler().load(p)
+    assert pf.read_text() == "shared content"
+    p.write("shared CONTENT")
+    with pytest.raises(IOError):
+        pf.read_text()
+
+
+def test_reference_mode_auto(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, "SHARED_FILESYSTEM", "auto")
+    shared = tmpdir.mkdir("shared")
+    private = tmpdir.mkdir("private")
+    monkeypatch.setattr(config, "SHARED_PATHS", [str(shared)])
+    p = shared.join("hello.txt")
+    p.write("shared content")
+    q = private.join("hello.txt")
+    q.write("private content")
+    fh = filehandling.FileHandler()
+    assert fh.load(p).reference is not None
+    qf = fh.load(q)
+    assert qf.reference is None
+    assert qf.read_text() == "private content"
+
+
+def test_reference_mode_copy(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, "SHARED_FILESYSTEM", True)
+    p = tmpdir.join("hello.txt")
+    p.write("shared content")
+    fh = filehandling.FileHandler()
+    pf = fh.load(p, copy=True)
+    assert pf.reference is None
+    qf = fh.load(p)
+    qf.dereference()
+    assert qf.reference is None
+    p.remove()
+    assert pf.read_text() == qf.read_text() == "shared content"
+
+
+def test_out_of_band_pickle(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, "STAGE_POINT", None)
+    p = tmpdir.join("hello.txt")
+    p.write("out of band content" * 1000)
+    pf = filehandling.FileHandler().load(p)
+    buffers = []
+    data = pickle.dumps(pf, protocol=5, buffer_callback=buffers.append)
+    assert len(buffers) == 1
+    assert len(data) < 1000
+    qf = pickle.loads(data, buffers=buffers)
+    assert qf.read_text() == p.read()
+    assert pickle.loads(pickle.dumps(qf, protocol=4)).read_text() == p.read()
+
+
+def test_dask_serialization(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, "STAGE_POINT", None)
+    p = tmpdir.join("hello.txt")
+    p.write("dask content" * 1000)
+    pf = filehandling.FileHandler().load(p)
+    header, frames = serialize(pf, serializers=["dask"])
+    assert header["serializer"] == "dask"
+    assert any(frame is pf.store for frame in frames)
+    qf = deserialize(header, frames)
+    assert qf.read_text() == p.read()
+
+
+@pytest.mark.parametrize("staged", [False, True])
+def test_random_access(tmpdir, monkeypatch, staged):
+    monkeypatch.setattr(config, "BLOCK_SIZE", 1000)
+    stage_point = str(tmpdir.mkdir("stage")) if staged else None
+    p = tmpdir.join("traj.txt")
+    lines = [f"frame {i}\n" for i in range(5000)]
+    p.write("".join(lines))
+    pf = filehandling.FileHandler(stage_point).load(p)
+    data = p.read_binary()
+    assert pf.read_range(0, 8) == data[:8]
+    assert pf.read_range(23456, 2500) == data[23456:25956]
+    assert pf.read_range(len(data) - 5, 100) == data[-5:]
+    with pf.open() as f:
+        f.seek(40000)
+        assert f.read(10) == data[40000:40010]
+        assert f.tell() == 40010
+    assert list(pf.iter_lines()) == lines
+
+
+def test_random_access_decompresses_few_blocks(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, "STAGE_POINT", None)
+    monkeypatch.setattr(config, "BLOCK_SIZE", 1000)
+    p = tmpdir.join("big.txt")
+    p.write("0123456789" * 100000)
+    pf = filehandling.FileHandler().load(p)
+    codec = filehandling.compression.get_codec(pf.codec)
+    calls = []
+    monkeypatch.setattr(
+        codec,
+        "_decompress",
+        lambda data, n, f=codec._decompress: calls.append(n) or f(data, n),
+    )
+    assert pf.read_range(500500, 10) == b"0123456789"
+    assert len(calls) == 1
+
+
+def test_io_stats(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, "STAGE_POINT", None)
+    p = tmpdir.join("stats.txt")
+    p.write("statistics " * 10000)
+    fh = filehandling.FileHandler()
+    pf = fh.load(p)
+    assert pf.stats.snapshot()["raw_bytes"] == p.size()
+    assert 0 < pf.stats.snapshot()["stored_bytes"] < p.size()
+    fh.load(p)
+    pf.materialize(str(tmpdir.join("a.txt")))
+    pf.materialize(str(tmpdir.join("b.txt")))
+    stats = fh.stats()
+    assert stats["loads"] == 1
+    assert stats["reuses"] == 1
+    assert stats["materializations"] == 2
+    assert stats["cache_hits"] == 1
+    assert stats["decompress_seconds"] > 0
+    qf = pickle.loads(pickle.dumps(pf))
+    assert qf.stats.snapshot() == pf.stats.snapshot()
+
+
+def _peak_rss_mb(tmpdir, size_mb, stage_point):
+    """Load, stage and save a file of size_mb in a fresh process."""
+    script = f"""
+import os, resource, sys
+from crossflow import config, filehandling
+config.BUFFER_SIZE = 1024 * 1024
+src = os.path.join({str(tmpdir)!r}, "big.dat")
+with open(src, "wb") as f:
+    for _ in range({size_mb}):
+        f.write(bytes(1024 * 1024))
+base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+fh = filehandling.FileHandler({stage_point!r})
+pf = fh.load(src)
+pf.save(os.path.join({str(tmpdir)!r}, "copy.dat"))
+os.fspath(pf)
+# ru_maxrss is in bytes on macOS, kilobytes elsewhere
+unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+print((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base) // unit)
+"""
+    result = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, check=True, text=True
+    )
+    return int(result.stdout.split()[-1])
+
+
+@pytest.mark.parametrize("staged", [False, True])
+def test_streaming_memory_is_bounded(tmpdir, staged):
+    pytest.importorskip("resource")
+    stage_point = str(tmpdir.mkdir("stage")) if staged else None
+    small = _peak_rss_mb(tmpdir.mkdir("small"), 16, stage_point)
+    large = _peak_rss_mb(tmpdir.mkdir("large"), 128, stage_point)
+    assert large - small < 32
+
+
 def test_file_protocol(tmpdir):
     d = tmpdir.mkdir("sub")
     p = d.join("hello.txt")
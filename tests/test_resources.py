@@ -0,0 +1,66 @@
+import json
+import os
+import subprocess
+
+import pytest
+
+from crossflow import resources
+
+
+def test_dask_resources():
+    assert resources.dask_resources(cores=4, memory="2GB", scratch=1) == {
+        "cores": 4,
+        "memory": 2 * 10**9,
+        "scratch": 1,
+    }
+    assert resources.dask_resources() == {}
+    with pytest.raises(ValueError):
+        resources.dask_resources(cores=0)
+    with pytest.raises(TypeError):
+        resources.dask_resources(scratch="yes")
+
+
+def test_core_allocator(tmpdir):
+    allocator = resources.CoreAllocator(str(tmpdir.join("cores.json")))
+    n = len(allocator.cores)
+    if n == 0:
+        pytest.skip("CPU affinity is not supported here")
+    first = allocator.acquire(n)
+    assert sorted(first) == allocator.cores
+    assert allocator.acquire(1) is None
+    allocator.release(first)
+    assert allocator.acquire(1) == allocator.cores[:1]
+
+
+def test_core_allocator_node_wide(tmpdir):
+    # allocators in different worker processes share the allocation file
+    path = str(tmpdir.join("cores.json"))
+    first = resources.CoreAllocator(path)
+    second = resources.CoreAllocator(path)
+    n = len(first.cores)
+    if n == 0:
+        pytest.skip("CPU affinity is not supported here")
+    a = first.acquire((n + 1) // 2)
+    b = second.acquire(n // 2)
+    assert not set(a) & set(b)
+    assert second.acquire(1) is None
+    first.release(a)
+    assert second.acquire(1) == first.cores[:1]
+
+
+@pytest.mark.skipif(os.name == "nt", reason="runs the POSIX true command")
+def test_core_allocator_ignores_dead_processes(tmpdir):
+    path = tmpdir.join("cores.json")
+    allocator = resources.CoreAllocator(str(path))
+    if not allocator.cores:
+        pytest.skip("CPU affinity is not supported here")
+    process = subprocess.Popen(["true"])
+    process.wait()
+    path.write(json.dumps({f"{process.pid}:0": allocator.cores}))
+    assert allocator.acquire(1) == allocator.cores[:1]
+
+
+def test_thread_environment():
+    env = resources.thread_environment(3, {"PATH": "/bin"})
+    assert env["OMP_NUM_THREADS"] == "3"
+    assert env["PATH"] == "/bin"
@@ -0,0 +1,55 @@
+from crossflow import filehandling, resultcache
+
+
+def test_key(tmpdir):
+    p = tmpdir.join("a.txt")
+    p.write("content")
+    pf = filehandling.FileHandler().load(p)
+    key = resultcache.task_key("cat {x} a", {"x": 1}, [("a", pf)], ["STDOUT"])
+    assert key == resultcache.task_key("cat {x} a", {"x": 1}, [("a", pf)], ["STDOUT"])
+    assert key != resultcache.task_key("cat {x} a", {"x": 2}, [("a", pf)], ["STDOUT"])
+    assert key != resultcache.task_key("cat {x} a", {"x": 1}, [("b", pf)], ["STDOUT"])
+
+
+def test_roundtrip(tmpdir):
+    cache = resultcache.ResultCache(str(tmpdir.join("cache")))
+    p = tmpdir.join("out.dat")
+    p.write("output")
+    fh = filehandling.FileHandler()
+    cache.put("k", (fh.load(p), "text"), "stdout")
+    (handle, text), stdout = cache.get("k", fh)
+    assert handle.read_text() == "output"
+    assert text == "text"
+    assert stdout == "stdout"
+    assert cache.get("missing", fh) is None
+
+
+def test_eviction(tmpdir):
+    cache = resultcache.ResultCache(str(tmpdir.join("cache")), max_size=3000)
+    fh = filehandling.FileHandler()
+    handles = []
+    for i in range(3):
+        p = tmpdir.join(f"out{i}.dat")
+        p.write(str(i) * 1000)
+        handles.append(fh.load(p))
+    cache.put("k0", handles[0], "")
+    cache.put("k1", handles[1], "")
+    cache.get("k0", fh)
+    cache.put("k2", handles[2], "")
+    assert cache.size() <= 3000
+    assert cache.get("k0", fh) is not None
+    assert cache.get("k1", fh) is None
+    assert cache.get("k2", fh) is not None
+
+
+def test_journal_mode(tmpdir, monkeypatch):
+    # write-ahead logging is not used on a network filesystem
+    monkeypatch.setattr(resultcache, "filesystem_type", lambda path: "ext4")
+    cache = resultcache.ResultCache(str(tmpdir.join("local")))
+    monkeypatch.setattr(resultcache, "filesystem_type", lambda path: "nfs")
+    shared = resultcache.ResultCache(str(tmpdir.join("shared")))
+    assert cache.journal_mode == "WAL"
+    assert shared.journal_mode == "DELETE"
+    assert shared._query("PRAGMA journal_mode") == [("delete",)]
+    shared.put("k", "output", "")
+    assert shared.get("k", filehandling.FileHandler()) == ("output", "")
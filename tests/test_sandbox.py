@@ -0,0 +1,51 @@
+import os
+import os.path as op
+
+from crossflow import config, sandbox
+
+
+def test_reuse(tmpdir):
+    pool = sandbox.SandboxPool(max_size=1)
+    first = pool.acquire(str(tmpdir))
+    second = pool.acquire(str(tmpdir))
+    os.makedirs(op.join(first, "sub", "dir"))
+    with open(op.join(first, "out.txt"), "w", encoding="utf-8") as f:
+        f.write("output")
+    pool.release(first)
+    pool.release(second)
+    pool.wait()
+    assert os.listdir(first) == []
+    assert not op.exists(second)
+    assert pool.acquire(str(tmpdir)) == first
+    assert pool.acquire(str(tmpdir)) not in (first, second)
+
+
+def test_choose_root(tmpdir, monkeypatch):
+    shm = tmpdir.mkdir("shm")
+    ssd = tmpdir.mkdir("ssd")
+    root = tmpdir.mkdir("root")
+    monkeypatch.setattr(config, "SCRATCH_SHM", str(shm))
+    monkeypatch.setattr(config, "SCRATCH_LARGE", str(ssd))
+    monkeypatch.setattr(config, "SCRATCH_ROOT", str(root))
+    monkeypatch.setattr(config, "SCRATCH_SHM_SIZE", 1000)
+    monkeypatch.setattr(config, "SCRATCH_LARGE_SIZE", 10000)
+    assert sandbox.choose_root(10) == str(shm)
+    assert sandbox.choose_root(5000) == str(root)
+    assert sandbox.choose_root(20000) == str(ssd)
+    assert sandbox.choose_root() == str(root)
+    monkeypatch.setattr(config, "SCRATCH_SHM", str(tmpdir.join("missing")))
+    assert sandbox.choose_root(10) == str(root)
+
+
+def test_choose_root_default(tmpdir, monkeypatch):
+    # the RAM-backed tier is opt-in
+    monkeypatch.setattr(config, "SCRATCH_ROOT", str(tmpdir))
+    assert sandbox.choose_root(10) == str(tmpdir)
+
+
+def test_sandbox(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, "SCRATCH_ROOT", str(tmpdir))
+    monkeypatch.setattr(config, "SCRATCH_SHM", None)
+    with sandbox.sandbox() as td:
+        assert op.dirname(td) == str(tmpdir)
+        assert os.listdir(td) == []
@@ -0,0 +1,94 @@
+import json
+import os
+
+import pytest
+
+from crossflow import cli, config, filehandling, staging
+
+
+def _load(stage_point, path, text):
+    path.write(text)
+    return filehandling.FileHandler(str(stage_point)).load(path)
+
+
+def test_collect(tmpdir):
+    stage_point = tmpdir.mkdir("stage")
+    d = tmpdir.mkdir("sub")
+    kept = _load(stage_point, d.join("kept.txt"), "kept content")
+    dropped = _load(stage_point, d.join("dropped.txt"), "dropped content")
+    dropped_path = dropped.staging_path
+    del dropped
+    assert os.path.exists(dropped_path)
+    removed = staging.collect(str(stage_point), grace=0)
+    assert removed["files"] == 1
+    assert not os.path.exists(dropped_path)
+    assert os.path.exists(kept.staging_path)
+    assert kept.read_text() == "kept content"
+
+
+def test_collect_ignores_other_files(tmpdir):
+    stage_point = tmpdir.mkdir("stage")
+    notes = stage_point.join("notes.txt")
+    notes.write("not staged by crossflow")
+    assert staging.collect(str(stage_point), grace=0)["files"] == 0
+    assert notes.exists()
+    assert staging.usage(str(stage_point))["files"] == 0
+
+
+def test_collect_respects_other_leases(tmpdir, monkeypatch):
+    stage_point = tmpdir.mkdir("stage")
+    d = tmpdir.mkdir("sub")
+    pf = _load(stage_point, d.join("leased.txt"), "leased content")
+    uid, path = pf.staging_path.split(os.sep)[-1], pf.staging_path
+    del pf
+    lease_dir = stage_point.join(staging.LEASE_DIR).ensure(dir=True)
+    lease = lease_dir.join("otherhost-1234.json")
+    lease.write(json.dumps([uid]))
+    staging.collect(str(stage_point), grace=0)
+    assert os.path.exists(path)
+    assert staging.usage(str(stage_point))["live_files"] == 1
+
+    monkeypatch.setattr(config, "STAGING_HEARTBEAT", 0.01)
+    os.utime(lease, (0, 0))
+    staging.collect(str(stage_point), grace=0)
+    assert not os.path.exists(path)
+    assert not lease.exists()
+
+
+def test_quota_backpressure(tmpdir, monkeypatch):
+    stage_point = tmpdir.mkdir("stage")
+    d = tmpdir.mkdir("sub")
+    monkeypatch.setattr(config, "STAGING_QUOTA", 100)
+    monkeypatch.setattr(config, "STAGING_TIMEOUT", 0)
+    monkeypatch.setattr(config, "STAGING_GRACE", 0)
+    monkeypatch.setattr(config, "COMPRESSION", "none")
+    # uploads check the quota against the collector's last scan
+    staging.collect(str(stage_point))
+    first = _load(stage_point, d.join("first.txt"), "x" * 200)
+    with pytest.raises(IOError):
+        _load(stage_point, d.join("second.txt"), "y" * 200)
+    del first
+    second = _load(stage_point, d.join("second.txt"), "y" * 200)
+    assert second.read_text() == "y" * 200
+
+
+def test_cli(tmpdir, capsys):
+    stage_point = tmpdir.mkdir("stage")
+    pf = _load(stage_point, tmpdir.join("hello.txt"), "content")
+    assert cli.main(["staging", str(stage_point), "--collect", "--grace", "0"]) == 0
+    out = capsys.readouterr().out
+    assert "removed 0 files" in out
+    assert "in use:          1" in out
+    assert pf.read_text() == "content"
+
+
+def test_quota_unknown_usage(tmpdir, monkeypatch):
+    stage_point = tmpdir.mkdir("stage")
+    monkeypatch.setattr(config, "STAGING_QUOTA", 100)
+    monkeypatch.setattr(config, "STAGING_GRACE", 0)
+    pf = _load(stage_point, tmpdir.join("old.txt"), "x" * 200)
+    path = pf.staging_path
+    del pf
+    # without a previous scan, the upload goes ahead without collecting
+    staging.TRACKER.wait_for_space(str(stage_point))
+    assert os.path.exists(path)
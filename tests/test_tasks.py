@@ -1,6 +1,14 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import os.path as op
+import pickle
+import time
+import types
+
 import pytest
 
-from crossflow import filehandling, tasks
+from crossflow import config, filehandling, procpool, sandbox, tasks, timings
 
 
 def test_subprocess_task_no_filehandles(tmpdir):
@@ -97,6 +105,22 @@ def test_subprocess_task_globoutputs(tmpdir):
     assert len(result) == 3
 
 
+def test_subprocess_task_many_files(tmpdir):
+    paths = []
+    for i in range(40):
+        p = tmpdir.join(f"in{i}.txt")
+        p.write(f"{i}\n")
+        paths.append(str(p))
+    sk = tasks.SubprocessTask(
+        "for f in frame_*.txt; do cp $f out_$f; done; cat frame_*.txt > all.txt"
+    )
+    sk.set_inputs(["frame_*.txt"])
+    sk.set_outputs(["out_frame_*.txt", "all.txt"])
+    frames, combined = sk(paths)
+    assert [f.read_text() for f in frames] == [f"{i}\n" for i in range(40)]
+    assert combined.read_text() == "".join(f"{i}\n" for i in range(40))
+
+
 def test_subprocess_task_fails():
     with pytest.raises(tasks.XflowError):
         sk = tasks.SubprocessTask("foo -bar")
@@ -170,8 +194,10 @@ def test_function_task_with_output_filehandles(tmpdir):
     fk = tasks.FunctionTask(duplicate)
     fk.set_inputs(["a"])
     fk.set_outputs(["out.dat"])
+    fk.set_chdir(True)
     result = fk.run(pf)
     assert isinstance(result, filehandling.FileHandle)
+    assert result.read_text() == "line 1\nline 2\nline 3\n"
 
 
 def test_function_task_with_constant_filehandles(tmpdir):
@@ -228,3 +254,364 @@ def test_function_task_no_filehandles(tmpdir):
     fk.set_outputs(["nlines"])
     result = fk.run(p)
     assert result == 3
+
+
+def test_subprocess_task_cache(tmpdir):
+    counter = tmpdir.join("runs.log")
+    sk = tasks.SubprocessTask(f"echo run >> {counter}; tr a-z A-Z < in.txt > out.txt")
+    sk.set_inputs(["in.txt"])
+    sk.set_outputs(["out.txt", tasks.STDOUT])
+    sk.set_cache(str(tmpdir.join("cache")))
+    p = tmpdir.join("hello.txt")
+    p.write("content")
+    out, _ = sk(p)
+    assert out.read_text() == "CONTENT"
+    out, _ = sk(p)
+    assert out.read_text() == "CONTENT"
+    assert op.basename(out.path) == "out.txt"
+    assert counter.read().count("run") == 1
+    p.write("changed")
+    out, _ = sk(p)
+    assert out.read_text() == "CHANGED"
+    assert counter.read().count("run") == 2
+
+
+def test_subprocess_task_large_stdout(monkeypatch):
+    monkeypatch.setattr(tasks.config, "CAPTURE_SIZE", 1000)
+    sk = tasks.SubprocessTask("seq 1 10000")
+    sk.set_outputs([tasks.STDOUT])
+    expected = "".join(f"{i}\n" for i in range(1, 10001))
+    assert sk() == expected
+    sk.set_capture(stdout_filehandle=True)
+    result = sk()
+    assert isinstance(result, filehandling.FileHandle)
+    assert result.read_text() == expected
+    small = tasks.SubprocessTask("seq 1 10")
+    small.set_outputs([tasks.STDOUT])
+    assert small() == "".join(f"{i}\n" for i in range(1, 11))
+
+
+def test_subprocess_task_spill_directory(monkeypatch, tmpdir):
+    monkeypatch.setattr(tasks.config, "SCRATCH_ROOT", str(tmpdir))
+    out, err = tasks.SubprocessTask("true")._captures()
+    assert out.directory == err.directory == str(tmpdir)
+
+
+def test_subprocess_task_stderr_tail():
+    sk = tasks.SubprocessTask("seq 1 10000 >&2; exit 1")
+    sk.set_outputs([tasks.DEBUGINFO])
+    sk.set_capture(stderr_tail=1)
+    result = sk()
+    assert len(result.stderr) == 1024
+    assert result.stderr.endswith(b"9999\n10000\n")
+
+
+def test_subprocess_task_large_stderr(monkeypatch):
+    monkeypatch.setattr(tasks.config, "CAPTURE_SIZE", 1000)
+    sk = tasks.SubprocessTask("seq 1 10000 >&2; exit 1")
+    sk.set_outputs([tasks.DEBUGINFO])
+    result = sk()
+    assert len(result.stderr) == 1000
+    assert result.stderr.endswith(b"9999\n10000\n")
+
+
+@pytest.mark.skipif(os.name == "nt", reason="uses POSIX shell commands")
+def test_subprocess_task_cores():
+    sk = tasks.SubprocessTask(
+        "echo $OMP_NUM_THREADS; grep Cpus_allowed_list /proc/self/status || true"
+    )
+    sk.set_outputs([tasks.STDOUT])
+    sk.set_resources(cores=1)
+    assert sk.resources == {"cores": 1}
+    lines = sk().splitlines()
+    assert lines[0] == "1"
+    cores = tasks.resources.ALLOCATOR.cores
+    if cores and len(lines) > 1:
+        assert lines[1].split()[-1] == str(cores[0])
+
+
+def test_subprocess_task_timeout():
+    sk = tasks.SubprocessTask("sleep 10")
+    sk.set_timeout(0.5)
+    with pytest.raises(tasks.TaskTimeoutError):
+        sk()
+
+
+def test_subprocess_task_retries(tmpdir):
+    counter = tmpdir.join("counter")
+    sk = tasks.SubprocessTask(
+        f"echo run >> {counter}; [ $(wc -l < {counter}) -ge 3 ] || sleep 10; echo done"
+    )
+    sk.set_outputs([tasks.STDOUT])
+    sk.set_timeout(0.5)
+    sk.set_retries(1, delay=0)
+    with pytest.raises(tasks.TaskTimeoutError):
+        sk()
+    sk.set_retries(2, delay=0)
+    assert sk() == "done\n"
+    assert counter.read().count("run") == 3
+
+
+def test_function_task_relative_outputs():
+    def write(x):
+        with open("out.txt", "w") as f:
+            f.write(str(x))
+        time.sleep(0.01)
+        return "out.txt"
+
+    fk = tasks.FunctionTask(write)
+    fk.set_inputs(["x"])
+    fk.set_outputs(["out.txt"])
+    fk.set_chdir(True)
+    cwd = os.getcwd()
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(fk.run, range(8)))
+    assert [r.read_text() for r in results] == [str(i) for i in range(8)]
+    assert os.getcwd() == cwd
+
+
+def test_function_task_concurrent():
+    # by default runs neither change directory nor wait for each other
+    cwd = os.getcwd()
+
+    def write(x):
+        assert os.getcwd() == cwd
+        assert op.isabs(tasks.workdir())
+        with open(op.join(tasks.workdir(), "out.txt"), "w") as f:
+            f.write(str(x))
+        time.sleep(0.01)
+        return "out.txt"
+
+    fk = tasks.FunctionTask(write)
+    fk.set_inputs(["x"])
+    fk.set_outputs(["out.txt"])
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(fk.run, range(32)))
+    assert [r.read_text() for r in results] == [str(i) for i in range(32)]
+    assert os.getcwd() == cwd
+    assert tasks.workdir() is None
+
+
+def _pid_and_size(data, a):
+    with open(a) as f:
+        n_lines = len(f.readlines())
+    with open(op.join(tasks.workdir(), "out.txt"), "w") as f:
+        f.write(str(len(data)))
+    return [os.getpid(), n_lines, data[-1:], "out.txt"]
+
+
+def test_function_task_process_executor(tmpdir):
+    p = tmpdir.join("lines.txt")
+    p.write("line 1\nline 2\nline 3\n")
+    pf = filehandling.FileHandler().load(p)
+    fk = tasks.FunctionTask(_pid_and_size)
+    fk.set_inputs(["data", "a"])
+    fk.set_outputs(["pid", "n_lines", "last", "out.txt"])
+    with pytest.raises(ValueError):
+        fk.set_executor("gpu")
+    fk.set_executor("process")
+    data = bytearray(1024 * 1024)
+    data[-1] = 7
+    pid, n_lines, last, out = fk.run(pickle.PickleBuffer(data), pf)
+    assert pid != os.getpid()
+    assert n_lines == 3
+    assert last == bytearray([7])
+    assert out.read_text() == str(len(data))
+
+
+def test_process_executor_daemon_flag(monkeypatch):
+    # a daemonic process whose flag is not where it is expected gets a
+    # clear error rather than a silent change to multiprocessing internals
+    process = types.SimpleNamespace(daemon=True)
+    monkeypatch.setattr(procpool.multiprocessing, "current_process", lambda: process)
+    with pytest.raises(RuntimeError, match="distributed.worker.daemon"):
+        with procpool._allow_children():
+            pass
+    process.daemon = False
+    with procpool._allow_children():
+        pass
+
+
+@pytest.mark.skipif(os.name == "nt", reason="uses POSIX shell commands")
+def test_subprocess_task_run_async(tmpdir):
+    p = tmpdir.join("input.txt")
+    p.write("hello\n")
+    sk = tasks.SubprocessTask("sleep 0.5; cat input.txt > output.txt; echo {x}")
+    sk.set_inputs(["input.txt", "x"])
+    sk.set_outputs(["output.txt", tasks.STDOUT])
+
+    async def run_many():
+        return await asyncio.gather(*(sk.run_async(p, i) for i in range(8)))
+
+    start = time.monotonic()
+    results = asyncio.run(run_many())
+    assert time.monotonic() - start < 3
+    assert [r[1] for r in results] == [f"{i}\n" for i in range(8)]
+    assert results[0][0].read_text() == "hello\n"
+
+    sk = tasks.SubprocessTask("sleep 10")
+    sk.set_timeout(0.5)
+    with pytest.raises(tasks.TaskTimeoutError):
+        asyncio.run(sk.run_async())
+
+
+def test_subprocess_task_timings(tmpdir):
+    p = tmpdir.join("input.txt")
+    p.write("hello\n")
+    sk = tasks.SubprocessTask("sleep 0.2; cat input.txt > output.txt")
+    sk.set_inputs(["input.txt"])
+    sk.set_outputs(["output.txt", tasks.DEBUGINFO])
+    _, debuginfo = sk(p)
+    times = debuginfo.timings
+    assert set(times) == set(timings.PHASES) | {"total"}
+    assert times["execute"] >= 0.2
+    assert times["total"] >= sum(times[phase] for phase in timings.PHASES)
+
+
+@pytest.mark.skipif(os.name == "nt", reason="uses POSIX shell commands")
+def test_subprocess_task_run_streamed(monkeypatch):
+    monkeypatch.setattr(tasks.config, "STREAM_INTERVAL", 0.1)
+    sk = tasks.SubprocessTask(
+        "for i in 1 2 3; do echo $i > chunk_$i.dat; sleep 0.5; done; echo done"
+    )
+    sk.set_outputs([tasks.STDOUT])
+    sk.set_stream(["chunk_*.dat"])
+    published = []
+    start = time.monotonic()
+
+    def publish(name, filehandle):
+        published.append((name, filehandle.read_text(), time.monotonic() - start))
+
+    assert sk.run_streamed(publish) == "done\n"
+    assert [p[:2] for p in published] == [
+        ("chunk_1.dat", "1\n"),
+        ("chunk_2.dat", "2\n"),
+        ("chunk_3.dat", "3\n"),
+    ]
+    # the first chunk was published while the command was still running
+    assert published[0][2] < 1.4
+    with pytest.raises(TypeError):
+        sk.set_stream("chunk_*.dat")
+
+
+SERVER = """
+import os, sys
+print("READY", flush=True)
+for line in sys.stdin:
+    command, _, arg = line.strip().partition(" ")
+    if command == "crash":
+        sys.exit(3)
+    if command == "count":
+        with open(arg) as f, open(os.path.join(os.path.dirname(arg), "n.txt"), "w") as g:
+            g.write(str(len(f.read())))
+    print(os.getpid())
+    print("ERROR bad" if command == "bad" else "ok")
+    print("END", flush=True)
+"""
+
+
+@pytest.mark.skipif(os.name == "nt", reason="ServerTasks need a POSIX platform")
+def test_server_task(tmpdir):
+    script = tmpdir.join("server.py")
+    script.write(SERVER)
+    p = tmpdir.join("input.txt")
+    p.write("hello")
+    sk = tasks.ServerTask(f"python {script}", "{cmd} {workdir}/input.txt")
+    sk.set_inputs(["cmd", "input.txt"])
+    sk.set_outputs([tasks.STDOUT, "n.txt"])
+    sk.set_protocol(terminator="END", ready="READY", error="^ERROR")
+    first, n = sk("count", p)
+    assert first.endswith("ok\n")
+    assert n.read_text() == "5"
+    second, _ = sk("count", p)
+    assert second == first
+    with pytest.raises(tasks.CalledProcessError):
+        sk("bad", p)
+    with pytest.raises(tasks.ServerError):
+        sk("crash", p)
+    restarted, _ = sk("count", p)
+    assert restarted != first
+    with pytest.raises(TypeError):
+        sk.set_stream(["*.dat"])
+
+
+@pytest.mark.skipif(os.name == "nt", reason="ServerTasks need a POSIX platform")
+def test_server_task_socket(tmpdir):
+    script = tmpdir.join("server.py")
+    script.write(
+        "import socket, sys\n"
+        "s = socket.socket(socket.AF_UNIX)\n"
+        "s.bind(sys.argv[1])\n"
+        "s.listen()\n"
+        "while True:\n"
+        "    c, _ = s.accept()\n"
+        "    c.sendall(c.makefile('rb').read().upper())\n"
+        "    c.close()\n"
+    )
+    sk = tasks.ServerTask(f"python {script} {{socket}}", "{x}")
+    sk.set_inputs(["x"])
+    sk.set_outputs([tasks.STDOUT])
+    sk.set_protocol(transport="socket")
+    assert sk("abc") == "ABC\n"
+    assert sk("def") == "DEF\n"
+    with pytest.raises(ValueError):
+        tasks.ServerTask("python server.py", "{x}").set_protocol(transport="socket")
+
+
+def test_outputs_copied_from_shared_filesystem(monkeypatch):
+    # the working directory is emptied once the run is over
+    monkeypatch.setattr(config, "SHARED_FILESYSTEM", True)
+    sk = tasks.SubprocessTask("echo hello > out.txt")
+    sk.set_outputs(["out.txt"])
+    out = sk.run()
+    assert out.reference is None
+    sandbox.get_pool().wait()
+    assert out.read_text() == "hello\n"
+
+
+def test_task_chain(tmpdir):
+    p = tmpdir.join("start.txt")
+    p.write("hello\n")
+    first = tasks.SubprocessTask("cat start.txt start.txt > double.txt")
+    first.set_inputs(["start.txt"])
+    first.set_outputs(["double.txt"])
+    second = tasks.SubprocessTask("cat in.txt > out_{n}.txt; echo {n} >> out_{n}.txt")
+    second.set_inputs(["in.txt", "n"])
+    second.set_outputs(["out_7.txt"])
+    second.set_constant("n", 7)
+
+    def count(path):
+        with open(path) as f:
+            return len(f.readlines())
+
+    third = tasks.FunctionTask(count)
+    third.set_inputs(["path"])
+    third.set_outputs(["lines"])
+    chain = tasks.TaskChain([first])
+    chain.add_step(second, links={"in.txt": "double.txt"})
+    chain.add_step(third, links={"path": "out_7.txt"})
+    chain.set_inputs(["start.txt"])
+    chain.set_outputs(["out_7.txt", "lines"])
+    out, lines = chain(p)
+    assert isinstance(out, filehandling.FileHandle)
+    assert out.read_text() == "hello\nhello\n7\n"
+    assert lines == 3
+    chain.set_inputs([])
+    with pytest.raises(ValueError):
+        chain()
+
+
+def test_task_chain_private_inputs(tmpdir, monkeypatch):
+    # a step that appends to its input must not change an earlier step's output
+    monkeypatch.setattr(config, "LINK_MODE", "hardlink")
+    first = tasks.SubprocessTask("echo hello > a.txt")
+    first.set_outputs(["a.txt"])
+    second = tasks.SubprocessTask("echo more >> b.txt")
+    second.set_inputs(["b.txt"])
+    second.set_outputs(["b.txt"])
+    chain = tasks.TaskChain([first])
+    chain.add_step(second, links={"b.txt": "a.txt"})
+    chain.set_outputs(["a.txt", "b.txt"])
+    a, b = chain()
+    assert a.read_text() == "hello\n"
+    assert b.read_text() == "hello\nmore\n"
@@ -0,0 +1,77 @@
+import functools
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+import time
+
+import pytest
+
+from crossflow import config, filehandling, urlcache
+
+
+@pytest.fixture
+def server(tmpdir):
+    statuses = []
+
+    class Handler(SimpleHTTPRequestHandler):
+        def send_response(self, code, message=None):
+            statuses.append(code)
+            super().send_response(code, message)
+
+        def log_message(self, *args):
+            pass
+
+    handler = functools.partial(Handler, directory=str(tmpdir))
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}", tmpdir, statuses
+    httpd.shutdown()
+
+
+@pytest.fixture
+def cache(tmpdir, monkeypatch):
+    url_cache = urlcache.URLCache(str(tmpdir.mkdir("cache")))
+    monkeypatch.setattr(urlcache._CACHE, "instance", url_cache)
+    return url_cache
+
+
+def test_fetch_and_revalidate(server, cache):
+    base, root, statuses = server
+    root.join("protein.pdb").write("ATOM 1")
+    url = f"{base}/protein.pdb"
+    fh = filehandling.FileHandler()
+    assert fh.load(url).read_text() == "ATOM 1"
+    assert fh.load(url).read_text() == "ATOM 1"
+    assert statuses == [200, 304]
+
+    root.join("protein.pdb").write("ATOM 2")
+    later = time.time() + 10
+    os.utime(root.join("protein.pdb"), (later, later))
+    assert fh.load(url).read_text() == "ATOM 2"
+    assert statuses == [200, 304, 200]
+
+
+def test_max_age(server, cache, monkeypatch):
+    base, root, statuses = server
+    monkeypatch.setattr(config, "URL_MAX_AGE", 3600)
+    root.join("params.dat").write("parameters")
+    url = f"{base}/params.dat"
+    cache.fetch(url)
+    cache.fetch(url)
+    assert statuses == [200]
+
+
+def test_missing_url(server, cache):
+    base, _, _ = server
+    with pytest.raises(IOError):
+        filehandling.FileHandler().load(f"{base}/missing.pdb")
+
+
+def test_eviction(server, tmpdir):
+    base, root, _ = server
+    url_cache = urlcache.URLCache(str(tmpdir.mkdir("small")), max_size=150)
+    for i in range(3):
+        root.join(f"file{i}.dat").write(str(i) * 100)
+    paths = [url_cache.fetch(f"{base}/file{i}.dat") for i in range(3)]
+    assert [os.path.exists(p) for p in paths] == [False, False, True]